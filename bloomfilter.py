@@ -16,6 +16,7 @@ Ippolito <bob@redivi.com>.  Simplified, and optimized to use just python code.
 """
 
 from hashlib import sha1, sha256, sha384, sha512, md5
+from itertools import islice, izip
 from math import ceil, log
 from struct import Struct
 from binascii import hexlify, unhexlify
@@ -23,6 +24,11 @@ from binascii import hexlify, unhexlify
 from .decorator import Constructor, constructor
 from .revision import update_revision_information
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 if __debug__:
     from time import time
     from .dprint import dprint
@@ -80,6 +86,7 @@ class BloomFilter(Constructor):
             hashfn = md5
 
         self._fmt_unpack = Struct(">" + (fmt_code * k_functions) + ("x" * (hashfn().digest_size - bits_required / 8))).unpack
+        self._chunk_size = chunk_size
         self._salt = hashfn(prefix)
 
     @constructor(str, int)
@@ -239,6 +246,156 @@ class BloomFilter(Constructor):
         padding = '0'*(self._m_size/4 - len(hex))
         return unhexlify(padding + hex)[::-1]
 
+class ByteArrayBloomFilter(BloomFilter):
+    """
+    A BloomFilter that stores its bits in a mutable bytearray instead of a python long.
+
+    Setting a bit in a long creates a new long of m_size bits, while setting a bit in a bytearray is
+    done in place.  Bit POS is stored in byte POS / 8 at bit POS % 8, this results in the same bytes
+    property, and hence the same wire format, as the BloomFilter.
+    """
+    # the number of tuples that not_filter checks at once when numpy is available
+    _numpy_batch_size = 1024
+
+    def _init_(self, m_size, k_functions, prefix, filter_):
+        assert isinstance(filter_, long)
+        super(ByteArrayBloomFilter, self)._init_(m_size, k_functions, prefix, filter_)
+        if filter_:
+            hex = '%x' % filter_
+            self._filter = bytearray(unhexlify('0' * (m_size / 4 - len(hex)) + hex)[::-1])
+        else:
+            self._filter = bytearray(m_size / 8)
+
+    def add(self, key):
+        """
+        Add KEY to the BloomFilter.
+        """
+        filter_ = self._filter
+        m_size = self._m_size
+        h = self._salt.copy()
+        h.update(key)
+        for pos in self._fmt_unpack(h.digest()):
+            pos %= m_size
+            filter_[pos >> 3] |= 1 << (pos & 7)
+
+    def add_keys(self, keys):
+        """
+        Add a sequence of KEYS to the BloomFilter.
+        """
+        filter_ = self._filter
+        salt_copy = self._salt.copy
+        m_size = self._m_size
+        fmt_unpack = self._fmt_unpack
+
+        for key in keys:
+            assert isinstance(key, str)
+            h = salt_copy()
+            h.update(key)
+            for pos in fmt_unpack(h.digest()):
+                pos %= m_size
+                filter_[pos >> 3] |= 1 << (pos & 7)
+
+    def clear(self):
+        """
+        Set all bits in the filter to zero.
+        """
+        self._filter = bytearray(self._m_size / 8)
+
+    def __contains__(self, key):
+        filter_ = self._filter
+        m_size = self._m_size
+
+        h = self._salt.copy()
+        h.update(key)
+
+        for pos in self._fmt_unpack(h.digest()):
+            pos %= m_size
+            if not filter_[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def not_filter(self, iterator):
+        """
+        Yields all tuples in iterator where the first element in the tuple is NOT in the bloom
+        filter.
+
+        When numpy is available the tuples are checked in batches of _numpy_batch_size.
+        """
+        if numpy:
+            return self._not_filter_numpy(iterator)
+        else:
+            return self._not_filter_python(iterator)
+
+    def _not_filter_python(self, iterator):
+        filter_ = self._filter
+        salt_copy = self._salt.copy
+        m_size = self._m_size
+        fmt_unpack = self._fmt_unpack
+
+        for tup in iterator:
+            assert isinstance(tup, tuple)
+            assert len(tup) > 0
+            assert isinstance(tup[0], str)
+            h = salt_copy()
+            h.update(tup[0])
+            for pos in fmt_unpack(h.digest()):
+                pos %= m_size
+                if not filter_[pos >> 3] & (1 << (pos & 7)):
+                    yield tup
+                    break
+
+    def _not_filter_numpy(self, iterator):
+        batch_size = self._numpy_batch_size
+        iterator = iter(iterator)
+        while True:
+            batch = list(islice(iterator, batch_size))
+            if not batch:
+                break
+            if __debug__:
+                for tup in batch:
+                    assert isinstance(tup, tuple)
+                    assert len(tup) > 0
+                    assert isinstance(tup[0], str)
+
+            for tup, missing in izip(batch, self.get_missing_mask([tup[0] for tup in batch])):
+                if missing:
+                    yield tup
+
+    def get_missing_mask(self, keys):
+        """
+        Returns a numpy array of booleans where element I is True when KEYS[I] is NOT in the bloom
+        filter.
+
+        The keys are hashed one by one, however, the bit positions for all keys are computed and
+        checked against the filter in a few vectorized operations.  This method requires numpy.
+        """
+        assert numpy, "requires numpy"
+        assert isinstance(keys, (tuple, list))
+        if not keys:
+            return numpy.zeros(0, dtype=bool)
+
+        salt_copy = self._salt.copy
+        digests = []
+        for key in keys:
+            h = salt_copy()
+            h.update(key)
+            digests.append(h.digest())
+
+        # one row for each key containing the first k_functions * chunk_size bytes of its digest,
+        # interpreted as k_functions big-endian unsigned integers (identical to _fmt_unpack)
+        rows = numpy.frombuffer("".join(digests), dtype=numpy.uint8).reshape(len(digests), self._salt.digest_size)
+        positions = numpy.ascontiguousarray(rows[:, :self._k_functions * self._chunk_size]).view(">u%d" % self._chunk_size) % self._m_size
+
+        bits = numpy.frombuffer(self._filter, dtype=numpy.uint8)[positions >> 3] & (1 << (positions & 7))
+        return (bits == 0).any(axis=1)
+
+    def get_bits_checked(self):
+        return sum(bin(byte).count("1") for byte in self._filter)
+
+    @property
+    def bytes(self):
+        return str(self._filter)
+
 if __debug__:
     def _test_behavior():
         length = 1024
@@ -301,7 +458,7 @@ if __debug__:
             print "create: {create:.1f}; fill: {fill:.1f}; check: {check:.1f}; write: {write:.1f}".format(create=fill_begin-create_begin, fill=check_begin-fill_begin, check=write_begin-check_begin, write=write_end-write_begin)
             print string.encode("HEX")[:100], "{len} bytes; ({ok}/{total} ~{part:.0%})".format(len=len(string), ok=ok, total=count, part=1.0*ok/count)
 
-        b = BloomFilter(100, 0.0001)
+        b = BloomFilter(128, 0.0001)
         b.add("Hello")
         data = str(b)
 
@@ -309,25 +466,48 @@ if __debug__:
         #assert "Hello" in c
         #assert not "Bye" in c
 
-        test2(10, 10,FasterBloomFilter)
-        test2(10, 100,FasterBloomFilter)
-        test2(100, 100,FasterBloomFilter)
-        test2(100, 1000,FasterBloomFilter)
-        test2(1000, 1000,FasterBloomFilter)
-        test2(1000, 10000,FasterBloomFilter)
-        test2(10000, 10000,FasterBloomFilter)
-        test2(10000, 100000,FasterBloomFilter)
-
-        test(10, 10,FasterBloomFilter)
-        test(10, 100,FasterBloomFilter)
-        test(100, 100,FasterBloomFilter)
-        test(100, 1000,FasterBloomFilter)
-        test(1000, 1000,FasterBloomFilter)
-        test(1000, 10000,FasterBloomFilter)
-        test(10000, 10000,FasterBloomFilter)
-        test(10000, 100000,FasterBloomFilter)
-        test(100000, 100000,FasterBloomFilter)
-        test(100000, 1000000,FasterBloomFilter)
+        def compare(m_size, count):
+            # compare the long based BloomFilter with the bytearray based ByteArrayBloomFilter
+            keys = [sha1(str(i)).digest() for i in xrange(count)]
+            tuples = [(key,) for key in keys[1::2]]
+            results = []
+            for constructor in (BloomFilter, ByteArrayBloomFilter):
+                create_begin = time()
+                bloom = constructor(m_size, 0.01, prefix="x")
+                fill_begin = time()
+                bloom.add_keys(keys[::2])
+                check_begin = time()
+                missing = len(list(bloom.not_filter(tuples)))
+                write_begin = time()
+                string = bloom.bytes
+                write_end = time()
+                results.append(string)
+
+                print "{name:>20}: {count:7d} keys; {size:8d} bits; create: {create:.2f}; fill: {fill:.2f}; check: {check:.2f}; write: {write:.3f}; missing: {missing}".format(name=constructor.__name__, count=count, size=m_size, create=fill_begin-create_begin, fill=check_begin-fill_begin, check=write_begin-check_begin, write=write_end-write_begin, missing=missing)
+            assert results[0] == results[1], "both engines must produce the same bytes"
+
+        # a filter that fits in a single introduction request
+        compare(1024 * 8, 10000)
+        compare(1024 * 8, 100000)
+        compare(1024 * 8, 1000000)
+
+        # a filter that is sized for the number of keys (1% error rate)
+        compare(int(ceil(10000 * 9.6 / 8) * 8), 10000)
+        compare(int(ceil(100000 * 9.6 / 8) * 8), 100000)
+        compare(int(ceil(1000000 * 9.6 / 8) * 8), 1000000)
+
+#          BloomFilter:   10000 keys;     8192 bits; create: 0.00; fill: 0.05; check: 0.05; write: 0.000; missing: 514
+# ByteArrayBloomFilter:   10000 keys;     8192 bits; create: 0.00; fill: 0.04; check: 0.03; write: 0.000; missing: 514
+#          BloomFilter:  100000 keys;     8192 bits; create: 0.00; fill: 0.26; check: 0.23; write: 0.000; missing: 0
+# ByteArrayBloomFilter:  100000 keys;     8192 bits; create: 0.00; fill: 0.16; check: 0.16; write: 0.000; missing: 0
+#          BloomFilter: 1000000 keys;     8192 bits; create: 0.00; fill: 2.70; check: 2.31; write: 0.000; missing: 0
+# ByteArrayBloomFilter: 1000000 keys;     8192 bits; create: 0.00; fill: 1.69; check: 1.25; write: 0.000; missing: 0
+#          BloomFilter:   10000 keys;    96000 bits; create: 0.00; fill: 0.03; check: 0.02; write: 0.000; missing: 4999
+# ByteArrayBloomFilter:   10000 keys;    96000 bits; create: 0.00; fill: 0.01; check: 0.01; write: 0.000; missing: 4999
+#          BloomFilter:  100000 keys;   960000 bits; create: 0.00; fill: 2.65; check: 1.15; write: 0.002; missing: 49987
+# ByteArrayBloomFilter:  100000 keys;   960000 bits; create: 0.00; fill: 0.10; check: 0.07; write: 0.000; missing: 49987
+#          BloomFilter: 1000000 keys;  9600000 bits; create: 0.00; fill: 625.26; check: 162.36; write: 0.016; missing: 499877
+# ByteArrayBloomFilter: 1000000 keys;  9600000 bits; create: 0.00; fill: 1.59; check: 0.89; write: 0.000; missing: 499877
 
 
         #test2(10, 10)
@@ -5,12 +5,21 @@ from __future__ import with_statement
 A callback thread running Dispersy.
 """
 
-from heapq import heappush, heappop
+from errno import EINTR
+from heapq import heapify, heappush, heappop
 from thread import get_ident
 from threading import Thread, Lock, Event, currentThread
 from time import sleep, time
 from types import GeneratorType, TupleType
 from sys import exc_info
+import os
+
+try:
+    from fcntl import fcntl, F_GETFL, F_SETFL
+    from select import epoll, EPOLLIN
+except ImportError:
+    # epoll is only available on Linux
+    epoll = None
 
 try:
     import prctl
@@ -30,6 +39,9 @@ if __debug__:
     # dprint warning when registered call, or generator call, should have run N seconds ago
     QUEUE_DELAY_FOR_WARNING = 1.0
 
+# check the registered readers at least every N seconds while there are expired tasks to handle
+READER_POLL_INTERVAL = 0.05
+
 # update version information directly from SVN
 update_revision_information("$HeadURL$", "$Revision$")
 
@@ -51,9 +63,17 @@ class Callback(object):
     def __init__(self):
         # _event is used to wakeup the thread when new actions arrive
         self._event = Event()
-        self._event_set = self._event.set
+        self._event_set = self._wakeup
         self._event_is_set = self._event.isSet
 
+        # _poller waits for the file descriptors in _readers, and for _wakeup_read, instead of
+        # _event when at least one reader has been registered.  _readers contains fileno:call pairs.
+        # they are protected by _lock
+        self._poller = None
+        self._readers = {}
+        self._wakeup_read = None
+        self._wakeup_write = None
+
         # _lock is used to protect variables that are written to on multiple threads
         self._lock = Lock()
 
@@ -89,20 +109,30 @@ class Callback(object):
         self._id = 0
 
         # _requests are ordered by deadline and moved to -expired- when they need to be handled
-        # (deadline, priority, root_id, (call, args, kargs), callback)
+        # (deadline, priority, root_id, task)
         self._requests = []
 
         # expired requests are ordered and handled by priority
-        # (priority, root_id, None, (call, args, kargs), callback)
+        # (priority, deadline, root_id, task)
         self._expired = []
 
-        # _requests_mirror and _expired_mirror contains the same list as _requests and _expired,
-        # respectively.  when the callback closes _requests is set to a new empty list while
-        # _requests_mirror continues to point to the existing one.  because all task 'deletes' are
-        # done on the _requests_mirror list, these actions will still be allowed while no new tasks
-        # will be accepted.
-        self._requests_mirror = self._requests
-        self._expired_mirror = self._expired
+        # every scheduled entry refers to a TASK, a mutable [call, callback] list where call is
+        # either a (call, args, kargs) tuple or a generator.  the same task is moved from _requests
+        # to _expired.  unregistering a task sets both its call and callback to None, the entry
+        # remains in the heap as a tombstone and is ignored once it is popped.
+        #
+        # _tasks maps every id_ to the list of tasks that are currently scheduled (in either
+        # _requests or _expired) under that id_.  it allows unregister, replace_register, and
+        # persistent_register to find tasks without scanning the heaps.  when the callback closes
+        # _requests and _expired are set to new empty lists, _tasks continues to point to the
+        # existing tasks, hence these can still be removed while no new tasks will be accepted.  it
+        # is protected by _lock
+        self._tasks = {}
+
+        # _tombstones contains the number of unregistered tasks that are still in either _requests
+        # or _expired.  the heaps are compacted when most of their entries are tombstones.  it is
+        # protected by _lock
+        self._tombstones = 0
 
         if __debug__:
             def must_close(callback):
@@ -188,6 +218,126 @@ class Callback(object):
                 dprint(exception=True, level="error")
                 assert False, "the exception handler should not cause an exception"
 
+    def _wakeup(self):
+        """
+        Wakeup the thread when it is waiting for either _event or _poller.
+        """
+        self._event.set()
+        if self._wakeup_write is not None:
+            try:
+                os.write(self._wakeup_write, "w")
+            except OSError:
+                # the pipe is full, the thread will wakeup regardless
+                pass
+
+    def register_reader(self, fileno, call):
+        """
+        Call CALL, on the callback thread, whenever file descriptor FILENO is readable.
+
+        The thread will wait for FILENO using epoll instead of sleeping, hence the readable data is
+        handled without any thread handoff or polling delay.  Available on Linux only.
+        """
+        assert epoll, "epoll is not available on this platform"
+        assert isinstance(fileno, int), type(fileno)
+        assert hasattr(call, "__call__"), call
+        with self._lock:
+            assert not fileno in self._readers, fileno
+            if self._poller is None:
+                self._poller = epoll()
+                self._wakeup_read, self._wakeup_write = os.pipe()
+                for fd in (self._wakeup_read, self._wakeup_write):
+                    fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | os.O_NONBLOCK)
+                self._poller.register(self._wakeup_read, EPOLLIN)
+            self._readers[fileno] = call
+            self._poller.register(fileno, EPOLLIN)
+
+            # wakeup, the thread may be waiting for _event
+            self._event_set()
+
+    def unregister_reader(self, fileno):
+        """
+        Stop calling the reader that was registered for file descriptor FILENO.
+        """
+        assert isinstance(fileno, int), type(fileno)
+        with self._lock:
+            if self._readers.pop(fileno, None) and self._poller:
+                self._poller.unregister(fileno)
+
+    def _poll(self, timeout):
+        """
+        Wait at most TIMEOUT seconds for the registered file descriptors and call the readers of
+        those that are readable.
+        """
+        try:
+            events = self._poller.poll(timeout)
+        except IOError, exception:
+            if exception.errno == EINTR:
+                return
+            raise
+
+        for fileno, _ in events:
+            if fileno == self._wakeup_read:
+                try:
+                    os.read(fileno, 4096)
+                except OSError:
+                    pass
+                continue
+
+            call = self._readers.get(fileno)
+            if call:
+                try:
+                    call()
+                except Exception, exception:
+                    dprint(exception=True, level="error")
+                    self._call_exception_handlers(exception, False)
+
+    def _schedule(self, id_, call, args, kargs, delay, priority, callback, callback_args, callback_kargs, include_id):
+        """
+        Push a new task onto either _requests or _expired and add it to _tasks.
+
+        Must be called while holding _lock.
+        """
+        task = [(call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
+                None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs)]
+
+        if delay <= 0.0:
+            heappush(self._expired, (-priority, time(), id_, task))
+        else:
+            heappush(self._requests, (delay + time(), -priority, id_, task))
+
+        tasks = self._tasks.get(id_)
+        if tasks is None:
+            self._tasks[id_] = [task]
+        else:
+            tasks.append(task)
+
+        # wakeup if sleeping
+        if not self._event_is_set():
+            self._event_set()
+
+    def _unschedule(self, id_):
+        """
+        Turn all tasks scheduled under ID_ into tombstones.
+
+        Must be called while holding _lock.
+        """
+        tasks = self._tasks.pop(id_, None)
+        if tasks:
+            if __debug__: dprint("unregister ", len(tasks), " tasks: ", id_)
+            for task in tasks:
+                task[0] = None
+                task[1] = None
+
+            self._tombstones += len(tasks)
+            if self._tombstones > 1024 and self._tombstones * 2 > len(self._requests) + len(self._expired):
+                if __debug__: dprint("compact ", self._tombstones, " tombstones")
+                # modify the lists in place, _loop holds references to them
+                self._requests[:] = [entry for entry in self._requests if entry[3][0] is not None]
+                heapify(self._requests)
+                self._expired[:] = [entry for entry in self._expired if entry[3][0] is not None]
+                heapify(self._expired)
+                self._tombstones = 0
+
     def register(self, call, args=(), kargs=None, delay=0.0, priority=0, id_="", callback=None, callback_args=(), callback_kargs=None, include_id=False):
         """
         Register CALL to be called.
@@ -252,25 +402,7 @@ class Callback(object):
                 self._id += 1
                 id_ = self._id
 
-            if delay <= 0.0:
-                heappush(self._expired,
-                         (-priority,
-                          time(),
-                          id_,
-                          None,
-                          (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
-                          None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs)))
-            else:
-                heappush(self._requests,
-                         (delay + time(),
-                          -priority,
-                          id_,
-                          (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
-                          None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs)))
-
-            # wakeup if sleeping
-            if not self._event_is_set():
-                self._event_set()
+            self._schedule(id_, call, args, kargs, delay, priority, callback, callback_args, callback_kargs, include_id)
             return id_
 
     def persistent_register(self, id_, call, args=(), kargs=None, delay=0.0, priority=0, callback=None, callback_args=(), callback_kargs=None, include_id=False):
@@ -303,38 +435,8 @@ class Callback(object):
         if __debug__: dprint("persistent register ", call, " after ", delay, " seconds")
 
         with self._lock:
-            for tup in self._requests:
-                if tup[2] == id_:
-                    break
-
-            else:
-                # not found in requests
-                for tup in self._expired:
-                    if tup[2] == id_:
-                        break
-
-                else:
-                    # not found in expired
-                    if delay <= 0.0:
-                        heappush(self._expired,
-                                 (-priority,
-                                  time(),
-                                  id_,
-                                  None,
-                                  (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
-                                  None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs)))
-
-                    else:
-                        heappush(self._requests,
-                                 (delay + time(),
-                                  -priority,
-                                  id_,
-                                  (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
-                                  None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs)))
-
-                    # wakeup if sleeping
-                    if not self._event_is_set():
-                        self._event_set()
+            if not id_ in self._tasks:
+                self._schedule(id_, call, args, kargs, delay, priority, callback, callback_args, callback_kargs, include_id)
 
             return id_
 
@@ -358,38 +460,8 @@ class Callback(object):
         assert isinstance(include_id, bool), "INCLUDE_ID has invalid type: %d" % type(include_id)
         if __debug__: dprint("replace register ", call, " after ", delay, " seconds")
         with self._lock:
-            # un-register
-            for index, tup in enumerate(self._requests_mirror):
-                if tup[2] == id_:
-                    self._requests_mirror[index] = (tup[0], tup[1], id_, None, None)
-                    if __debug__: dprint("in _requests: ", id_)
-
-            for index, tup in enumerate(self._expired_mirror):
-                if tup[2] == id_:
-                    self._expired_mirror[index] = (tup[0], tup[1], id_, tup[3], None, None)
-                    if __debug__: dprint("in _expired: ", id_)
-
-            # register
-            if delay <= 0.0:
-                heappush(self._expired,
-                         (-priority,
-                          time(),
-                          id_,
-                          None,
-                          (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
-                          None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs)))
-
-            else:
-                heappush(self._requests,
-                         (delay + time(),
-                          -priority,
-                          id_,
-                          (call, args + (id_,) if include_id else args, {} if kargs is None else kargs),
-                          None if callback is None else (callback, callback_args, {} if callback_kargs is None else callback_kargs)))
-
-            # wakeup if sleeping
-            if not self._event_is_set():
-                self._event_set()
+            self._unschedule(id_)
+            self._schedule(id_, call, args, kargs, delay, priority, callback, callback_args, callback_kargs, include_id)
             return id_
 
     def unregister(self, id_):
@@ -400,16 +472,7 @@ class Callback(object):
         assert id_, "ID_ may not be zero or an empty (unicode)string"
         if __debug__: dprint(id_)
         with self._lock:
-            # un-register
-            for index, tup in enumerate(self._requests_mirror):
-                if tup[2] == id_:
-                    self._requests_mirror[index] = (tup[0], tup[1], id_, None, None)
-                    if __debug__: dprint("in _requests: ", id_)
-
-            for index, tup in enumerate(self._expired_mirror):
-                if tup[2] == id_:
-                    self._expired_mirror[index] = (tup[0], tup[1], id_, tup[2], None, None)
-                    if __debug__: dprint("in _expired: ", id_)
+            self._unschedule(id_)
 
     def call(self, call, args=(), kargs=None, delay=0.0, priority=0, id_="", include_id=False, timeout=0.0, default=None):
         """
@@ -499,7 +562,7 @@ class Callback(object):
                 if __debug__: dprint("STATE_PLEASE_STOP")
 
                 # wakeup if sleeping
-                self._event.set()
+                self._event_set()
 
             if wait and not self._thread_ident == get_ident():
                 while self._state == "STATE_PLEASE_STOP" and timeout > 0.0:
@@ -534,6 +597,7 @@ class Callback(object):
 
         # put some often used methods and object in the local namespace
         actual_time = 0
+        poll_time = 0
         event_clear = self._event.clear
         event_wait = self._event.wait
         event_is_set = self._event.isSet
@@ -541,6 +605,17 @@ class Callback(object):
         get_timestamp = time
         lock = self._lock
         requests = self._requests
+        tasks = self._tasks
+
+        def schedule(heap, entry):
+            # push ENTRY, with the task in its last position, onto HEAP and add it to TASKS.  must
+            # be called while holding LOCK
+            heappush(heap, entry)
+            scheduled = tasks.get(entry[2])
+            if scheduled is None:
+                tasks[entry[2]] = [entry[3]]
+            else:
+                scheduled.append(entry[3])
 
         self._thread_ident = get_ident()
 
@@ -552,6 +627,11 @@ class Callback(object):
         while 1:
             actual_time = get_timestamp()
 
+            # registered readers are also handled when we are too busy to wait
+            if self._poller and actual_time >= poll_time:
+                poll_time = actual_time + READER_POLL_INTERVAL
+                self._poll(0)
+
             with lock:
                 # check if we should continue to run
                 if self._state != "STATE_RUNNING":
@@ -561,8 +641,11 @@ class Callback(object):
                 while requests and requests[0][0] <= actual_time:
                     # notice that the deadline and priority entries are switched, hence, the entries in
                     # the EXPIRED list are ordered by priority instead of deadline
-                    deadline, priority, root_id, call, callback = heappop(requests)
-                    heappush(expired, (priority, deadline, root_id, None, call, callback))
+                    deadline, priority, root_id, task = heappop(requests)
+                    if task[0] is None:
+                        self._tombstones -= 1
+                    else:
+                        heappush(expired, (priority, deadline, root_id, task))
 
                 if expired:
                     if __debug__ and len(expired) > 10:
@@ -570,7 +653,8 @@ class Callback(object):
                             time_since_expired = actual_time
 
                     # we need to handle the next call in line
-                    priority, deadline, root_id, _, call, callback = heappop(expired)
+                    priority, deadline, root_id, task = heappop(expired)
+                    call, callback = task
                     wait = 0.0
 
                     if __debug__:
@@ -578,8 +662,19 @@ class Callback(object):
 
                     # ignore removed tasks
                     if call is None:
+                        self._tombstones -= 1
                         continue
 
+                    # the task is no longer scheduled
+                    scheduled = tasks[root_id]
+                    if len(scheduled) == 1:
+                        del tasks[root_id]
+                    else:
+                        for index, other in enumerate(scheduled):
+                            if other is task:
+                                del scheduled[index]
+                                break
+
                 else:
                     # there is nothing to handle
                     wait = requests[0][0] - actual_time if requests else 300.0
@@ -596,7 +691,10 @@ class Callback(object):
 
             if wait:
                 if __debug__: dprint("%d wait at most %.3fs before next call, still have %d calls in queue" % (time(), wait, len(requests)))
-                event_wait(wait)
+                if self._poller:
+                    self._poll(wait)
+                else:
+                    event_wait(wait)
 
             else:
                 if __debug__:
@@ -618,7 +716,7 @@ class Callback(object):
 
                         elif callback:
                             with lock:
-                                heappush(expired, (priority, actual_time, root_id, None, (callback[0], (result,) + callback[1], callback[2]), None))
+                                schedule(expired, (priority, actual_time, root_id, [(callback[0], (result,) + callback[1], callback[2]), None]))
 
                     if isinstance(call, GeneratorType):
                         # start next generator iteration
@@ -626,12 +724,12 @@ class Callback(object):
                         assert isinstance(result, float), [type(result), call]
                         assert result >= 0.0, [result, call]
                         with lock:
-                            heappush(requests, (get_timestamp() + result, priority, root_id, call, callback))
+                            schedule(requests, (get_timestamp() + result, priority, root_id, [call, callback]))
 
                 except StopIteration:
                     if callback:
                         with lock:
-                            heappush(expired, (priority, actual_time, root_id, None, (callback[0], (result,) + callback[1], callback[2]), None))
+                            schedule(expired, (priority, actual_time, root_id, [(callback[0], (result,) + callback[1], callback[2]), None]))
 
                 except (SystemExit, KeyboardInterrupt, GeneratorExit, AssertionError), exception:
                     dprint("attempting proper shutdown", exception=True, level="error")
@@ -644,7 +742,7 @@ class Callback(object):
                 except Exception, exception:
                     if callback:
                         with lock:
-                            heappush(expired, (priority, actual_time, root_id, None, (callback[0], (exception,) + callback[1], callback[2]), None))
+                            schedule(expired, (priority, actual_time, root_id, [(callback[0], (exception,) + callback[1], callback[2]), None]))
                     if __debug__:
                         dprint("__debug__ only shutdown", exception=True, level="error")
                         with lock:
@@ -662,8 +760,7 @@ class Callback(object):
                         dprint(round(debug_call_duration, 2), "s call to ", self._debug_call_name, level="warning")
 
         with lock:
-            # allowing us to refuse any new tasks.  _requests_mirror and _expired_mirror will still
-            # allow tasks to be removed
+            # allowing us to refuse any new tasks.  _tasks will still allow tasks to be removed
             self._requests = []
             self._expired = []
 
@@ -671,7 +768,8 @@ class Callback(object):
         # new tasks will not be accepted
         if __debug__: dprint(self._debug_thread_name, "] there are ", len(expired), " expired tasks")
         while expired:
-            _, _, _, _, call, callback = heappop(expired)
+            _, _, _, task = heappop(expired)
+            call, callback = task
             if isinstance(call, TupleType):
                 try:
                     result = call[0](*call[1], **call[2])
@@ -699,7 +797,8 @@ class Callback(object):
         # send GeneratorExit exceptions to scheduled generators
         if __debug__: dprint("there are ", len(requests), " scheduled tasks")
         while requests:
-            _, _, _, call, _ = heappop(requests)
+            _, _, _, task = heappop(requests)
+            call = task[0]
             if isinstance(call, GeneratorType):
                 if __debug__: dprint("raise Shutdown in ", call)
                 try:
@@ -707,12 +806,62 @@ class Callback(object):
                 except:
                     dprint(exception=True, level="error")
 
+        # readers are no longer called
+        with lock:
+            poller, self._poller = self._poller, None
+            self._readers.clear()
+            if poller:
+                poller.close()
+                os.close(self._wakeup_read)
+                os.close(self._wakeup_write)
+                self._wakeup_read = self._wakeup_write = None
+
         # set state to finished
         with lock:
             if __debug__: dprint("STATE_FINISHED")
             self._state = "STATE_FINISHED"
 
 if __debug__:
+    def _performance_test(count=100000):
+        """
+        Register and unregister COUNT timers, both with generated and with string ids, and report the
+        time taken.  The thread is not started, hence only the bookkeeping is measured.
+        """
+        def dummy():
+            pass
+
+        c = Callback()
+
+        begin = time()
+        ids = [c.register(dummy, delay=60.0 + index) for index in xrange(count)]
+        register_duration = time() - begin
+        begin = time()
+        for id_ in ids:
+            c.unregister(id_)
+        unregister_duration = time() - begin
+        dprint("register ", count, " timers in ", round(register_duration, 3), "s, unregister in ", round(unregister_duration, 3), "s", force=1)
+
+        ids = ["timer-%d" % index for index in xrange(count)]
+        begin = time()
+        for index, id_ in enumerate(ids):
+            c.persistent_register(id_, dummy, delay=60.0 + index)
+        register_duration = time() - begin
+        begin = time()
+        for id_ in ids:
+            c.replace_register(id_, dummy, delay=120.0)
+        replace_duration = time() - begin
+        begin = time()
+        for id_ in ids:
+            c.unregister(id_)
+        unregister_duration = time() - begin
+        dprint("persistent_register ", count, " timers in ", round(register_duration, 3), "s, replace_register in ", round(replace_duration, 3), "s, unregister in ", round(unregister_duration, 3), "s", force=1)
+
+        assert not c._tasks
+        assert len(c._requests) + len(c._expired) <= 2 * c._tombstones
+
+        # the atexit handler requires a finished callback
+        c._state = "STATE_FINISHED"
+
     def main():
         c = Callback()
         c.start()
@@ -845,4 +994,8 @@ if __debug__:
         c.stop()
 
     if __name__ == "__main__":
-        main()
+        import sys
+        if "--performance" in sys.argv:
+            _performance_test()
+        else:
+            main()
@@ -1,3 +1,10 @@
+from bisect import bisect_left, insort
+from itertools import count
+from time import time
+from weakref import WeakKeyDictionary
+
+from .requestcache import TimingWheel
+
 if __debug__:
     from .dprint import dprint
     from .member import Member
@@ -33,7 +40,15 @@ assert isinstance(CANDIDATE_STUMBLE_LIFETIME, float)
 assert isinstance(CANDIDATE_INTRO_LIFETIME, float)
 assert isinstance(CANDIDATE_LIFETIME, float)
 
+# obsolete_candidates contains every WalkCandidate, except bootstrap candidates, by the time at
+# which all its communities become obsolete.  Dispersy removes the candidates that expire
+obsolete_candidates = TimingWheel(resolution=5.0)
+
 class Candidate(object):
+    # candidates are kept for every address that we communicate with, __slots__ ensures that they do
+    # not each carry an instance dictionary
+    __slots__ = ["_sock_addr", "_tunnel"]
+
     def __init__(self, sock_addr, tunnel):
         assert is_address(sock_addr), sock_addr
         assert isinstance(tunnel, bool), type(tunnel)
@@ -85,6 +100,9 @@ class WalkCandidate(Candidate):
     - INTRO: we know about this candidate through hearsay.  Viable up to CANDIDATE_INACTIVE seconds
       after the introduction-response message (talking about the candidate) was received.
     """
+    __slots__ = ["_lan_address", "_wan_address", "_connection_type", "_associations", "_timestamps", "_global_times",
+                 "_obsolete_at", "_stumble_until", "_walk_until", "_sync_digests"]
+
     class Timestamps(object):
         __slots__ = ["timeout_adjustment", "last_walk", "last_stumble", "last_intro"]
 
@@ -112,9 +130,28 @@ class WalkCandidate(Candidate):
         self._lan_address = lan_address
         self._wan_address = wan_address
         self._connection_type = connection_type
-        self._associations = set()
         self._timestamps = dict()
-        self._global_times = dict()
+        # _associations and _global_times remain None until the first member is associated or the
+        # first global time is set.  Most candidates that we hear about through introductions never
+        # reach that point
+        self._associations = None
+        self._global_times = None
+
+        # the timestamps of all communities combined, these are updated by _update_lifetime
+        # whenever _timestamps changes.  _obsolete_at is the time at which all communities become
+        # obsolete, _stumble_until and _walk_until are the times at which the last stumble and walk
+        # category expire
+        self._obsolete_at = 0.0
+        self._stumble_until = 0.0
+        self._walk_until = 0.0
+
+        # _sync_digests is True once the candidate told us that it understands bloom filters that
+        # contain packet digests.  until then we send bloom filters that contain the packets
+        self._sync_digests = False
+
+        # a candidate that never obtains any timestamps is removed once CANDIDATE_LIFETIME passed
+        if not isinstance(self, BootstrapCandidate):
+            obsolete_candidates.schedule(self, time() + CANDIDATE_LIFETIME, None, time())
 
         if __debug__:
             if not (self.sock_addr == self._lan_address or self.sock_addr == self._wan_address):
@@ -133,34 +170,65 @@ class WalkCandidate(Candidate):
     def connection_type(self):
         return self._connection_type
 
+    # @property
+    def __get_sync_digests(self):
+        return self._sync_digests
+    # @sync_digests.setter
+    def __set_sync_digests(self, sync_digests):
+        assert isinstance(sync_digests, bool), type(sync_digests)
+        self._sync_digests = sync_digests
+    # .setter was introduced in Python 2.6
+    sync_digests = property(__get_sync_digests, __set_sync_digests)
+
     def get_destination_address(self, wan_address):
         assert is_address(wan_address), wan_address
         return self._lan_address if wan_address[0] == self._wan_address[0] else self._wan_address
 
     def merge(self, other):
         assert isinstance(other, WalkCandidate), other
-        self._associations.update(other._associations)
-        
+        #TODO: this should be improved
+        from .dispersy import Dispersy
+        dispersy = Dispersy.get_instance()
+
+        self._sync_digests = self._sync_digests or other._sync_digests
+
+        if other._associations:
+            if self._associations is None:
+                self._associations = set()
+            self._associations.update(other._associations)
+            for cid, member in other._associations:
+                community = dispersy._communities.get(cid)
+                if community:
+                    community.associate_candidate(self, member)
+
         for cid, timestamps in other._timestamps.iteritems():
+            community = dispersy._communities.get(cid, None)
             if cid in self._timestamps:
                 self._timestamps[cid].merge(timestamps)
+                # the merged timestamps may be more recent than those in the candidate index
+                if community:
+                    community.candidate_index.update(self)
             else:
                 self._timestamps[cid] = timestamps
-                
-                #TODO: this should be improved
-                from .dispersy import Dispersy
-                dispersy = Dispersy.get_instance()
-                community = dispersy._communities.get(cid, None)
-                community.add_candidate(self)
-                
-        for cid, global_time in self._global_times.iteritems():
-            self._global_times[cid] = max(self._global_times.get(cid, 0), global_time)
+                if community:
+                    community.add_candidate(self)
+
+        if other._global_times:
+            if self._global_times is None:
+                self._global_times = {}
+            for cid, global_time in other._global_times.iteritems():
+                self._global_times[cid] = max(self._global_times.get(cid, 0), global_time)
+
+        self._update_lifetime()
         
     def set_global_time(self, community, global_time):
-        self._global_times[community.cid] = max(self._global_times.get(community.cid, 0), global_time)
+        if self._global_times is None:
+            self._global_times = {community.cid:global_time}
+        else:
+            self._global_times[community.cid] = max(self._global_times.get(community.cid, 0), global_time)
 
     def get_global_time(self, community):
-        return self._global_times.get(community.cid, 0)
+        return self._global_times.get(community.cid, 0) if self._global_times else 0
 
     def _get_or_create_timestamps(self, community):
         if __debug__:
@@ -180,7 +248,10 @@ class WalkCandidate(Candidate):
             from .community import Community
         assert isinstance(community, Community)
         assert isinstance(member, Member)
+        if self._associations is None:
+            self._associations = set()
         self._associations.add((community.cid, member))
+        community.associate_candidate(self, member)
 
     def is_associated(self, community, member):
         """
@@ -190,7 +261,7 @@ class WalkCandidate(Candidate):
             from .community import Community
         assert isinstance(community, Community)
         assert isinstance(member, Member)
-        return (community.cid, member) in self._associations
+        return bool(self._associations) and (community.cid, member) in self._associations
 
     def disassociate(self, community, member):
         """
@@ -200,14 +271,19 @@ class WalkCandidate(Candidate):
             from .community import Community
         assert isinstance(community, Community)
         assert isinstance(member, Member)
+        if not self._associations:
+            raise KeyError((community.cid, member))
         self._associations.remove((community.cid, member))
-        if community.cid in self._global_times:
+        community.disassociate_candidate(self, member)
+        if self._global_times and community.cid in self._global_times:
             del self._global_times[community.cid]
 
     def get_members(self, community):
         """
         Returns all unique Member instances in COMMUNITY associated to this candidate.
         """
+        if not self._associations:
+            return set()
         return set(member for cid, member in self._associations if community.cid == cid)
 
     def in_community(self, community, now):
@@ -232,6 +308,20 @@ class WalkCandidate(Candidate):
                     now < timestamps.last_stumble + CANDIDATE_STUMBLE_LIFETIME)
         return False
 
+    def _update_lifetime(self):
+        """
+        Recompute the combined timestamps and reschedule SELF in obsolete_candidates.
+
+        Must be called whenever a timestamp in _timestamps changes.
+        """
+        if self._timestamps:
+            timestamps = self._timestamps.values()
+            self._obsolete_at = max(max(timestamp.last_walk, timestamp.last_stumble, timestamp.last_intro) for timestamp in timestamps) + CANDIDATE_LIFETIME
+            self._stumble_until = max(timestamp.last_stumble for timestamp in timestamps) + CANDIDATE_STUMBLE_LIFETIME
+            self._walk_until = max(timestamp.last_walk for timestamp in timestamps) + CANDIDATE_WALK_LIFETIME
+            if not isinstance(self, BootstrapCandidate):
+                obsolete_candidates.schedule(self, self._obsolete_at, None, time())
+
     def is_any_active(self, now):
         """
         Returns True if SELF is either walk or stumble in any of the associated communities.
@@ -241,7 +331,12 @@ class WalkCandidate(Candidate):
         this rule is when a node decides to leave one or more communities while remaining active in
         one or more others.
         """
-        return any(timestamps.last_walk + timestamps.timeout_adjustment <= now < timestamps.last_walk + CANDIDATE_WALK_LIFETIME or now < timestamps.last_stumble + CANDIDATE_STUMBLE_LIFETIME
+        if now < self._stumble_until:
+            return True
+        if now >= self._walk_until:
+            return False
+        # one of the walk categories may still be active, unless the timeout adjustment applies
+        return any(timestamps.last_walk + timestamps.timeout_adjustment <= now < timestamps.last_walk + CANDIDATE_WALK_LIFETIME
                    for timestamps
                    in self._timestamps.itervalues())
 
@@ -249,9 +344,7 @@ class WalkCandidate(Candidate):
         """
         Returns True if SELF exceeded the CANDIDATE_LIFETIME of all the associated communities.
         """
-        return all(max(timestamps.last_walk, timestamps.last_stumble, timestamps.last_intro) + CANDIDATE_LIFETIME < now
-                   for timestamps
-                   in self._timestamps.itervalues())
+        return not self._timestamps or self._obsolete_at < now
 
     def age(self, now):
         """
@@ -268,6 +361,8 @@ class WalkCandidate(Candidate):
             timestamps.last_walk = now - CANDIDATE_WALK_LIFETIME
             timestamps.last_stumble = now - CANDIDATE_STUMBLE_LIFETIME
             timestamps.last_intro = now - CANDIDATE_INTRO_LIFETIME
+            community.candidate_index.remove(self)
+            self._update_lifetime()
 
     def obsolete(self, community, now):
         """
@@ -278,6 +373,8 @@ class WalkCandidate(Candidate):
             timestamps.last_walk = now - CANDIDATE_LIFETIME
             timestamps.last_stumble = now - CANDIDATE_LIFETIME
             timestamps.last_intro = now - CANDIDATE_LIFETIME
+            community.candidate_index.remove(self)
+            self._update_lifetime()
 
     def all_inactive(self, now):
         """
@@ -292,6 +389,7 @@ class WalkCandidate(Candidate):
             timestamps.last_walk = now - CANDIDATE_WALK_LIFETIME
             timestamps.last_stumble = now - CANDIDATE_STUMBLE_LIFETIME
             timestamps.last_intro = now - CANDIDATE_INTRO_LIFETIME
+        self._update_lifetime()
 
     def is_eligible_for_walk(self, community, now):
         """
@@ -347,6 +445,7 @@ class WalkCandidate(Candidate):
         timestamps = self._get_or_create_timestamps(community)
         timestamps.timeout_adjustment = timeout_adjustment
         timestamps.last_walk = now
+        self._update_lifetime()
         
         if not isinstance(self, BootstrapCandidate):
             community.add_candidate(self)
@@ -362,6 +461,7 @@ class WalkCandidate(Candidate):
         Called when we receive an introduction-request from this candidate.
         """
         self._get_or_create_timestamps(community).last_stumble = now
+        self._update_lifetime()
         
         if not isinstance(self, BootstrapCandidate):
             community.add_candidate(self)
@@ -371,6 +471,7 @@ class WalkCandidate(Candidate):
         Called when we receive an introduction-response introducing this candidate.
         """
         self._get_or_create_timestamps(community).last_intro = now
+        self._update_lifetime()
         
         if not isinstance(self, BootstrapCandidate):
             community.add_candidate(self)
@@ -404,6 +505,8 @@ class WalkCandidate(Candidate):
             return "{%s:%d %s:%d %s:%d}" % (self._sock_addr[0], self._sock_addr[1], self._lan_address[0], self._lan_address[1], self._wan_address[0], self._wan_address[1])
 
 class BootstrapCandidate(WalkCandidate):
+    __slots__ = []
+
     def __init__(self, sock_addr, tunnel):
         super(BootstrapCandidate, self).__init__(sock_addr, tunnel, sock_addr, sock_addr, connection_type=u"public")
 
@@ -432,6 +535,223 @@ class BootstrapCandidate(WalkCandidate):
     def __str__(self):
         return "B!" + super(BootstrapCandidate, self).__str__()
 
+class CandidateTable(object):
+    """
+    A sock_addr:candidate dictionary that remembers the order in which the candidates were added.
+
+    The keys form a doubly linked list, allowing cursors to step through the candidates in O(1).  A
+    cursor that points to a removed candidate continues with the candidate that followed it, hence
+    cursors survive any insertion or removal.
+    """
+    class Cursor(object):
+        __slots__ = ["position", "__weakref__"]
+
+        def __init__(self, position):
+            self.position = position
+
+    # marks both the start and the end of the linked list
+    _sentinel = object()
+
+    def __init__(self):
+        self._candidates = {}
+        # _links contains key:[previous-key, next-key] pairs
+        self._links = {self._sentinel:[self._sentinel, self._sentinel]}
+        # _cursors contains all cursors that are in use
+        self._cursors = WeakKeyDictionary()
+
+    def __len__(self):
+        return len(self._candidates)
+
+    def __contains__(self, key):
+        return key in self._candidates
+
+    def __getitem__(self, key):
+        return self._candidates[key]
+
+    def __setitem__(self, key, candidate):
+        if not key in self._candidates:
+            links = self._links
+            last = links[self._sentinel][0]
+            links[key] = [last, self._sentinel]
+            links[last][1] = key
+            links[self._sentinel][0] = key
+        self._candidates[key] = candidate
+
+    def __delitem__(self, key):
+        del self._candidates[key]
+        links = self._links
+        previous, next_ = links.pop(key)
+        links[previous][1] = next_
+        links[next_][0] = previous
+        for cursor in self._cursors.iterkeys():
+            if cursor.position == key:
+                cursor.position = previous
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def get(self, key, default=None):
+        return self._candidates.get(key, default)
+
+    def pop(self, key, *default):
+        if key in self._candidates:
+            candidate = self._candidates[key]
+            del self[key]
+            return candidate
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def iterkeys(self):
+        links = self._links
+        key = links[self._sentinel][1]
+        while not key is self._sentinel:
+            # get the next key first, allowing KEY to be removed while iterating
+            next_ = links[key][1]
+            yield key
+            key = next_
+
+    def itervalues(self):
+        return (self._candidates[key] for key in self.iterkeys())
+
+    def iteritems(self):
+        return ((key, self._candidates[key]) for key in self.iterkeys())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def cursor(self):
+        """
+        Returns a new cursor positioned before the first candidate.
+        """
+        cursor = self.Cursor(self._sentinel)
+        self._cursors[cursor] = None
+        return cursor
+
+    def next(self, cursor):
+        """
+        Moves CURSOR to the next candidate and returns that candidate, or returns None once, and
+        moves CURSOR before the first candidate, when CURSOR reached the end.
+        """
+        key = cursor.position = self._links[cursor.position][1]
+        if key is self._sentinel:
+            return None
+        return self._candidates[key]
+
+class CandidateIndex(object):
+    """
+    Indexes the WalkCandidate instances of a single community by category.
+
+    For each of the u"walk", u"stumble", and u"intro" categories, a bucket contains the candidates
+    ordered by their last_walk, last_stumble, or last_intro timestamp respectively.  Candidates
+    whose timestamp has exceeded the lifetime of a category are removed from the front of its bucket
+    when the bucket is iterated.
+
+    The buckets only approximate the categories: a candidate in the u"stumble" bucket may currently
+    be in the u"walk" category.  Hence, users must still check get_category and
+    is_eligible_for_walk for the candidates that are yielded.
+    """
+    _lifetimes = {u"walk":CANDIDATE_WALK_LIFETIME,
+                  u"stumble":CANDIDATE_STUMBLE_LIFETIME,
+                  u"intro":CANDIDATE_INTRO_LIFETIME}
+    _attributes = {u"walk":"last_walk",
+                   u"stumble":"last_stumble",
+                   u"intro":"last_intro"}
+
+    def __init__(self, cid):
+        assert isinstance(cid, str), type(cid)
+        assert len(cid) == 20, len(cid)
+        self._cid = cid
+        # each bucket is a sorted list with (timestamp, sequence, candidate) entries.  the unique
+        # sequence number ensures that candidates are never compared
+        self._buckets = dict((category, []) for category in self._lifetimes)
+        # each keys dictionary contains candidate:(timestamp, sequence) pairs for the entries in the
+        # bucket of the same category
+        self._keys = dict((category, {}) for category in self._lifetimes)
+        self._sequence = count()
+
+    def __len__(self):
+        return len(self._buckets[u"walk"]) + len(self._buckets[u"stumble"]) + len(self._buckets[u"intro"])
+
+    def length(self, category):
+        """
+        Returns the number of candidates in the CATEGORY bucket, including those that expired.
+        """
+        return len(self._buckets[category])
+
+    def update(self, candidate):
+        """
+        Add CANDIDATE to, or move CANDIDATE within, the buckets according to its current timestamps.
+        """
+        assert isinstance(candidate, WalkCandidate), type(candidate)
+        timestamps = candidate._timestamps.get(self._cid)
+        if timestamps is None:
+            self.remove(candidate)
+            return
+
+        for category, attribute in self._attributes.iteritems():
+            timestamp = getattr(timestamps, attribute)
+            keys = self._keys[category]
+            key = keys.get(candidate)
+            if key is None or key[0] != timestamp:
+                bucket = self._buckets[category]
+                if key:
+                    del bucket[bisect_left(bucket, key)]
+                key = keys[candidate] = (timestamp, self._sequence.next())
+                insort(bucket, (timestamp, key[1], candidate))
+
+    def remove(self, candidate):
+        """
+        Remove CANDIDATE from all buckets.
+        """
+        for category, keys in self._keys.iteritems():
+            key = keys.pop(candidate, None)
+            if key:
+                bucket = self._buckets[category]
+                del bucket[bisect_left(bucket, key)]
+
+    def iter_category(self, category, now, maximum=None):
+        """
+        Yields the candidates in the CATEGORY bucket that have not yet exceeded the lifetime of
+        CATEGORY at time NOW, least recent first.  When MAXIMUM is given, only candidates whose
+        timestamp is at most MAXIMUM are yielded.
+
+        The bucket may be modified between iterations, i.e. the yielded candidate may be walked.
+        """
+        bucket = self._buckets[category]
+        keys = self._keys[category]
+        attribute = self._attributes[category]
+
+        # remove all candidates that exceeded the lifetime
+        cutoff = bisect_left(bucket, (now - self._lifetimes[category],))
+        if cutoff:
+            for _, _, candidate in bucket[:cutoff]:
+                del keys[candidate]
+            del bucket[:cutoff]
+
+        index = 0
+        while index < len(bucket):
+            timestamp, sequence, candidate = bucket[index]
+            if maximum is not None and timestamp > maximum:
+                break
+
+            timestamps = candidate._timestamps.get(self._cid)
+            if timestamps is None or getattr(timestamps, attribute) != timestamp:
+                # the timestamps changed without updating the index (i.e. merge or all_inactive)
+                self.update(candidate)
+
+            else:
+                yield candidate
+
+            # continue after the yielded entry, even when the bucket has been modified in the
+            # meantime
+            index = bisect_left(bucket, (timestamp, sequence + 1))
+
 class LoopbackCandidate(Candidate):
+    __slots__ = []
+
     def __init__(self):
         super(LoopbackCandidate, self).__init__(("localhost", 0), False)
@@ -14,13 +14,7 @@ from math import ceil
 from random import random, Random, randint, shuffle
 from time import time
 
-try:
-    # python 2.7 only...
-    from collections import OrderedDict
-except ImportError:
-    from .python27_ordereddict import OrderedDict
-
-from .bloomfilter import BloomFilter
+from .bloomfilter import ByteArrayBloomFilter
 from .conversion import BinaryConversion, DefaultConversion
 from .crypto import ec_generate_key, ec_to_public_bin, ec_to_private_bin
 from .decorator import documentation, runtime_duration_warning
@@ -31,8 +25,10 @@ from .member import DummyMember, Member, MemberFromId
 from .resolution import PublicResolution, LinearResolution, DynamicResolution
 from .revision import update_revision_information
 from .statistics import CommunityStatistics
+from .synchistory import LastSyncHistory
+from .syncindex import SyncIndex, SyncKeyFilter
 from .timeline import Timeline
-from .candidate import WalkCandidate
+from .candidate import WalkCandidate, CandidateIndex, CandidateTable, CANDIDATE_ELIGIBLE_DELAY
 
 # update version information directly from SVN
 update_revision_information("$HeadURL$", "$Revision$")
@@ -47,6 +43,9 @@ class SyncCache(object):
         self.times_used = 0
         self.responses_received = 0
         self.candidate = None
+        # the same range with a bloom filter that contains the packets instead of their digests.  it
+        # is created when the range is first sent to a peer that does not understand digests
+        self.packet_bloom_filter = None
 
 class Community(object):
     @classmethod
@@ -279,6 +278,7 @@ class Community(object):
             self.meta_message_cache[name] = {"id":database_id, "cluster":cluster, "priority":priority, "direction":direction}
         # define all available messages
         self._meta_messages = {}
+        self._sync_response_sql = None
         self._initialize_meta_messages()
         # cleanup pre-fetched values
         self.meta_message_cache = None
@@ -302,8 +302,11 @@ class Community(object):
 
         # sync range bloom filters
         self._sync_cache = None
+        self._sync_index = SyncIndex(self)
+        self._last_sync_history = LastSyncHistory(self)
+        self._sync_key_filter = SyncKeyFilter(self)
         if __debug__:
-            b = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate)
+            b = ByteArrayBloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate)
             dprint("sync bloom:    size: ", int(ceil(b.size // 8)), ";  capacity: ", b.get_capacity(self.dispersy_sync_bloom_filter_error_rate), ";  error-rate: ", self.dispersy_sync_bloom_filter_error_rate)
 
         # initial timeline.  the timeline will keep track of member permissions
@@ -315,7 +318,11 @@ class Community(object):
         self._nrsyncpackets = 0
         
         #Initialize all the candidate iterators
-        self._candidates = OrderedDict()
+        self._candidates = CandidateTable()
+        self._candidate_index = CandidateIndex(self._cid)
+        # _member_candidates contains Member:set([WalkCandidate]) pairs for the candidates in
+        # self._candidates that are associated to a member in this community
+        self._member_candidates = {}
         self._walked_candidates = self._iter_category(u'walk')
         self._stumbled_candidates = self._iter_category(u'stumble')
         self._introduced_candidates = self._iter_category(u'intro')
@@ -379,6 +386,9 @@ class Community(object):
             assert meta_message.name not in self._meta_messages
             self._meta_messages[meta_message.name] = meta_message
 
+        # the sync response sql depends on the meta messages
+        self._sync_response_sql = None
+
         if __debug__:
             sync_interval = 5.0
             for meta_message in self._meta_messages.itervalues():
@@ -549,7 +559,9 @@ class Community(object):
                         cached += 1
 
                     # update cached bloomfilter to avoid duplicates
-                    cache.bloom_filter.add(message.packet)
+                    cache.bloom_filter.add(message.packet_digest)
+                    if cache.packet_bloom_filter:
+                        cache.packet_bloom_filter.add(message.packet)
 
                     # if this message was received from the candidate we send the bloomfilter too, increment responses
                     if (cache.candidate and message.candidate and cache.candidate.sock_addr == message.candidate.sock_addr):
@@ -573,10 +585,11 @@ class Community(object):
             cache.responses_received = 0
             cache.candidate = request_cache.helper_candidate
 
-            if __debug__: dprint(self._cid.encode("HEX"), " reuse #", cache.times_used, " (packets received: ", cache.responses_received, "; ", hex(cache.bloom_filter._filter), ")")
+            if __debug__: dprint(self._cid.encode("HEX"), " reuse #", cache.times_used, " (packets received: ", cache.responses_received, "; ", cache.bloom_filter.bytes.encode("HEX")[:32], ")")
             return cache.time_low, cache.time_high, cache.modulo, cache.offset, cache.bloom_filter
 
         sync = self.dispersy_sync_bloom_filter_strategy()
+
         if sync:
             self._sync_cache = SyncCache(*sync)
             self._sync_cache.candidate = request_cache.helper_candidate
@@ -586,9 +599,39 @@ class Community(object):
 
         return sync
 
+    def dispersy_claim_packet_sync_bloom_filter(self, sync):
+        """
+        Returns SYNC with a bloom filter that contains the packets instead of their digests.
+
+        Older peers do not understand bloom filters that contain packet digests.  The packets in the
+        range of SYNC are read from the database, the result is cached for as long as SYNC is the
+        cached sync range.
+        """
+        time_low, time_high, modulo, offset, bloom_filter = sync
+        cache = self._sync_cache
+        if cache and cache.bloom_filter is bloom_filter:
+            if cache.packet_bloom_filter is None:
+                cache.packet_bloom_filter = self._create_packet_sync_bloom_filter(sync)
+            packet_bloom_filter = cache.packet_bloom_filter
+        else:
+            packet_bloom_filter = self._create_packet_sync_bloom_filter(sync)
+        return (time_low, time_high, modulo, offset, packet_bloom_filter)
+
+    def _create_packet_sync_bloom_filter(self, sync):
+        time_low, time_high, modulo, offset, bloom_filter = sync
+        if time_high == 0:
+            time_high = self.global_time
+        packet_bloom_filter = ByteArrayBloomFilter("\x00" * (bloom_filter.size / 8), bloom_filter.functions, prefix=bloom_filter.prefix)
+        packet_bloom_filter.add_keys(str(packet) for packet, in self._dispersy.database.execute(u"""SELECT sync.packet
+FROM sync
+JOIN meta_message ON meta_message.id = sync.meta_message
+WHERE sync.community = ? AND meta_message.priority > 32 AND sync.undone = 0 AND sync.global_time BETWEEN ? AND ? AND (sync.global_time + ?) % ? = 0""",
+                                                                                                (self._database_id, time_low, min(time_high, 2**63-1), offset, modulo)))
+        return packet_bloom_filter
+
     @runtime_duration_warning(0.5)
     def dispersy_claim_sync_bloom_filter_simple(self):
-        bloom = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
+        bloom = ByteArrayBloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
         capacity = bloom.get_capacity(self.dispersy_sync_bloom_filter_error_rate)
         global_time = self.global_time
 
@@ -614,7 +657,7 @@ class Community(object):
         else:
             db_high = time_high
 
-        bloom.add_keys(str(packet) for packet, in self._dispersy.database.execute(u"SELECT sync.packet FROM sync JOIN meta_message ON meta_message.id = sync.meta_message WHERE sync.community = ? AND meta_message.priority > 32 AND NOT sync.undone AND global_time BETWEEN ? AND ?", (self._database_id, time_low, db_high)))
+        bloom.add_keys(self._sync_index.iter_range(time_low, db_high))
 
         if __debug__:
             import sys
@@ -624,7 +667,7 @@ class Community(object):
     #choose a pivot, add all items capacity to the right. If too small, add items left of pivot
     @runtime_duration_warning(0.5)
     def dispersy_claim_sync_bloom_filter_right(self):
-        bloom = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
+        bloom = ByteArrayBloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
         capacity = bloom.get_capacity(self.dispersy_sync_bloom_filter_error_rate)
 
         desired_mean = self.global_time / 2.0
@@ -668,17 +711,17 @@ class Community(object):
                 time_low = 1
                 time_high = self.acceptable_global_time
 
-            bloom.add_keys(str(packet) for _, packet in data)
+            bloom.add_keys((digest for _, digest in data))
 
             #print >> sys.stderr, "Syncing %d-%d, nr_packets = %d, capacity = %d, packets %d-%d"%(time_low, time_high, len(data), capacity, data[0][0], data[-1][0])
 
             return (time_low, time_high, 1, 0, bloom)
-        return (1, self.acceptable_global_time, 1, 0, BloomFilter(8, 0.1, prefix='\x00'))
+        return (1, self.acceptable_global_time, 1, 0, ByteArrayBloomFilter(8, 0.1, prefix='\x00'))
 
     #instead of pivot + capacity, divide capacity to have 50/50 divivion around pivot
     @runtime_duration_warning(0.5)
     def dispersy_claim_sync_bloom_filter_50_50(self):
-        bloom = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
+        bloom = ByteArrayBloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
         capacity = bloom.get_capacity(self.dispersy_sync_bloom_filter_error_rate)
 
         desired_mean = self.global_time / 2.0
@@ -737,12 +780,12 @@ class Community(object):
                 time_low = 1
                 time_high = self.acceptable_global_time
 
-            bloom.add_keys(str(packet) for _, packet in data)
+            bloom.add_keys((digest for _, digest in data))
 
             #print >> sys.stderr, "Syncing %d-%d, nr_packets = %d, capacity = %d, packets %d-%d"%(time_low, time_high, len(data), capacity, data[0][0], data[-1][0])
 
             return (time_low, time_high, 1, 0, bloom)
-        return (1, self.acceptable_global_time, 1, 0, BloomFilter(8, 0.1, prefix='\x00'))
+        return (1, self.acceptable_global_time, 1, 0, ByteArrayBloomFilter(8, 0.1, prefix='\x00'))
 
     #instead of pivot + capacity, compare pivot - capacity and pivot + capacity to see which globaltime range is largest
     @runtime_duration_warning(0.5)
@@ -750,13 +793,12 @@ class Community(object):
         if __debug__:
             t1 = time()
 
-        syncable_messages = u", ".join(unicode(meta.database_id) for meta in self._meta_messages.itervalues() if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32)
-        if syncable_messages:
+        if self._sync_index.has_syncable_messages:
             if __debug__:
                 t2 = time()
 
             acceptable_global_time = self.acceptable_global_time
-            bloom = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
+            bloom = ByteArrayBloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
             capacity = bloom.get_capacity(self.dispersy_sync_bloom_filter_error_rate)
 
             desired_mean = self.global_time / 2.0
@@ -767,12 +809,12 @@ class Community(object):
 
             if from_gbtime > 1 and self._nrsyncpackets >= capacity:
                 #use from_gbtime -1/+1 to include from_gbtime
-                right, rightdata = self._select_bloomfilter_range(syncable_messages, from_gbtime -1, capacity, True)
+                right, rightdata = self._select_bloomfilter_range(from_gbtime -1, capacity, True)
 
                 #if right did not get to capacity, then we have less than capacity items in the database
                 #skip left
                 if right[2] == capacity:
-                    left, leftdata = self._select_bloomfilter_range(syncable_messages, from_gbtime + 1, capacity, False)
+                    left, leftdata = self._select_bloomfilter_range(from_gbtime + 1, capacity, False)
                     left_range = (left[1] or self.global_time) - left[0]
                     right_range = (right[1] or self.global_time) - right[0]
 
@@ -797,7 +839,7 @@ class Community(object):
 
                 bloomfilter_range = [1, acceptable_global_time]
 
-                data, fixed = self._select_and_fix(syncable_messages, 0, capacity, True)
+                data, fixed = self._select_and_fix(0, capacity, True)
                 if len(data) > 0 and fixed:
                     bloomfilter_range[1] = data[-1][0]
                     self._nrsyncpackets = capacity + 1
@@ -806,7 +848,7 @@ class Community(object):
                 t4 = time()
 
             if len(data) > 0:
-                bloom.add_keys(str(packet) for _, packet in data)
+                bloom.add_keys((digest for _, digest in data))
 
                 if __debug__:
                     dprint(self.cid.encode("HEX"), " syncing %d-%d, nr_packets = %d, capacity = %d, packets %d-%d, pivot = %d"%(bloomfilter_range[0], bloomfilter_range[1], len(data), capacity, data[0][0], data[-1][0], from_gbtime))
@@ -819,27 +861,24 @@ class Community(object):
 
         elif __debug__:
             dprint(self.cid.encode("HEX"), " NOT syncing no syncable messages")
-        return (1, acceptable_global_time, 1, 0, BloomFilter(8, 0.1, prefix='\x00'))
+        return (1, acceptable_global_time, 1, 0, ByteArrayBloomFilter(8, 0.1, prefix='\x00'))
 
     #instead of pivot + capacity, compare pivot - capacity and pivot + capacity to see which globaltime range is largest
     @runtime_duration_warning(0.5)
     def _dispersy_claim_sync_bloom_filter_modulo(self):
-        syncable_messages = u", ".join(unicode(meta.database_id) for meta in self._meta_messages.itervalues() if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32)
-        if syncable_messages:
-            bloom = BloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
+        if self._sync_index.has_syncable_messages:
+            bloom = ByteArrayBloomFilter(self.dispersy_sync_bloom_filter_bits, self.dispersy_sync_bloom_filter_error_rate, prefix=chr(int(random() * 256)))
             capacity = bloom.get_capacity(self.dispersy_sync_bloom_filter_error_rate)
 
-            self._nrsyncpackets = list(self._dispersy.database.execute(u"SELECT count(*) FROM sync WHERE meta_message IN (%s) AND undone = 0 LIMIT 1" % (syncable_messages)))[0][0]
+            self._nrsyncpackets = len(self._sync_index)
             modulo = int(ceil(self._nrsyncpackets / float(capacity)))
             if modulo > 1:
                 offset = randint(0, modulo-1)
-                packets = list(str(packet) for packet, in self._dispersy.database.execute(u"SELECT sync.packet FROM sync WHERE meta_message IN (%s) AND sync.undone = 0 AND (sync.global_time + ?) %% ? = 0" % syncable_messages, (offset, modulo)))
             else:
                 offset = 0
                 modulo = 1
-                packets = list(str(packet) for packet, in self._dispersy.database.execute(u"SELECT sync.packet FROM sync WHERE meta_message IN (%s) AND sync.undone = 0" % syncable_messages))
-            
-            bloom.add_keys(packets)
+
+            bloom.add_keys(self._sync_index.iter_modulo(modulo, offset))
 
             if __debug__:
                 dprint(self.cid.encode("HEX"), " syncing %d-%d, nr_packets = %d, capacity = %d, totalnr = %d"%(modulo, offset, self._nrsyncpackets, capacity, self._nrsyncpackets))
@@ -848,16 +887,12 @@ class Community(object):
 
         elif __debug__:
             dprint(self.cid.encode("HEX"), " NOT syncing no syncable messages")
-        return (1, self.acceptable_global_time, 1, 0, BloomFilter(8, 0.1, prefix='\x00'))
+        return (1, self.acceptable_global_time, 1, 0, ByteArrayBloomFilter(8, 0.1, prefix='\x00'))
 
-    def _select_and_fix(self, syncable_messages, global_time, to_select, higher = True):
-        assert isinstance(syncable_messages, unicode)
-        if higher:
-            data = list(self._dispersy.database.execute(u"SELECT global_time, packet FROM sync WHERE meta_message IN (%s) AND undone = 0 AND global_time > ? ORDER BY global_time ASC LIMIT ?" % (syncable_messages),
-                                                    (global_time, to_select + 1)))
-        else:
-            data = list(self._dispersy.database.execute(u"SELECT global_time, packet FROM sync WHERE meta_message IN (%s) AND undone = 0 AND global_time < ? ORDER BY global_time DESC LIMIT ?" % (syncable_messages),
-                                                    (global_time, to_select + 1)))
+    def _select_and_fix(self, global_time, to_select, higher = True):
+        # the sync index returns the digests in the same order as the ORDER BY global_time ASC/DESC
+        # queries did, without touching the database
+        data = self._sync_index.select(global_time, to_select + 1, higher)
 
         fixed = False
         if len(data) > to_select:
@@ -874,8 +909,8 @@ class Community(object):
 
         return data, fixed
 
-    def _select_bloomfilter_range(self, syncable_messages, global_time, to_select, higher = True):
-        data, fixed = self._select_and_fix(syncable_messages, global_time, to_select, higher)
+    def _select_bloomfilter_range(self, global_time, to_select, higher = True):
+        data, fixed = self._select_and_fix(global_time, to_select, higher)
 
         lowerfixed = True
         higherfixed = True
@@ -886,10 +921,10 @@ class Community(object):
             to_select = to_select - len(data)
             if to_select > 25:
                 if higher:
-                    lowerdata, lowerfixed = self._select_and_fix(syncable_messages, global_time + 1, to_select, False)
+                    lowerdata, lowerfixed = self._select_and_fix(global_time + 1, to_select, False)
                     data = lowerdata + data
                 else:
-                    higherdata, higherfixed = self._select_and_fix(syncable_messages, global_time - 1, to_select, True)
+                    higherdata, higherfixed = self._select_and_fix(global_time - 1, to_select, True)
                     data = data + higherdata
 
         bloomfilter_range = [data[0][0], data[-1][0], len(data)]
@@ -1064,6 +1099,30 @@ class Community(object):
         """
         return self._timeline
 
+    @property
+    def sync_index(self):
+        """
+        The SyncIndex instance.
+        @rtype: SyncIndex
+        """
+        return self._sync_index
+
+    @property
+    def sync_key_filter(self):
+        """
+        The SyncKeyFilter instance.
+        @rtype: SyncKeyFilter
+        """
+        return self._sync_key_filter
+
+    @property
+    def last_sync_history(self):
+        """
+        The LastSyncHistory instance.
+        @rtype: LastSyncHistory
+        """
+        return self._last_sync_history
+
     @property
     def global_time(self):
         """
@@ -1284,73 +1343,62 @@ class Community(object):
         return self._dispersy.create_introduction_request(self, candidate, allow_sync)
 
     def dispersy_on_dynamic_settings(self, messages, initializing=False):
+        # the policies of the meta messages may change
+        self._sync_response_sql = None
         return self._dispersy.on_dynamic_settings(self, messages, initializing)
 
+    @property
+    def candidate_index(self):
+        """
+        The CandidateIndex with the candidates in self._candidates by category.
+        """
+        return self._candidate_index
+
+    def _iter_indexed_candidates(self, categories, now):
+        """
+        Yields the unique candidates in the CATEGORIES buckets of the candidate index.
+        """
+        seen = set()
+        for category in categories:
+            for candidate in self._candidate_index.iter_category(category, now):
+                if not candidate in seen:
+                    seen.add(candidate)
+                    yield candidate
+
     def dispersy_yield_candidates(self):
         """
         Yields all active candidates that are part of COMMUNITY.
         """
         now = time()
-        return (candidate for candidate in self._candidates.itervalues() if candidate.in_community(self, now) and candidate.is_any_active(now))
+        return (candidate for candidate in self._iter_indexed_candidates((u"walk", u"stumble", u"intro"), now) if candidate.in_community(self, now) and candidate.is_any_active(now))
 
     def _iter_category(self, category):
-        while True:
-            no_result = True
-            
-            keys = self._candidates.keys()
-            key_index = 0
-            key_value = None
-
-            while True:
-                try:
-                    key_value = keys[key_index]
-                    candidate = self._candidates[key_value]
-                    
-                    if candidate.in_community(self, time()) and candidate.is_any_active(time()) and category == candidate.get_category(self, time()):
-                        no_result = False
-                        yield candidate
-                        
-                        keys = self._candidates.keys()
-                        if key_value in keys:
-                            key_index = keys.index(key_value)
-                        
-                    key_index += 1
-                        
-                except IndexError:
-                    break
-            
-            if no_result:
-                yield None
-                
+        return self._iter_categories((category,))
+
     def _iter_categories(self, categories, once = False):
+        """
+        Yields the candidates in CATEGORIES in round robin fashion, in the order that they were
+        added.  None is yielded after every round that did not yield any candidate.
+
+        The cursor survives candidates being added or removed between iterations.
+        """
+        cursor = self._candidates.cursor()
+        next_candidate = self._candidates.next
         while True:
             no_result = True
 
-            keys = self._candidates.keys()
-            key_index = 0
-            key_value = None
-            
-            while True:
-                try:
-                    key_value = keys[key_index]
-                    candidate = self._candidates[key_value]
-                    
-                    if candidate.in_community(self, time()) and candidate.is_any_active(time()) and candidate.get_category(self, time()) in categories:
-                        no_result = False
-                        yield candidate
-                        
-                        keys = self._candidates.keys()
-                        if key_value in keys:
-                            key_index = keys.index(key_value)
-                        
-                    key_index += 1
-                        
-                except IndexError:
-                    break
-                    
+            candidate = next_candidate(cursor)
+            while candidate:
+                now = time()
+                if candidate.in_community(self, now) and candidate.is_any_active(now) and candidate.get_category(self, now) in categories:
+                    no_result = False
+                    yield candidate
+
+                candidate = next_candidate(cursor)
+
             if no_result:
                 yield None
-            
+
             if once:
                 break
                 
@@ -1386,7 +1434,7 @@ class Community(object):
         """
         assert all(not sock_address in self._candidates for sock_address in self._dispersy._bootstrap_candidates.iterkeys()), "none of the bootstrap candidates may be in self._candidates"
         now = time()
-        candidates = [candidate for candidate in self._candidates.itervalues() if candidate.is_any_active(now) and candidate.get_category(self, now) in (u"walk", u"stumble")]
+        candidates = [candidate for candidate in self._iter_indexed_candidates((u"walk", u"stumble"), now) if candidate.is_any_active(now) and candidate.get_category(self, now) in (u"walk", u"stumble")]
         shuffle(candidates)
         return iter(candidates)
 
@@ -1426,44 +1474,55 @@ class Community(object):
         # bootstrap peers can not be visited multiple times within 55 seconds.  this is handled by
         # the Candidate.is_eligible_for_walk(...) method
         
+        # the candidate index orders each category by its timestamp, hence every step only needs
+        # to find the next eligible candidate instead of sorting all candidates
         now = time()
-        categories = {u"walk":[], u"stumble":[], u"intro":[], u"none":[]}
-        for candidate in self._candidates.itervalues():
-            if candidate.is_eligible_for_walk(self, now):
-                categories[candidate.get_category(self, now)].append(candidate)
+        index = self._candidate_index
+
+        def iter_eligible(category, maximum=None):
+            for candidate in index.iter_category(category, now, maximum):
+                if candidate.is_eligible_for_walk(self, now) and candidate.get_category(self, now) == category:
+                    yield candidate
 
-        walks = sorted(categories[u"walk"], key=lambda candidate: candidate.last_walk(self))
-        stumbles = sorted(categories[u"stumble"], key=lambda candidate: candidate.last_stumble(self))
-        intros = sorted(categories[u"intro"], key=lambda candidate: candidate.last_intro(self))
+        # only candidates that were walked at least CANDIDATE_ELIGIBLE_DELAY ago are eligible
+        walks = iter_eligible(u"walk", now - CANDIDATE_ELIGIBLE_DELAY)
+        stumbles = iter_eligible(u"stumble")
+        intros = iter_eligible(u"intro")
+        walk = next(walks, None)
+        stumble = next(stumbles, None)
+        intro = next(intros, None)
 
-        while walks or stumbles or intros:
+        while walk or stumble or intro:
             r = random()
 
             # 13/02/12 Boudewijn: we decrease the 1% chance to contact a bootstrap peer to .5%
             if r <= .4975: # ~50%
-                if walks:
-                    if __debug__: dprint("yield [%2d:%2d:%2d walk   ] " % (len(walks), len(stumbles), len(intros)), walks[0])
-                    yield walks.pop(0)
+                if walk:
+                    if __debug__: dprint("yield [%2d:%2d:%2d walk   ] " % (index.length(u"walk"), index.length(u"stumble"), index.length(u"intro")), walk)
+                    yield walk
+                    walk = next(walks, None)
 
             elif r <= .995: # ~50%
-                if stumbles or intros:
+                if stumble or intro:
                     while True:
                         if random() <= .5:
-                            if stumbles:
-                                if __debug__: dprint("yield [%2d:%2d:%2d stumble] " % (len(walks), len(stumbles), len(intros)), stumbles[0])
-                                yield stumbles.pop(0)
+                            if stumble:
+                                if __debug__: dprint("yield [%2d:%2d:%2d stumble] " % (index.length(u"walk"), index.length(u"stumble"), index.length(u"intro")), stumble)
+                                yield stumble
+                                stumble = next(stumbles, None)
                                 break
 
                         else:
-                            if intros:
-                                if __debug__: dprint("yield [%2d:%2d:%2d intro  ] " % (len(walks), len(stumbles), len(intros)), intros[0])
-                                yield intros.pop(0)
+                            if intro:
+                                if __debug__: dprint("yield [%2d:%2d:%2d intro  ] " % (index.length(u"walk"), index.length(u"stumble"), index.length(u"intro")), intro)
+                                yield intro
+                                intro = next(intros, None)
                                 break
 
             else: # ~.5%
                 candidate = self._bootstrap_candidates.next()
                 if candidate:
-                    if __debug__: dprint("yield [%2d:%2d:%2d bootstr] " % (len(walks), len(stumbles), len(intros)), candidate)
+                    if __debug__: dprint("yield [%2d:%2d:%2d bootstr] " % (index.length(u"walk"), index.length(u"stumble"), index.length(u"intro")), candidate)
                     yield candidate
         
         bootstrap_candidates = list(self._iter_bootstrap(once = True))
@@ -1471,7 +1530,7 @@ class Community(object):
         
         for candidate in bootstrap_candidates:
             if candidate:
-                if __debug__: dprint("yield [%2d:%2d:%2d bootstr] " % (len(walks), len(stumbles), len(intros)), candidate)
+                if __debug__: dprint("yield [%2d:%2d:%2d bootstr] " % (index.length(u"walk"), index.length(u"stumble"), index.length(u"intro")), candidate)
             yield candidate
             
         if __debug__: dprint("no candidates or bootstrap candidates available")
@@ -1498,15 +1557,84 @@ class Community(object):
             if len(candidate._timestamps) > 1:
                 self._dispersy.statistics.total_candidates_overlapped += 1
                 self._dispersy.statistics.dict_inc(self._dispersy.statistics.overlapping_stumble_candidates, str(self))
-    
+
+            self.index_associations(candidate)
+
+        # walk, stumble, and intro call add_candidate after changing the timestamps
+        self._candidate_index.update(candidate)
+
+    def remove_candidate(self, sock_addr):
+        """
+        Removes the candidate at SOCK_ADDR from this community, if it is there.
+        """
+        candidate = self._candidates.pop(sock_addr, None)
+        if candidate:
+            self._candidate_index.remove(candidate)
+            for member in candidate.get_members(self):
+                self.disassociate_candidate(candidate, member)
+
+    def index_associations(self, candidate):
+        """
+        Adds the members associated to CANDIDATE, which must be in self._candidates, to the member
+        index.
+        """
+        for member in candidate.get_members(self):
+            self.associate_candidate(candidate, member)
+
+    def associate_candidate(self, candidate, member):
+        """
+        Called by WalkCandidate.associate to add the CANDIDATE, MEMBER pair to the member index.
+
+        Candidates that are not in self._candidates are indexed once they are added.
+        """
+        if self._candidates.get(candidate.sock_addr) is candidate:
+            candidates = self._member_candidates.get(member)
+            if candidates is None:
+                self._member_candidates[member] = set([candidate])
+            else:
+                candidates.add(candidate)
+
+    def disassociate_candidate(self, candidate, member):
+        """
+        Called by WalkCandidate.disassociate to remove the CANDIDATE, MEMBER pair from the member
+        index.
+        """
+        candidates = self._member_candidates.get(member)
+        if candidates:
+            candidates.discard(candidate)
+            if not candidates:
+                del self._member_candidates[member]
+
+    def get_member_candidates(self, member):
+        """
+        Returns the candidates in self._candidates that are associated to MEMBER, in no particular
+        order.
+
+        Candidates that are associated to MEMBER but are not in self._candidates, i.e. candidates
+        that are only known in other communities, are not returned.
+        """
+        return self._member_candidates.get(member, ())
+
     def get_candidate_mid(self, mid):
+        """
+        Returns the first candidate in self._candidates that is associated to the member with MID,
+        or None.
+        """
         try:
             member = MemberFromId(mid)
+        except LookupError:
+            return None
+
+        candidates = self.get_member_candidates(member)
+        if len(candidates) == 1:
+            for candidate in candidates:
+                return candidate
+
+        elif candidates:
+            # keep the insertion order of self._candidates when multiple candidates are associated
             for candidate in self._candidates.itervalues():
-                if candidate.is_associated(self, member):
+                if candidate in candidates:
                     return candidate
-        except LookupError:
-            pass
 
     def dispersy_cleanup_community(self, message):
         """
@@ -1587,6 +1715,42 @@ class Community(object):
         """
         return self._meta_messages.values()
 
+    def get_sync_response_sql(self):
+        """
+        Returns the SQL statements that select the sync response candidates.
+
+        Returns a (sql, digest_sql, count) tuple.  SQL selects the packets, DIGEST_SQL selects the
+        (digest, id) pairs, and COUNT is the number of sub selects, i.e. the four bindings (time_low,
+        time_high, offset, modulo) must be repeated COUNT times.
+
+        The statements are created once and are cached until the meta messages change.  Using the
+        same statements also allows the database to reuse its prepared statements.
+
+        @rtype: (unicode, unicode, int)
+        """
+        if self._sync_response_sql is None:
+            # obtain all available messages for this community
+            meta_messages = [(meta.distribution.priority, -meta.distribution.synchronization_direction_value, meta) for meta in self._meta_messages.itervalues() if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32]
+            meta_messages.sort(reverse = True)
+
+            sub_selects = []
+            digest_sub_selects = []
+            for _, _, meta in meta_messages:
+                sub_selects.append(u"""SELECT * FROM (SELECT sync.packet FROM sync
+WHERE sync.meta_message = %d AND sync.undone = 0 AND sync.global_time BETWEEN ? AND ? AND (sync.global_time + ?) %% ? = 0
+ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchronization_direction))
+                digest_sub_selects.append(u"""SELECT * FROM (SELECT sync.digest, sync.id FROM sync
+WHERE sync.meta_message = %d AND sync.undone = 0 AND sync.global_time BETWEEN ? AND ? AND (sync.global_time + ?) %% ? = 0
+ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchronization_direction))
+
+            sql = u"SELECT * FROM (" + u" UNION ALL ".join(sub_selects) + u")"
+            digest_sql = u"SELECT * FROM (" + u" UNION ALL ".join(digest_sub_selects) + u")"
+            if __debug__: dprint(sql)
+
+            self._sync_response_sql = (sql, digest_sql, len(sub_selects))
+
+        return self._sync_response_sql
+
     def initiate_meta_messages(self):
         """
         Create the meta messages for one community instance.
@@ -5,7 +5,7 @@ from struct import pack, unpack_from, Struct
 from random import choice
 
 from .authentication import NoAuthentication, MemberAuthentication, DoubleMemberAuthentication
-from .bloomfilter import BloomFilter
+from .bloomfilter import ByteArrayBloomFilter
 from .crypto import ec_check_public_bin
 from .destination import MemberDestination, CommunityDestination, CandidateDestination
 from .dispersydatabase import DispersyDatabase
@@ -191,7 +191,13 @@ class BinaryConversion(Conversion):
         # reserve 3rd bit for enable/disable tunnel (02/05/12)
         self._encode_tunnel_map = {True:int("100", 2), False:int("000", 2)}
         self._decode_tunnel_map = dict((value, key) for key, value in self._encode_tunnel_map.iteritems())
-        # 4th, 5th and 6th bits are currently unused
+        # reserve 4th bit for digest keyed bloom filters.  in the introduction-request it is set when
+        # the bloom filter contains packet digests, in the introduction-response it is set when the
+        # sender understands such bloom filters.  older peers ignore this bit, hence we only send
+        # digest keyed bloom filters to peers that set it
+        self._encode_digest_map = {True:int("1000", 2), False:int("0000", 2)}
+        self._decode_digest_map = dict((value, key) for key, value in self._encode_digest_map.iteritems())
+        # 5th and 6th bits are currently unused
         # reserve 7th and 8th bits for connection type
         self._encode_connection_type_map = {u"unknown":int("00000000", 2), u"public":int("10000000", 2), u"symmetric-NAT":int("11000000", 2)}
         self._decode_connection_type_map = dict((value, key) for key, value in self._encode_connection_type_map.iteritems())
@@ -798,7 +804,7 @@ class BinaryConversion(Conversion):
         data = [inet_aton(payload.destination_address[0]), self._struct_H.pack(payload.destination_address[1]),
                 inet_aton(payload.source_lan_address[0]), self._struct_H.pack(payload.source_lan_address[1]),
                 inet_aton(payload.source_wan_address[0]), self._struct_H.pack(payload.source_wan_address[1]),
-                self._struct_B.pack(self._encode_advice_map[payload.advice] | self._encode_connection_type_map[payload.connection_type] | self._encode_sync_map[payload.sync]),
+                self._struct_B.pack(self._encode_advice_map[payload.advice] | self._encode_connection_type_map[payload.connection_type] | self._encode_sync_map[payload.sync] | self._encode_digest_map[payload.digest]),
                 self._struct_H.pack(payload.identifier)]
 
         # add optional sync
@@ -839,6 +845,12 @@ class BinaryConversion(Conversion):
         sync = self._decode_sync_map.get(flags & int("10", 2))
         if sync is None:
             raise DropPacket("Invalid sync flag")
+
+        # older peers do not set the digest flag, their bloom filter contains the packets
+        digest = self._decode_digest_map.get(flags & int("1000", 2))
+        if digest is None:
+            raise DropPacket("Invalid digest flag")
+
         if sync:
             if len(data) < offset + 24:
                 raise DropPacket("Insufficient packet size")
@@ -868,7 +880,7 @@ class BinaryConversion(Conversion):
             if not length == len(data) - offset:
                 raise DropPacket("Invalid number of bytes available")
 
-            bloom_filter = BloomFilter(data[offset:offset + length], functions, prefix=prefix)
+            bloom_filter = ByteArrayBloomFilter(data[offset:offset + length], functions, prefix=prefix)
             offset += length
 
             sync = (time_low, time_high, modulo, modulo_offset, bloom_filter)
@@ -876,7 +888,7 @@ class BinaryConversion(Conversion):
         else:
             sync = None
 
-        return offset, placeholder.meta.payload.Implementation(placeholder.meta.payload, destination_address, source_lan_address, source_wan_address, advice, connection_type, sync, identifier)
+        return offset, placeholder.meta.payload.Implementation(placeholder.meta.payload, destination_address, source_lan_address, source_wan_address, advice, connection_type, sync, identifier, digest)
 
     def _encode_introduction_response(self, message):
         payload = message.payload
@@ -885,7 +897,7 @@ class BinaryConversion(Conversion):
                 inet_aton(payload.source_wan_address[0]), self._struct_H.pack(payload.source_wan_address[1]),
                 inet_aton(payload.lan_introduction_address[0]), self._struct_H.pack(payload.lan_introduction_address[1]),
                 inet_aton(payload.wan_introduction_address[0]), self._struct_H.pack(payload.wan_introduction_address[1]),
-                self._struct_B.pack(self._encode_connection_type_map[payload.connection_type] | self._encode_tunnel_map[payload.tunnel]),
+                self._struct_B.pack(self._encode_connection_type_map[payload.connection_type] | self._encode_tunnel_map[payload.tunnel] | self._encode_digest_map[payload.digest]),
                 self._struct_H.pack(payload.identifier))
 
     def _decode_introduction_response(self, placeholder, offset, data):
@@ -918,7 +930,12 @@ class BinaryConversion(Conversion):
         if tunnel is None:
             raise DropPacket("Invalid tunnel flag")
 
-        return offset, placeholder.meta.payload.Implementation(placeholder.meta.payload, destination_address, source_lan_address, source_wan_address, lan_introduction_address, wan_introduction_address, connection_type, tunnel, identifier)
+        # older peers do not set the digest flag, they do not understand digest keyed bloom filters
+        digest = self._decode_digest_map.get(flags & int("1000", 2))
+        if digest is None:
+            raise DropPacket("Invalid digest flag")
+
+        return offset, placeholder.meta.payload.Implementation(placeholder.meta.payload, destination_address, source_lan_address, source_wan_address, lan_introduction_address, wan_introduction_address, connection_type, tunnel, identifier, digest)
 
     def _encode_puncture_request(self, message):
         payload = message.payload
@@ -99,6 +99,15 @@ else:
 
     _struct_L = Struct(">L")
 
+    # older M2Crypto versions can only load keys through PEM, newer versions can load the DER
+    # encoded (binary) public key directly
+    _pub_key_from_der = getattr(EC, "pub_key_from_der", None)
+
+    # _valid_public_bins contains public keys, in binary format, that ec_check_public_bin has
+    # accepted before.  it is cleared once it reaches _valid_public_bins_length keys
+    _valid_public_bins = set()
+    _valid_public_bins_length = 4096
+
     # Allow all available curves.
     _curves = dict((unicode(curve), getattr(EC, curve)) for curve in dir(EC) if curve.startswith("NID_"))
 
@@ -179,6 +188,8 @@ else:
 
     def ec_to_public_bin(ec):
         "Get the public key in binary format."
+        if _pub_key_from_der:
+            return ec.pub().get_der()
         return ec_public_pem_to_public_bin(ec_to_public_pem(ec))
 
     def ec_check_private_bin(string):
@@ -191,10 +202,15 @@ else:
 
     def ec_check_public_bin(string):
         "Returns True if the input is a valid public key"
+        if string in _valid_public_bins:
+            return True
         try:
             ec_from_public_bin(string)
         except:
             return False
+        if len(_valid_public_bins) >= _valid_public_bins_length:
+            _valid_public_bins.clear()
+        _valid_public_bins.add(string)
         return True
 
     def ec_from_private_bin(string):
@@ -203,6 +219,8 @@ else:
 
     def ec_from_public_bin(string):
         "Get the EC from a public key in binary format."
+        if _pub_key_from_der:
+            return _pub_key_from_der(string)
         return ec_from_public_pem("".join(("-----BEGIN PUBLIC KEY-----\n", string.encode("BASE64"), "-----END PUBLIC KEY-----\n")))
 
     def ec_signature_length(ec):
@@ -324,6 +342,27 @@ if __debug__:
             t3 = time.time()
             print key, "signing took", round(t2-t1, 5), "verify took", round(t3-t2, 5), "totals", round(t3-t1, 5)
 
+        for key, curve in sorted(curves.iteritems()):
+            public_pem = ec_to_public_pem(curve)
+            public_bin = ec_to_public_bin(curve)
+            private_bin = ec_to_private_bin(curve)
+            count = 1000
+
+            t1 = time.time()
+            for _ in xrange(count):
+                ec_from_public_pem(public_pem)
+            t2 = time.time()
+            for _ in xrange(count):
+                ec_from_public_bin(public_bin)
+            t3 = time.time()
+            for _ in xrange(count):
+                ec_from_private_bin(private_bin)
+            t4 = time.time()
+            for _ in xrange(count):
+                ec_check_public_bin(public_bin)
+            t5 = time.time()
+            print key, "key loads per second:", "public-pem", int(count / (t2-t1)), "public-bin", int(count / (t3-t2)), "private-bin", int(count / (t4-t3)), "check-public-bin", int(count / (t5-t4))
+
     def main():
         for curve in [u"very-low", u"NID_secp224r1", u"low", u"medium", u"high"]:
             ec = ec_generate_key(curve)
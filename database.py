@@ -47,6 +47,11 @@ class IgnoreCommits(Exception):
         super(IgnoreCommits, self).__init__("Ignore all commits made within __enter__ and __exit__")
 
 class Database(Singleton):
+    # the number of prepared statements that are kept by the connection.  sqlite only needs to
+    # parse a statement once while it is in this cache, and each community adds a few large sync
+    # statements, hence the sqlite3 default of 100 is too small
+    _statement_cache_size = 512
+
     def __init__(self, file_path):
         """
         Initialize a new Database instance.
@@ -140,7 +145,7 @@ class Database(Singleton):
         assert isinstance(self._database_version, (int, long)), type(self._database_version)
         
     def _connect(self, file_path):
-        self._connection = sqlite3.Connection(file_path)
+        self._connection = sqlite3.Connection(file_path, cached_statements=self._statement_cache_size)
         # self._connection.setrollbackhook(self._on_rollback)
         self._cursor = self._connection.cursor()
 
@@ -431,7 +436,7 @@ class Database(Singleton):
 class APSWDatabase(Database):
     def _connect(self, file_path):
         import apsw
-        self._connection = apsw.Connection(file_path)
+        self._connection = apsw.Connection(file_path, statementcachesize=self._statement_cache_size)
         self._cursor = self._connection.cursor()
 
     def _init_database(self):
@@ -181,6 +181,9 @@ class DebugCommunity(Community):
         """
         self._dispersy.database.execute(u"DELETE FROM sync WHERE meta_message IN (" + ", ".join("?" * len(message_names)) + ")",
                                         [self.get_meta_message(name).database_id for name in message_names])
+        self._sync_index.invalidate()
+        self._last_sync_history.invalidate()
+        self._dispersy.invalidate_sequence_number_cache()
         return self._dispersy.database.changes
 
     def initiate_meta_messages(self):
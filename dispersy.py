@@ -51,12 +51,12 @@ from .authentication import NoAuthentication, MemberAuthentication, DoubleMember
 from .bloomfilter import BloomFilter
 from .bootstrap import get_bootstrap_candidates
 from .callback import Callback
-from .candidate import BootstrapCandidate, LoopbackCandidate, WalkCandidate, Candidate
+from .candidate import BootstrapCandidate, LoopbackCandidate, WalkCandidate, Candidate, obsolete_candidates
 from .destination import CommunityDestination, CandidateDestination, MemberDestination
 from .dispersydatabase import DispersyDatabase
 from .distribution import SyncDistribution, FullSyncDistribution, LastSyncDistribution, DirectDistribution
 from .dprint import dprint
-from .endpoint import DummyEndpoint
+from .endpoint import DummyEndpoint, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
 from .member import DummyMember, Member, MemberFromId, MemberFromDatabaseId, MemberWithoutCheck
 from .member import cleanup as cleanup_members
 from .message import BatchConfiguration, Packet, Message
@@ -231,11 +231,12 @@ class GlobalCandidateCache():
         for community in self._dispersy._communities.itervalues():
             if item.in_community(community, now):
                 community._candidates[key] = item
+                community.candidate_index.update(item)
+                community.index_associations(item)
         
     def __delitem__(self, item):
         for community in self._dispersy._communities.itervalues():
-            if item in community._candidates:
-                del community._candidates[item]
+            community.remove_candidate(item)
     
     def iteritems(self):
         for community in self._dispersy._communities.itervalues():
@@ -266,6 +267,9 @@ class Dispersy(Singleton):
     The Dispersy class provides the interface to all Dispersy related commands, managing the in- and
     outgoing data for, possibly, multiple communities.
     """
+    # the messages that make up the walker, these are sent with PRIORITY_HIGH
+    _walker_message_names = frozenset([u"dispersy-introduction-request", u"dispersy-introduction-response", u"dispersy-puncture-request", u"dispersy-puncture"])
+
     def __init__(self, callback, working_directory, database_filename=u"dispersy.db"):
         """
         Initialize the Dispersy singleton instance.
@@ -352,6 +356,17 @@ class Dispersy(Singleton):
         # commit changes to the database periodically
         self._callback.register(self._watchdog)
 
+        # the number of stored packets that have not been committed yet, and the number of stored
+        # packets after which _store will commit
+        self._store_uncommitted = 0
+        self._store_commit_threshold = 2500
+        self._database.attach_commit_callback(self._on_database_commit)
+
+        # the most recent global time and sequence number that we have stored for each member and
+        # FullSyncDistribution meta message that uses sequence numbers.
+        # (member_database_id, meta_message_database_id) / (last_global_time, sequence_number)
+        self._sequence_number_cache = {}
+
         # statistics...
         self._statistics = DispersyStatistics(self)
 
@@ -1127,8 +1142,9 @@ class Dispersy(Singleton):
 
                     if have_packet < message.packet:
                         # replace our current message with the other one
-                        self._database.execute(u"UPDATE sync SET packet = ? WHERE community = ? AND member = ? AND global_time = ?",
-                                               (buffer(message.packet), community.database_id, message.authentication.member.database_id, message.distribution.global_time))
+                        self._database.execute(u"UPDATE sync SET packet = ?, digest = ? WHERE community = ? AND member = ? AND global_time = ?",
+                                               (buffer(message.packet), buffer(message.packet_digest), community.database_id, message.authentication.member.database_id, message.distribution.global_time))
+                        community.sync_index.replace(message.distribution.global_time, message.authentication.member.database_id, message.packet_digest)
 
                         # notify that global times have changed
                         # community.update_sync_range(message.meta, [message.distribution.global_time])
@@ -1139,6 +1155,50 @@ class Dispersy(Singleton):
             # this message is a duplicate
             return True
 
+    def _get_stored_sync_keys(self, messages):
+        """
+        Returns a set with the (member_database_id, global_time) keys of MESSAGES that are already
+        stored in the database.
+
+        Only the keys that may be stored, according to the community's SyncKeyFilter, are resolved
+        and this is done using a single query for the entire batch.  _is_duplicate_sync_message
+        only needs to be called for the returned keys.
+
+        @param messages: The messages, all from the same community.
+        @type messages: [Message.Implementation]
+
+        @rtype: set
+        """
+        assert isinstance(messages, list)
+        assert all(message.community == messages[0].community for message in messages)
+        if not messages:
+            return set()
+        community = messages[0].community
+        may_contain = community.sync_key_filter.may_contain
+        keys = set(key
+                   for key
+                   in ((message.authentication.member.database_id, message.distribution.global_time) for message in messages)
+                   if may_contain(*key))
+        if not keys:
+            return keys
+
+        members = list(set(member for member, _ in keys))
+        global_times = list(set(global_time for _, global_time in keys))
+        # sqlite allows at most 999 variables per statement
+        if len(members) + len(global_times) < 999:
+            return set(key
+                       for key
+                       in self._database.execute(u"SELECT member, global_time FROM sync WHERE community = ? AND member IN (" + u", ".join(u"?" * len(members)) + u") AND global_time IN (" + u", ".join(u"?" * len(global_times)) + u")",
+                                                 [community.database_id] + members + global_times)
+                       if key in keys)
+
+        else:
+            return set(key
+                       for key
+                       in keys
+                       if any(True for _ in self._database.execute(u"SELECT 1 FROM sync WHERE community = ? AND member = ? AND global_time = ?",
+                                                                   (community.database_id,) + key)))
+
     def _check_full_sync_distribution_batch(self, messages):
         """
         Ensure that we do not yet have the messages and that, if sequence numbers are enabled, we
@@ -1172,14 +1232,21 @@ class Dispersy(Singleton):
         # refuse messages where the global time is unreasonably high
         acceptable_global_time = messages[0].community.acceptable_global_time
 
+        # the keys that we may already have, only these need to be checked by
+        # _is_duplicate_sync_message
+        stored = self._get_stored_sync_keys(messages)
+
         if enable_sequence_number:
-            # obtain the highest sequence_number from the database
+            # obtain the highest sequence_number from the cache or the database
             highest = {}
+            sequence_number_cache = self._sequence_number_cache
             for message in messages:
                 if not message.authentication.member.database_id in highest:
-                    last_global_time, seq = execute(u"SELECT MAX(global_time), COUNT(*) FROM sync WHERE member = ? AND meta_message = ?",
-                                                    (message.authentication.member.database_id, message.database_id)).next()
-                    highest[message.authentication.member.database_id] = (last_global_time or 0, seq)
+                    key = (message.authentication.member.database_id, message.database_id)
+                    if not key in sequence_number_cache:
+                        last_global_time, seq = execute(u"SELECT MAX(global_time), COUNT(*) FROM sync WHERE member = ? AND meta_message = ?", key).next()
+                        sequence_number_cache[key] = (last_global_time or 0, seq)
+                    highest[message.authentication.member.database_id] = sequence_number_cache[key]
 
             # all messages must follow the sequence_number order
             for message in messages:
@@ -1199,8 +1266,8 @@ class Dispersy(Singleton):
                     # we already have this message (drop)
 
                     # fetch the corresponding packet from the database (it should be binary identical)
-                    global_time, packet = execute(u"SELECT global_time, packet FROM sync WHERE member = ? AND meta_message = ? ORDER BY global_time, packet LIMIT 1 OFFSET ?",
-                                                  (message.authentication.member.database_id, message.database_id, message.distribution.sequence_number - 1)).next()
+                    global_time, packet = execute(u"SELECT global_time, packet FROM sync WHERE meta_message = ? AND member = ? AND sequence_number = ?",
+                                                  (message.database_id, message.authentication.member.database_id, message.distribution.sequence_number)).next()
                     packet = str(packet)
                     if message.packet == packet:
                         yield DropMessage(message, "duplicate message by binary packet")
@@ -1219,11 +1286,13 @@ class Dispersy(Singleton):
                             execute(u"DELETE FROM sync WHERE member = ? AND meta_message = ? AND global_time >= ?",
                                     (message.authentication.member.database_id, message.database_id, global_time))
                             if __debug__: dprint("removed ", self._database.changes, " entries from sync because the member created multiple sequences")
+                            message.community.sync_index.invalidate()
 
                             # by deleting messages we changed SEQ and the HIGHEST cache
                             last_global_time, seq = execute(u"SELECT MAX(global_time), COUNT(*) FROM sync WHERE member = ? AND meta_message = ?",
                                                        (message.authentication.member.database_id, message.database_id)).next()
                             highest[message.authentication.member.database_id] = (last_global_time or 0, seq)
+                            self._sequence_number_cache[(message.authentication.member.database_id, message.database_id)] = (last_global_time or 0, seq)
                             # we can allow MESSAGE to be processed
 
                 if seq + 1 != message.distribution.sequence_number:
@@ -1233,7 +1302,7 @@ class Dispersy(Singleton):
 
                 # we have the previous message, check for duplicates based on community,
                 # member, and global_time
-                if self._is_duplicate_sync_message(message):
+                if key in stored and self._is_duplicate_sync_message(message):
                     # we have the previous message (drop)
                     yield DropMessage(message, "duplicate message by global_time (1)")
                     continue
@@ -1262,7 +1331,7 @@ class Dispersy(Singleton):
                 unique.add(key)
 
                 # check for duplicates based on community, member, and global_time
-                if self._is_duplicate_sync_message(message):
+                if key in stored and self._is_duplicate_sync_message(message):
                     # we have the previous message (drop)
                     yield DropMessage(message, "duplicate message by global_time (2)")
                     continue
@@ -1323,8 +1392,7 @@ class Dispersy(Singleton):
                 unique.add(key)
 
                 if not message.authentication.member.database_id in times:
-                    times[message.authentication.member.database_id] = [global_time for global_time, in self._database.execute(u"SELECT global_time FROM sync WHERE community = ? AND member = ? AND meta_message = ?",
-                                                                                                                               (message.community.database_id, message.authentication.member.database_id, message.database_id))]
+                    times[message.authentication.member.database_id] = [global_time for global_time, _, _ in message.community.last_sync_history.get(message.meta, message.authentication.member.database_id)]
                     assert len(times[message.authentication.member.database_id]) <= message.distribution.history_size, [message.packet_id, message.distribution.history_size, times[message.authentication.member.database_id]]
                 tim = times[message.authentication.member.database_id]
 
@@ -1356,6 +1424,18 @@ class Dispersy(Singleton):
                     tim.append(message.distribution.global_time)
                     return message
 
+        def get_packet(tim, global_time):
+            """
+            Returns the (packet_id, packet) tuple for GLOBAL_TIME, the packet is obtained from the
+            database when it is not yet known
+            """
+            packet_id, packet = tim[global_time]
+            if packet is None:
+                packet, = self._database.execute(u"SELECT packet FROM sync WHERE id = ?", (packet_id,)).next()
+                packet = str(packet)
+                tim[global_time] = (packet_id, packet)
+            return packet_id, packet
+
         def check_double_member_and_global_time(unique, times, message):
             """
             No other message may exist with this message.authentication.members / global_time
@@ -1383,30 +1463,24 @@ class Dispersy(Singleton):
                 else:
                     unique.add(key)
 
-                    if self._is_duplicate_sync_message(message):
+                    if (message.authentication.member.database_id, message.distribution.global_time) in stored and self._is_duplicate_sync_message(message):
                         # we have the previous message (drop)
                         if __debug__: dprint("drop ", message.name, " ", ",".join(map(str, members)), "@", message.distribution.global_time, " (_is_duplicate_sync_message)")
                         return DropMessage(message, "duplicate message by member^global_time (4)")
 
                     if not members in times:
-                        # the next query obtains a list with all global times that we have in the
-                        # database for all message.meta messages that were signed by
-                        # message.authentication.members where the order of signing is not taken
-                        # into account.
-                        times[members] = dict((global_time, (packet_id, str(packet)))
-                                              for global_time, packet_id, packet
-                                              in self._database.execute(u"""
-SELECT sync.global_time, sync.id, sync.packet
-FROM sync
-JOIN double_signed_sync ON double_signed_sync.sync = sync.id
-WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed_sync.member2 = ?
-""",
-                                                                        (message.database_id,) + members))
+                        # the history contains all global times that we have in the database for
+                        # all message.meta messages that were signed by message.authentication.members
+                        # where the order of signing is not taken into account.  the packets are
+                        # only obtained when they are needed
+                        times[members] = dict((global_time, (packet_id, None))
+                                              for global_time, packet_id, _
+                                              in message.community.last_sync_history.get(message.meta, members))
                         assert len(times[members]) <= message.distribution.history_size, [len(times[members]), message.distribution.history_size]
                     tim = times[members]
 
                     if message.distribution.global_time in tim:
-                        packet_id, have_packet = tim[message.distribution.global_time]
+                        packet_id, have_packet = get_packet(tim, message.distribution.global_time)
 
                         if message.packet == have_packet:
                             # exact binary duplicate, do NOT process the message
@@ -1424,8 +1498,12 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
 
                                 if have_packet < message.packet:
                                     # replace our current message with the other one
-                                    self._database.execute(u"UPDATE sync SET member = ?, packet = ? WHERE id = ?",
-                                                           (message.authentication.member.database_id, buffer(message.packet), packet_id))
+                                    self._database.execute(u"UPDATE sync SET member = ?, packet = ?, digest = ? WHERE id = ?",
+                                                           (message.authentication.member.database_id, buffer(message.packet), buffer(message.packet_digest), packet_id))
+                                    message.community.sync_index.invalidate()
+                                    message.community.last_sync_history.invalidate()
+                                    # the packet is now stored under the (member, global_time) key of MESSAGE
+                                    message.community.sync_key_filter.add([message])
 
                                     return DropMessage(message, "replaced existing packet with other packet with the same payload")
 
@@ -1441,7 +1519,7 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
                         # if the history_size is one, we can sent that on message back because
                         # apparently the sender does not have this message yet
                         if message.distribution.history_size == 1:
-                            packet_id, have_packet = tim.values()[0]
+                            packet_id, have_packet = get_packet(tim, tim.keys()[0])
                             self._statistics.dict_inc(self._statistics.outgoing, u"-sequence-")
                             self._endpoint.send([message.candidate], [have_packet])
 
@@ -1478,6 +1556,9 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
             assert isinstance(meta.authentication, DoubleMemberAuthentication)
             unique = set()
             times = {}
+            # the keys that we may already have, only these need to be checked by
+            # _is_duplicate_sync_message
+            stored = self._get_stored_sync_keys([message for message in messages if not isinstance(message, DropMessage)])
             messages = [message if isinstance(message, DropMessage) else check_double_member_and_global_time(unique, times, message) for message in messages]
 
         return messages
@@ -2104,7 +2185,6 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
         meta = messages[0].meta
         if __debug__: dprint("attempting to store ", len(messages), " ", meta.name, " messages")
         is_double_member_authentication = isinstance(meta.authentication, DoubleMemberAuthentication)
-        highest_global_time = 0
 
         # update_sync_range = set()
         for message in messages:
@@ -2117,73 +2197,101 @@ WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed
 
             if __debug__: dprint(message.name, " ", message.authentication.member.database_id, "@", message.distribution.global_time)
 
-            # add packet to database
-            self._database.execute(u"INSERT INTO sync (community, member, global_time, meta_message, packet) VALUES (?, ?, ?, ?, ?)",
-                    (message.community.database_id,
-                     message.authentication.member.database_id,
-                     message.distribution.global_time,
-                     message.database_id,
-                     buffer(message.packet)))
-            # update_sync_range.add(message.distribution.global_time)
-            if __debug__:
-                # must have stored one entry
-                assert self._database.changes == 1
-                # when sequence numbers are enabled, we must have exactly
-                # message.distribution.sequence_number messages in the database
-                if isinstance(message.distribution, FullSyncDistribution) and message.distribution.enable_sequence_number:
-                    count_ = self._database.execute(u"SELECT COUNT(*) FROM sync WHERE meta_message = ? AND member = ?", (message.database_id, message.authentication.member.database_id)).next()
-                    assert count_ == message.distribution.sequence_number, [count_, message.distribution.sequence_number]
-
-            # ensure that we can reference this packet
-            message.packet_id = self._database.last_insert_rowid
+        # add packets to database.  all packets are inserted with a single statement
+        enable_sequence_number = isinstance(meta.distribution, FullSyncDistribution) and meta.distribution.enable_sequence_number
+        self._database.executemany(u"INSERT INTO sync (community, member, global_time, meta_message, packet, digest, sequence_number) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   [(message.community.database_id,
+                                     message.authentication.member.database_id,
+                                     message.distribution.global_time,
+                                     message.database_id,
+                                     buffer(message.packet),
+                                     buffer(message.packet_digest),
+                                     message.distribution.sequence_number if enable_sequence_number else 0)
+                                    for message
+                                    in messages])
+        # update_sync_range.update(message.distribution.global_time for message in messages)
+        assert self._database.changes == len(messages), [self._database.changes, len(messages)]
+
+        # ensure that we can reference these packets.  sqlite assigns consecutive row ids to the
+        # rows inserted by a single executemany, hence the ids follow from the last inserted row id
+        last_insert_rowid, = self._database.execute(u"SELECT last_insert_rowid()").next()
+        for packet_id, message in enumerate(messages, last_insert_rowid - len(messages) + 1):
+            message.packet_id = packet_id
             if __debug__: dprint("insert_rowid: ", message.packet_id, " for ", message.name)
 
-            if is_double_member_authentication:
-                member1 = message.authentication.members[0].database_id
-                member2 = message.authentication.members[1].database_id
-                self._database.execute(u"INSERT INTO double_signed_sync (sync, member1, member2) VALUES (?, ?, ?)",
-                                       (message.packet_id, member1, member2) if member1 < member2 else (message.packet_id, member2, member1))
-                assert self._database.changes == 1
+        if __debug__:
+            for message in messages:
+                packet, = self._database.execute(u"SELECT packet FROM sync WHERE id = ?", (message.packet_id,)).next()
+                assert str(packet) == message.packet, "packet_id does not reference the stored packet"
+
+            # when sequence numbers are enabled, we must have exactly message.distribution.sequence_number
+            # messages in the database for the highest sequence number of every member
+            if enable_sequence_number:
+                sequence_numbers = {}
+                for message in messages:
+                    member_database_id = message.authentication.member.database_id
+                    sequence_numbers[member_database_id] = max(sequence_numbers.get(member_database_id, 0), message.distribution.sequence_number)
+                for member_database_id, sequence_number in sequence_numbers.iteritems():
+                    count_, = self._database.execute(u"SELECT COUNT(*) FROM sync WHERE meta_message = ? AND member = ?", (meta.database_id, member_database_id)).next()
+                    assert count_ == sequence_number, [count_, sequence_number]
+
+        if is_double_member_authentication:
+            order = lambda member1, member2: (member1, member2) if member1 < member2 else (member2, member1)
+            self._database.executemany(u"INSERT INTO double_signed_sync (sync, member1, member2) VALUES (?, ?, ?)",
+                                       [(message.packet_id,) + order(message.authentication.members[0].database_id, message.authentication.members[1].database_id)
+                                        for message
+                                        in messages])
+            assert self._database.changes == len(messages), [self._database.changes, len(messages)]
+
+        if enable_sequence_number:
+            # the sequence number of a stored message equals the number of messages that we have
+            # from that member
+            sequence_number_cache = self._sequence_number_cache
+            for message in messages:
+                key = (message.authentication.member.database_id, message.database_id)
+                if sequence_number_cache.get(key, (0, 0))[1] < message.distribution.sequence_number:
+                    sequence_number_cache[key] = (message.distribution.global_time, message.distribution.sequence_number)
+
+        # update global time
+        highest_global_time = max(message.distribution.global_time for message in messages)
 
-            # update global time
-            highest_global_time = max(highest_global_time, message.distribution.global_time)
+        # the stored packets are part of the sync bloom filters from now on
+        meta.community.sync_index.add(messages)
+        meta.community.sync_key_filter.add(messages)
 
         if isinstance(meta.distribution, LastSyncDistribution):
-            # delete packets that have become obsolete
-            items = set()
+            # delete packets that have become obsolete.  the in memory history tells us which
+            # packets no longer fit, hence they can be deleted by their id
+            items = []
+            history = meta.community.last_sync_history
             if is_double_member_authentication:
-                order = lambda member1, member2: (member1, member2) if member1 < member2 else (member2, member1)
-                for member1, member2 in set(order(message.authentication.members[0].database_id, message.authentication.members[1].database_id) for message in messages):
-                    assert member1 < member2, [member1, member2]
-                    all_items = list(self._database.execute(u"""
-SELECT sync.id, sync.global_time
-FROM sync
-JOIN double_signed_sync ON double_signed_sync.sync = sync.id
-WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed_sync.member2 = ?
-ORDER BY sync.global_time, sync.packet""", (meta.database_id, member1, member2)))
-                    if len(all_items) > meta.distribution.history_size:
-                        items.update(all_items[:len(all_items) - meta.distribution.history_size])
+                for message in messages:
+                    member1 = message.authentication.members[0].database_id
+                    member2 = message.authentication.members[1].database_id
+                    key = (member1, member2) if member1 < member2 else (member2, member1)
+                    items.extend(history.add(meta, key, message.distribution.global_time, message.packet_id, message.authentication.member.database_id))
 
             else:
-                for member_database_id in set(message.authentication.member.database_id for message in messages):
-                    all_items = list(self._database.execute(u"""
-SELECT id, global_time
-FROM sync
-WHERE meta_message = ? AND member = ?
-ORDER BY global_time""", (meta.database_id, member_database_id)))
-                    if len(all_items) > meta.distribution.history_size:
-                        items.update(all_items[:len(all_items) - meta.distribution.history_size])
+                for message in messages:
+                    member_database_id = message.authentication.member.database_id
+                    items.extend(history.add(meta, member_database_id, message.distribution.global_time, message.packet_id, member_database_id))
 
             if items:
-                self._database.executemany(u"DELETE FROM sync WHERE id = ?", [(syncid, ) for syncid,_ in items])
-                assert len(items) == self._database.changes
-                if __debug__: dprint("deleted ", self._database.changes, " messages")
+                # sqlite allows at most 999 variables per statement
+                packet_ids = [packet_id for _, packet_id, _ in items]
+                for index in xrange(0, len(packet_ids), 999):
+                    chunk = packet_ids[index:index+999]
+                    self._database.execute(u"DELETE FROM sync WHERE id IN (" + u", ".join(u"?" * len(chunk)) + u")", chunk)
+                    assert len(chunk) == self._database.changes
+                    if __debug__: dprint("deleted ", self._database.changes, " messages")
+
+                    if is_double_member_authentication:
+                        self._database.execute(u"DELETE FROM double_signed_sync WHERE sync IN (" + u", ".join(u"?" * len(chunk)) + u")", chunk)
+                        assert len(chunk) == self._database.changes
 
-                if is_double_member_authentication:
-                    self._database.executemany(u"DELETE FROM double_signed_sync WHERE sync = ?", [(syncid, ) for syncid,_ in items])
-                    assert len(items) == self._database.changes
+                meta.community.sync_index.remove((global_time, member) for global_time, _, member in items)
 
-                # update_sync_range.update(global_time for _, _, global_time in items)
+                # update_sync_range.update(global_time for global_time, _, _ in items)
 
             # 12/10/11 Boudewijn: verify that we do not have to many packets in the database
             if __debug__:
@@ -2197,6 +2305,13 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
 
         meta.community.dispersy_store(messages)
 
+        # the stored packets are committed by the _watchdog, when a user generated message is
+        # stored, or when too many packets are waiting to be committed
+        self._store_uncommitted += len(messages)
+        if self._store_uncommitted >= self._store_commit_threshold:
+            if __debug__: dprint("commit ", self._store_uncommitted, " stored packets")
+            self._database.commit()
+
         # if update_sync_range:
         #     # notify that global times have changed
         #     meta.community.update_sync_range(meta, update_sync_range)
@@ -2333,7 +2448,7 @@ ORDER BY global_time""", (meta.database_id, member_database_id)))
 
                     # verify that the bloom filter is correct
                     try:
-                        packets = [str(packet) for packet, in self._database.execute(u"""SELECT sync.packet
+                        digests = [str(digest) for digest, in self._database.execute(u"""SELECT sync.digest
 FROM sync
 JOIN meta_message ON meta_message.id = sync.meta_message
 WHERE sync.community = ? AND meta_message.priority > 32 AND sync.undone = 0 AND global_time BETWEEN ? AND ? AND (sync.global_time + ?) % ? = 0""",
@@ -2348,27 +2463,33 @@ WHERE sync.community = ? AND meta_message.priority > 32 AND sync.undone = 0 AND
                     # BLOOM_FILTER must be the same after transmission
                     test_bloom_filter = BloomFilter(bloom_filter.bytes, bloom_filter.functions, prefix=bloom_filter.prefix)
                     assert bloom_filter.bytes == test_bloom_filter.bytes, "problem with the long <-> binary conversion"
-                    assert list(bloom_filter.not_filter((packet,) for packet in packets)) == [], "does not have all correct bits set before transmission"
-                    assert list(test_bloom_filter.not_filter((packet,) for packet in packets)) == [], "does not have all correct bits set after transmission"
+                    assert list(bloom_filter.not_filter((digest,) for digest in digests)) == [], "does not have all correct bits set before transmission"
+                    assert list(test_bloom_filter.not_filter((digest,) for digest in digests)) == [], "does not have all correct bits set after transmission"
 
                     # BLOOM_FILTER must have been correctly filled
                     test_bloom_filter.clear()
-                    test_bloom_filter.add_keys(packets)
+                    test_bloom_filter.add_keys(digests)
                     if not bloom_filter.bytes == bloom_filter.bytes:
                         if bloom_filter.get_bits_checked() < test_bloom_filter.get_bits_checked():
                             dprint(bloom_filter.get_bits_checked(), " bits in: ", bloom_filter.bytes.encode("HEX"), level="error")
                             dprint(test_bloom_filter.get_bits_checked(), " bits in: ", test_bloom_filter.bytes.encode("HEX"), level="error")
-                            assert False, "does not match the given range [%d:%d] %%%d+%d packets:%d" % (time_low, time_high, modulo, offset, len(packets))
+                            assert False, "does not match the given range [%d:%d] %%%d+%d packets:%d" % (time_low, time_high, modulo, offset, len(digests))
 
         if __debug__:
             if destination.get_destination_address(self._wan_address) != destination.sock_addr:
                 dprint("destination address, ", destination.get_destination_address(self._wan_address), " should (in theory) be the sock_addr ", destination, level="warning")
 
+        # older peers check the bloom filter against their packets, they only receive digest keyed
+        # bloom filters once they told us that they understand them
+        digest = destination.sync_digests
+        if sync and not digest:
+            sync = community.dispersy_claim_packet_sync_bloom_filter(sync)
+
         meta_request = community.get_meta_message(u"dispersy-introduction-request")
         request = meta_request.impl(authentication=(community.my_member,),
                                     distribution=(community.global_time,),
                                     destination=(destination,),
-                                    payload=(destination.get_destination_address(self._wan_address), self._lan_address, self._wan_address, advice, self._connection_type, sync, identifier))
+                                    payload=(destination.get_destination_address(self._wan_address), self._lan_address, self._wan_address, advice, self._connection_type, sync, identifier, digest))
 
         if __debug__:
             if sync:
@@ -2452,6 +2573,8 @@ WHERE sync.community = ? AND meta_message.priority > 32 AND sync.undone = 0 AND
             # update sender candidate
             source_lan_address, source_wan_address = self._estimate_lan_and_wan_addresses(candidate.sock_addr, payload.source_lan_address, payload.source_wan_address)
             candidate.update(candidate.tunnel, source_lan_address, source_wan_address, payload.connection_type)
+            if payload.digest:
+                candidate.sync_digests = True
             candidate.stumble(community, now)
             
             self._filter_duplicate_candidate(candidate)
@@ -2485,7 +2608,7 @@ WHERE sync.community = ? AND meta_message.priority > 32 AND sync.undone = 0 AND
                 if __debug__: dprint("telling ", candidate, " that ", introduced, " exists ", type(community))
 
                 # create introduction response
-                responses.append(meta_introduction_response.impl(authentication=(community.my_member,), distribution=(community.global_time,), destination=(candidate,), payload=(candidate.get_destination_address(self._wan_address), self._lan_address, self._wan_address, introduced.lan_address, introduced.wan_address, self._connection_type, introduced.tunnel, payload.identifier)))
+                responses.append(meta_introduction_response.impl(authentication=(community.my_member,), distribution=(community.global_time,), destination=(candidate,), payload=(candidate.get_destination_address(self._wan_address), self._lan_address, self._wan_address, introduced.lan_address, introduced.wan_address, self._connection_type, introduced.tunnel, payload.identifier, True)))
 
                 # create puncture request
                 requests.append(meta_puncture_request.impl(distribution=(community.global_time,), destination=(introduced,), payload=(source_lan_address, source_wan_address, payload.identifier)))
@@ -2494,7 +2617,7 @@ WHERE sync.community = ? AND meta_message.priority > 32 AND sync.undone = 0 AND
                 if __debug__: dprint("responding to ", candidate, " without an introduction ", type(community))
 
                 none = ("0.0.0.0", 0)
-                responses.append(meta_introduction_response.impl(authentication=(community.my_member,), distribution=(community.global_time,), destination=(candidate,), payload=(candidate.get_destination_address(self._wan_address), self._lan_address, self._wan_address, none, none, self._connection_type, False, payload.identifier)))
+                responses.append(meta_introduction_response.impl(authentication=(community.my_member,), distribution=(community.global_time,), destination=(candidate,), payload=(candidate.get_destination_address(self._wan_address), self._lan_address, self._wan_address, none, none, self._connection_type, False, payload.identifier, True)))
 
         if responses:
             self._forward(responses)
@@ -2505,21 +2628,10 @@ WHERE sync.community = ? AND meta_message.priority > 32 AND sync.undone = 0 AND
         # process the bloom filter part of the request
         #
 
-        # obtain all available messages for this community
-        meta_messages = [(meta.distribution.priority, -meta.distribution.synchronization_direction_value, meta) for meta in community.get_meta_messages() if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32]
-        meta_messages.sort(reverse = True)
-        
-        sub_selects = []
-        for _, _, meta in meta_messages:
-            sub_selects.append(u"""SELECT * FROM (SELECT sync.packet FROM sync
-WHERE sync.meta_message = %d AND sync.undone = 0 AND sync.global_time BETWEEN ? AND ? AND (sync.global_time + ?) %% ? = 0
-ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchronization_direction))
-        
-        sql = u"SELECT * FROM ("
-        sql += " UNION ALL ".join(sub_selects)
-        sql += ")"
-
-        if __debug__: dprint(sql)
+        # bloom filters either contain the packets (older peers) or the packet digests.  in the
+        # latter case we only need to read the narrow digest column, the packets themselves are
+        # only read once they are known to be missing
+        sql, digest_sql, sub_selects = community.get_sync_response_sql()
 
         for message in messages:
             payload = message.payload
@@ -2539,23 +2651,50 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
                 modulo = long(payload.modulo)
                 
                 packets = []
-                generator = ((str(packet),) for packet, in self._database.execute(sql, (time_low, long(time_high), offset, modulo) * len(sub_selects)))
-                    
-                for packet, in payload.bloom_filter.not_filter(generator):
-                    if __debug__:dprint("found missing (", len(packet), " bytes) ", sha1(packet).digest().encode("HEX"), " for ", message.candidate)
+                if payload.digest:
+                    # many peers request the same range, the (digest, id) candidates are cached by
+                    # the sync index until the sync table changes
+                    candidates = community.sync_index.get_response_candidates(time_low, time_high, modulo, offset)
+                    if candidates is None:
+                        self._statistics.sync_response_cache_miss += 1
+                        # the digests must be fetched before iterating, because the same cursor is
+                        # used to obtain the missing packets
+                        candidates = [(str(digest), packet_id) for digest, packet_id in self._database.execute(digest_sql, (time_low, long(time_high), offset, modulo) * sub_selects)]
+                        community.sync_index.set_response_candidates(time_low, time_high, modulo, offset, candidates)
+                    else:
+                        self._statistics.sync_response_cache_hit += 1
 
-                    packets.append(packet)
-                    byte_limit -= len(packet)
-                    if byte_limit <= 0:
-                        if __debug__:
-                            dprint("bandwidth throttle")
-                        break
+                    for digest, packet_id in payload.bloom_filter.not_filter(candidates):
+                        packet, = self._database.execute(u"SELECT packet FROM sync WHERE id = ?", (packet_id,)).next()
+                        packet = str(packet)
+                        if __debug__: dprint("found missing (", len(packet), " bytes) ", digest.encode("HEX"), " for ", message.candidate)
+
+                        packets.append(packet)
+                        byte_limit -= len(packet)
+                        if byte_limit <= 0:
+                            if __debug__:
+                                dprint("bandwidth throttle")
+                            break
+
+                else:
+                    # older peers send bloom filters that contain the packets.  these are not cached,
+                    # the packets are streamed from the database until byte_limit is reached
+                    generator = ((str(packet),) for packet, in self._database.execute(sql, (time_low, long(time_high), offset, modulo) * sub_selects))
+                    for packet, in payload.bloom_filter.not_filter(generator):
+                        if __debug__:dprint("found missing (", len(packet), " bytes) ", sha1(packet).digest().encode("HEX"), " for ", message.candidate)
+
+                        packets.append(packet)
+                        byte_limit -= len(packet)
+                        if byte_limit <= 0:
+                            if __debug__:
+                                dprint("bandwidth throttle")
+                            break
 
                 if packets:
                     if __debug__:
                         dprint("syncing ", len(packets), " packets (", sum(len(packet) for packet in packets), " bytes) over [", time_low, ":", time_high, "] selecting (%", message.payload.modulo, "+", message.payload.offset, ") to " , message.candidate)
                     self._statistics.dict_inc(self._statistics.outgoing, u"-sync-", len(packets))
-                    self._endpoint.send([message.candidate], packets)
+                    self._endpoint.send([message.candidate], packets, PRIORITY_LOW)
 
     def check_introduction_response(self, messages):
         for message in messages:
@@ -2608,6 +2747,9 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
             else:
                 candidate = community.create_candidate(message.candidate.sock_addr, message.candidate.tunnel, source_lan_address, source_wan_address, payload.connection_type)
 
+            # older peers do not understand bloom filters that contain packet digests
+            candidate.sync_digests = payload.digest
+
             # until we implement a proper 3-way handshake we are going to assume that the creator of
             # this message is associated to this candidate
             candidate.associate(community, message.authentication.member)
@@ -2881,16 +3023,18 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
             result = all(self._send(message.destination.candidates, [message]) for message in messages)
 
         elif isinstance(meta.destination, MemberDestination):
-            # MemberDestination.candidates may be empty
-            result = all(self._send([candidate
-                                            for candidate
-                                            in self._candidates.itervalues()
-                                            if any(candidate.is_associated(message.community, member)
-                                                   for member
-                                                   in message.destination.members)],
-                                           [message])
-                       for message
-                       in messages)
+            # MemberDestination.candidates may be empty.  only the candidates in META.COMMUNITY are
+            # used, a candidate that is only known in other communities is no longer active in this
+            # community and its associations are not indexed
+            community = meta.community
+            result = all(self._send(list(set(candidate
+                                             for member
+                                             in message.destination.members
+                                             for candidate
+                                             in community.get_member_candidates(member))),
+                                    [message])
+                         for message
+                         in messages)
 
         else:
             raise NotImplementedError(meta.destination)
@@ -2922,7 +3066,10 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
         messages_send = False
         if len(candidates) and len(messages):
             packets = [message.packet for message in messages]
-            messages_send = self._endpoint.send(candidates, packets)
+            # walker messages are sent before all others, keeping the walk going while the
+            # sendqueue is full of sync responses
+            priority = PRIORITY_HIGH if all(message.name in self._walker_message_names for message in messages) else PRIORITY_NORMAL
+            messages_send = self._endpoint.send(candidates, packets, priority)
         
         if messages_send:
             for message in messages:
@@ -2978,6 +3125,9 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
         # remove all messages created by the malicious member
         self._database.execute(u"DELETE FROM sync WHERE community = ? AND member = ?",
                                (community.database_id, member.database_id))
+        community.sync_index.invalidate()
+        community.last_sync_history.invalidate()
+        self.invalidate_sequence_number_cache()
 
         # TODO: if we have a address for the malicious member, we can also remove her from the
         # candidate table
@@ -3563,8 +3713,8 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
                 highest = min(lowest + packet_limit, highest)
 
                 if __debug__: dprint("fetching member:", member_id, " message:", message_id, ", ", highest - lowest + 1, " packets from database for ", candidate)
-                for packet, in self._database.execute(u"SELECT packet FROM sync WHERE member = ? AND meta_message = ? ORDER BY global_time LIMIT ? OFFSET ?",
-                                                      (member_id, message_id, highest - lowest + 1, lowest - 1)):
+                for packet, in self._database.execute(u"SELECT packet FROM sync WHERE meta_message = ? AND member = ? AND sequence_number BETWEEN ? AND ? ORDER BY sequence_number",
+                                                      (message_id, member_id, lowest, highest)):
                     packet = str(packet)
                     packets.append(packet)
 
@@ -4009,6 +4159,8 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
 
         self._database.executemany(u"UPDATE sync SET undone = ? WHERE community = ? AND member = ? AND global_time = ?",
                                    ((message.packet_id, message.community.database_id, message.payload.member.database_id, message.payload.global_time) for message in messages))
+        for community, iterator in groupby(messages, key=lambda x: x.community):
+            community.sync_index.remove((message.payload.global_time, message.payload.member.database_id) for message in iterator)
         for meta, iterator in groupby(messages, key=lambda x: x.payload.packet.meta):
             sub_messages = list(iterator)
             meta.undo_callback([(message.payload.member, message.payload.global_time, message.payload.packet) for message in sub_messages])
@@ -4122,6 +4274,9 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
                 # 2. cleanup sync table.  everything except what we need to tell others this
                 # community is no longer available
                 self._database.execute(u"DELETE FROM sync WHERE community = ? AND id NOT IN (" + u", ".join(u"?" for _ in packet_ids) + ")", [community.database_id] + list(packet_ids))
+                community.sync_index.invalidate()
+                community.last_sync_history.invalidate()
+                self.invalidate_sequence_number_cache()
 
                 # 3. cleanup the malicious_proof table.  we need nothing here anymore
                 self._database.execute(u"DELETE FROM malicious_proof WHERE community = ?", (community.database_id,))
@@ -4187,6 +4342,7 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
                 if undo:
                     executemany(u"UPDATE sync SET undone = 1 WHERE id = ?", ((message.packet_id,) for message in undo))
                     assert self._database.changes == len(undo), (self._database.changes, len(undo))
+                    community.sync_index.remove((message.distribution.global_time, message.authentication.member.database_id) for message in undo)
                     meta.undo_callback([(message.authentication.member, message.distribution.global_time, message) for message in undo])
 
                     # notify that global times have changed
@@ -4195,6 +4351,7 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
                 if redo:
                     executemany(u"UPDATE sync SET undone = 0 WHERE id = ?", ((message.packet_id,) for message in redo))
                     assert self._database.changes == len(redo), (self._database.changes, len(redo))
+                    community.sync_index.add(redo)
                     meta.handle_callback(redo)
 
                     # notify that global times have changed
@@ -4491,6 +4648,35 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
                 self._database.commit(exiting = True)
                 break
 
+    def invalidate_sequence_number_cache(self):
+        """
+        Discard the cached sequence numbers.
+
+        Must be called after messages with sequence numbers are removed from the database.
+        """
+        self._sequence_number_cache.clear()
+
+    def _on_database_commit(self, exiting=False):
+        self._store_uncommitted = 0
+
+    @property
+    def store_commit_threshold(self):
+        """
+        The number of stored, but uncommitted, packets after which the database is committed.
+
+        Stored packets are written to the database immediately, because subsequent checks query the
+        sync table.  The commit, however, is deferred until the _watchdog runs, a user generated
+        message is stored, or this many packets are waiting.
+        @rtype: int
+        """
+        return self._store_commit_threshold
+
+    @store_commit_threshold.setter
+    def store_commit_threshold(self, threshold):
+        assert isinstance(threshold, int)
+        assert threshold > 0
+        self._store_commit_threshold = threshold
+
     def _commit_now(self):
         """
         Flush changes to disk.
@@ -4502,7 +4688,7 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
         Stop the callback thread and clean all caches.
         """
         self._callback.stop(timeout=timeout)
-        
+
         cleanup_members()
         cleanup_singletons()
 
@@ -4579,15 +4765,21 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
     def _periodically_cleanup_candidates(self):
         """
         Periodically remove Candidate instance where all communities are obsolete.
+
+        Every candidate is filed in obsolete_candidates by the time at which all its communities
+        become obsolete, hence only the candidates that expired are visited.
         """
         while True:
-            yield 5 * 60.0
+            yield obsolete_candidates.resolution
 
             now = time()
-            for key, candidate in [(key, candidate) for key, candidate in self._candidates.iteritems() if candidate.is_all_obsolete(now)]:
-                if __debug__: dprint("removing obsolete candidate ", candidate)
-                del self._candidates[key]
-                self.wan_address_unvote(candidate)
+            for candidate, _ in obsolete_candidates.expire(now):
+                # the candidate may already have been replaced or removed
+                key = candidate.sock_addr
+                if candidate.is_all_obsolete(now) and self._candidates.get(key) is candidate:
+                    if __debug__: dprint("removing obsolete candidate ", candidate)
+                    del self._candidates[key]
+                    self.wan_address_unvote(candidate)
 
     if __debug__:
         def _stats_candidates(self):
@@ -4599,7 +4791,7 @@ ORDER BY sync.global_time %s)"""%(meta.database_id, meta.distribution.synchroniz
                     if community.get_classification() == u"PreviewChannelCommunity":
                         continue
 
-                    candidates = [candidate for candidate in self._candidates.itervalues() if candidate.in_community(community, now) and candidate.is_any_active(now)]
+                    candidates = list(community.dispersy_yield_candidates())
                     dprint(" ", community.cid.encode("HEX"), " ", "%20s" % community.get_classification(), " with ", len(candidates), "" if community.dispersy_enable_candidate_walker else "*", " candidates[:5] ", ", ".join(str(candidate) for candidate in candidates[:5]))
 
         def _stats_detailed_candidates(self):
@@ -6,6 +6,7 @@ This module provides an interface to the Dispersy database.
 @contact: dispersy@frayja.com
 """
 
+from hashlib import sha1
 from itertools import groupby
 from collections import defaultdict
 
@@ -22,7 +23,7 @@ from .revision import update_revision_information
 # update version information directly from SVN
 update_revision_information("$HeadURL$", "$Revision$")
 
-LATEST_VERSION = 16
+LATEST_VERSION = 18
 
 schema = u"""
 CREATE TABLE member(
@@ -74,9 +75,12 @@ CREATE TABLE sync(
  meta_message INTEGER REFERENCES meta_message(id),
  undone INTEGER DEFAULT 0,
  packet BLOB,
+ digest BLOB,                                           -- sha1 of packet, used as sync bloom filter key
+ sequence_number INTEGER DEFAULT 0,                     -- zero when sequence numbers are disabled
  UNIQUE(community, member, global_time));
 CREATE INDEX sync_meta_message_undone_global_time_index ON sync(meta_message, undone, global_time);
 CREATE INDEX sync_meta_message_member ON sync(meta_message, member);
+CREATE INDEX sync_meta_message_member_sequence_number ON sync(meta_message, member, sequence_number);
 
 CREATE TABLE malicious_proof(
  id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -355,11 +359,44 @@ UPDATE option SET value = '13' WHERE key = 'database_version';
 
             # upgrade from version 16 to version 17
             if database_version < 17:
-                # there is no version 17 yet...
-                # if __debug__: dprint("upgrade database ", database_version, " -> ", 17)
-                # self.executescript(u"""UPDATE option SET value = '17' WHERE key = 'database_version';""")
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 17)
+                # the sync bloom filters contain the sha1 digest of each packet instead of the packet
+                # itself.  storing the digest allows us to build the bloom filters, and to answer
+                # incoming sync requests, without reading (and hashing) every packet
+                self.executescript(u"""ALTER TABLE sync ADD COLUMN digest BLOB;""")
+                last_id = 0
+                while True:
+                    rows = list(self.execute(u"SELECT id, packet FROM sync WHERE id > ? ORDER BY id LIMIT 1000", (last_id,)))
+                    if not rows:
+                        break
+                    self.executemany(u"UPDATE sync SET digest = ? WHERE id = ?", [(buffer(sha1(str(packet)).digest()), id_) for id_, packet in rows])
+                    last_id = rows[-1][0]
+                self.executescript(u"""UPDATE option SET value = '17' WHERE key = 'database_version';""")
+                self.commit()
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 17, " (done)")
+
+            # upgrade from version 17 to version 18
+            if database_version < 18:
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 18)
+                # the sequence number is stored explicitly, allowing missing sequence numbers to be
+                # found using the index instead of LIMIT ... OFFSET ....  the database does not know
+                # which meta messages use sequence numbers, hence the values are set per community
+                # in check_community_database
+                self.executescript(u"""
+ALTER TABLE sync ADD COLUMN sequence_number INTEGER DEFAULT 0;
+CREATE INDEX sync_meta_message_member_sequence_number ON sync(meta_message, member, sequence_number);
+UPDATE option SET value = '18' WHERE key = 'database_version';
+""")
+                self.commit()
+                if __debug__: dprint("upgrade database ", database_version, " -> ", 18, " (done)")
+
+            # upgrade from version 18 to version 19
+            if database_version < 19:
+                # there is no version 19 yet...
+                # if __debug__: dprint("upgrade database ", database_version, " -> ", 19)
+                # self.executescript(u"""UPDATE option SET value = '19' WHERE key = 'database_version';""")
                 # self.commit()
-                # if __debug__: dprint("upgrade database ", database_version, " -> ", 17, " (done)")
+                # if __debug__: dprint("upgrade database ", database_version, " -> ", 19, " (done)")
                 pass
 
         return LATEST_VERSION
@@ -553,4 +590,24 @@ WHERE a.community = ? AND a.undone > 0 AND b.id is NULL""", (community.database_
             for handler in progress_handlers:
                 handler.Destroy()
 
+        if database_version < 18:
+            if __debug__: dprint("upgrade community ", database_version, " -> ", 18)
+
+            # patch 17 -> 18 notes:
+            #
+            # the sync table has a new sequence_number column.  since version 16 the sequence
+            # numbers of a member are consecutive, hence the sequence number of a message is its
+            # position when ordered by global time
+            metas = [meta for meta in community.get_meta_messages() if isinstance(meta.distribution, FullSyncDistribution) and meta.distribution.enable_sequence_number]
+            for meta in metas:
+                updates = []
+                for member_id, iterator in groupby(list(self.execute(u"SELECT id, member FROM sync WHERE meta_message = ? ORDER BY member, global_time", (meta.database_id,))), key=lambda tup: tup[1]):
+                    updates.extend((sequence_number, packet_id) for sequence_number, (packet_id, _) in enumerate(iterator, 1))
+                if updates:
+                    self.executemany(u"UPDATE sync SET sequence_number = ? WHERE id = ?", updates)
+                    assert len(updates) == self.changes, [len(updates), self.changes]
+
+            self.execute(u"UPDATE community SET database_version = 18 WHERE id = ?", (community.database_id,))
+            self.commit()
+
         return LATEST_VERSION
@@ -1,8 +1,10 @@
 # Python 2.5 features
 from __future__ import with_statement
 
+from collections import deque
 from itertools import product
 from select import select
+from struct import Struct
 from time import time
 from traceback import print_exc
 import errno
@@ -27,12 +29,274 @@ else:
 TUNNEL_PREFIX = "ffffffff".decode("HEX")
 DEBUG = False
 
+# send priorities, packets with a higher priority (lower value) are sent first.  walker messages
+# use PRIORITY_HIGH, sync responses use PRIORITY_LOW
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# recvmmsg and sendmmsg allow many datagrams to be received or sent using a single system call.
+# they are only available on Linux (2.6.33 and 3.0 respectively), all other platforms use one
+# recvfrom or sendto call per datagram
+_libc = None
+if sys.platform.startswith("linux"):
+    try:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not (hasattr(_libc, "recvmmsg") and hasattr(_libc, "sendmmsg")):
+            _libc = None
+    except (ImportError, OSError):
+        _libc = None
+
+if _libc:
+    MSG_TRUNC = 0x20
+
+    # sin_addr is stored in network byte order, i.e. the packed bytes from inet_aton
+    _struct_in_addr = Struct("=L")
+
+    class _iovec(ctypes.Structure):
+        _fields_ = [("iov_base", ctypes.c_void_p),
+                    ("iov_len", ctypes.c_size_t)]
+
+    class _sockaddr_in(ctypes.Structure):
+        _fields_ = [("sin_family", ctypes.c_ushort),
+                    ("sin_port", ctypes.c_ushort),
+                    ("sin_addr", ctypes.c_uint32),
+                    ("sin_zero", ctypes.c_char * 8)]
+
+    class _msghdr(ctypes.Structure):
+        _fields_ = [("msg_name", ctypes.c_void_p),
+                    ("msg_namelen", ctypes.c_uint32),
+                    ("msg_iov", ctypes.POINTER(_iovec)),
+                    ("msg_iovlen", ctypes.c_size_t),
+                    ("msg_control", ctypes.c_void_p),
+                    ("msg_controllen", ctypes.c_size_t),
+                    ("msg_flags", ctypes.c_int)]
+
+    class _mmsghdr(ctypes.Structure):
+        _fields_ = [("msg_hdr", _msghdr),
+                    ("msg_len", ctypes.c_uint)]
+
+    _libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _libc.recvmmsg.restype = ctypes.c_int
+    _libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int]
+    _libc.sendmmsg.restype = ctypes.c_int
+
+    class MMsgSocket(object):
+        """
+        Receives and sends batches of IPv4 UDP datagrams using recvmmsg and sendmmsg.
+
+        The receive buffers, COUNT datagrams of SIZE bytes each, are allocated once.
+        """
+        def __init__(self, sock, count, size):
+            assert isinstance(count, int)
+            assert count > 0
+            assert isinstance(size, int)
+            assert size > 0
+            self._fileno = sock.fileno()
+            self._count = count
+            self._size = size
+            self._buffer = ctypes.create_string_buffer(count * size)
+            self._addresses = (_sockaddr_in * count)()
+            self._iovecs = (_iovec * count)()
+            self._messages = (_mmsghdr * count)()
+
+            address = ctypes.addressof(self._buffer)
+            for index in xrange(count):
+                self._iovecs[index].iov_base = address + index * size
+                self._iovecs[index].iov_len = size
+                header = self._messages[index].msg_hdr
+                header.msg_name = ctypes.addressof(self._addresses[index])
+                header.msg_iov = ctypes.pointer(self._iovecs[index])
+                header.msg_iovlen = 1
+
+        @property
+        def count(self):
+            return self._count
+
+        def recv(self):
+            """
+            Returns a list with up to COUNT (sock_addr, data) tuples, or an empty list when no
+            datagrams are available.
+
+            Datagrams that were larger than SIZE bytes are truncated, these are returned with
+            None as data.
+            """
+            for index in xrange(self._count):
+                header = self._messages[index].msg_hdr
+                header.msg_namelen = ctypes.sizeof(_sockaddr_in)
+                header.msg_flags = 0
+
+            received = _libc.recvmmsg(self._fileno, self._messages, self._count, 0, None)
+            if received < 0:
+                code = ctypes.get_errno()
+                if code == errno.EAGAIN or code == errno.EWOULDBLOCK:
+                    return []
+                raise socket.error(code, errno.errorcode.get(code, "recvmmsg"))
+
+            address = ctypes.addressof(self._buffer)
+            packets = []
+            for index in xrange(received):
+                message = self._messages[index]
+                sockaddr = self._addresses[index]
+                sock_addr = (socket.inet_ntoa(_struct_in_addr.pack(sockaddr.sin_addr)), socket.ntohs(sockaddr.sin_port))
+                if message.msg_hdr.msg_flags & MSG_TRUNC:
+                    packets.append((sock_addr, None))
+                else:
+                    packets.append((sock_addr, ctypes.string_at(address + index * self._size, message.msg_len)))
+            return packets
+
+        def send(self, batch):
+            """
+            Sends up to COUNT (sock_addr, data) tuples from BATCH and returns the number of
+            datagrams that were sent.
+
+            Raises socket.error when not a single datagram could be sent.
+            """
+            count = min(len(batch), self._count)
+            addresses = (_sockaddr_in * count)()
+            iovecs = (_iovec * count)()
+            messages = (_mmsghdr * count)()
+            for index in xrange(count):
+                (ip, port), data = batch[index]
+                addresses[index].sin_family = socket.AF_INET
+                addresses[index].sin_port = socket.htons(port)
+                addresses[index].sin_addr, = _struct_in_addr.unpack(socket.inet_aton(ip))
+                # DATA is referenced from BATCH until sendmmsg returns
+                iovecs[index].iov_base = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+                iovecs[index].iov_len = len(data)
+                header = messages[index].msg_hdr
+                header.msg_name = ctypes.addressof(addresses[index])
+                header.msg_namelen = ctypes.sizeof(_sockaddr_in)
+                header.msg_iov = ctypes.pointer(iovecs[index])
+                header.msg_iovlen = 1
+
+            sent = _libc.sendmmsg(self._fileno, messages, count, 0)
+            if sent < 0:
+                code = ctypes.get_errno()
+                raise socket.error(code, errno.errorcode.get(code, "sendmmsg"))
+            return sent
+
+else:
+    MMsgSocket = None
+
+class SendQueue(object):
+    """
+    A queue with (sock_addr, data) tuples that are waiting to be sent.
+
+    Packets are taken by priority.  Within a priority, destinations take turns, one packet each, so
+    a large response to one destination does not delay the packets to all others.  When RATE is
+    given, a token bucket limits the number of bytes taken to RATE bytes per second, allowing bursts
+    of BURST bytes.  When the queue contains MAX_LENGTH packets, new packets are dropped.
+    """
+    def __init__(self, rate=0, burst=65536, max_length=50000):
+        assert isinstance(rate, (int, long, float)), type(rate)
+        assert rate >= 0, rate
+        assert isinstance(burst, (int, long)), type(burst)
+        assert burst > 0, burst
+        assert isinstance(max_length, int), type(max_length)
+        assert max_length > 0, max_length
+        # for each priority: a deque with the destinations that have packets queued, in turn, and a
+        # dictionary with sock_addr:deque-of-packets pairs
+        self._priorities = [(deque(), {}) for _ in xrange(PRIORITY_LOW + 1)]
+        self._length = 0
+        self._max_length = max_length
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._timestamp = time()
+        # _taken contains (priority, sock_addr, data) tuples for the packets that were returned by
+        # the last call to take
+        self._taken = []
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def delay(self):
+        """
+        The number of seconds until the token bucket allows packets to be taken.
+        """
+        if self._rate and self._tokens <= 0:
+            return (1 - self._tokens) / float(self._rate)
+        return 0.0
+
+    def put(self, sock_addr, data, priority=PRIORITY_NORMAL):
+        """
+        Queue DATA for SOCK_ADDR.  Returns False when the packet was dropped because the queue is
+        full.
+        """
+        assert PRIORITY_HIGH <= priority <= PRIORITY_LOW, priority
+        if self._length >= self._max_length:
+            return False
+
+        turns, queues = self._priorities[priority]
+        queue = queues.get(sock_addr)
+        if queue is None:
+            queue = queues[sock_addr] = deque()
+            turns.append(sock_addr)
+        queue.append(data)
+        self._length += 1
+        return True
+
+    def take(self, count):
+        """
+        Remove and return up to COUNT (sock_addr, data) tuples.
+
+        Packets that could not be sent must be returned to the queue using restore.
+        """
+        if self._rate:
+            now = time()
+            self._tokens = min(self._burst, self._tokens + (now - self._timestamp) * self._rate)
+            self._timestamp = now
+
+        taken = []
+        for priority, (turns, queues) in enumerate(self._priorities):
+            while turns and len(taken) < count and not (self._rate and self._tokens <= 0):
+                sock_addr = turns[0]
+                queue = queues[sock_addr]
+                data = queue.popleft()
+                taken.append((priority, sock_addr, data))
+                self._tokens -= len(data)
+
+                if queue:
+                    # next destination's turn
+                    turns.rotate(-1)
+                else:
+                    turns.popleft()
+                    del queues[sock_addr]
+
+        self._length -= len(taken)
+        self._taken = taken
+        return [(sock_addr, data) for _, sock_addr, data in taken]
+
+    def restore(self, sent):
+        """
+        Return all but the first SENT packets of the last take to the front of the queue.
+        """
+        assert 0 <= sent <= len(self._taken), [sent, len(self._taken)]
+        for priority, sock_addr, data in reversed(self._taken[sent:]):
+            turns, queues = self._priorities[priority]
+            queue = queues.get(sock_addr)
+            if queue is None:
+                queue = queues[sock_addr] = deque()
+                turns.appendleft(sock_addr)
+            queue.appendleft(data)
+            self._tokens += len(data)
+            self._length += 1
+        self._taken = []
+
 class Endpoint(object):
     def __init__(self):
         self._total_up = 0
         self._total_down = 0
         self._total_send = 0
         self._cur_sendqueue = 0
+        self._total_recv = 0
+        self._recv_syscalls = 0
+        self._send_syscalls = 0
+        self._total_send_dropped = 0
 
     @property
     def total_up(self):
@@ -50,16 +314,40 @@ class Endpoint(object):
     def cur_sendqueue(self):
         return self._cur_sendqueue
 
+    @property
+    def total_recv(self):
+        "The number of datagrams that were received."
+        return self._total_recv
+
+    @property
+    def recv_syscalls(self):
+        "The number of system calls that were made to receive datagrams."
+        return self._recv_syscalls
+
+    @property
+    def send_syscalls(self):
+        "The number of system calls that were made to send datagrams."
+        return self._send_syscalls
+
+    @property
+    def total_send_dropped(self):
+        "The number of packets that were dropped because the sendqueue was full."
+        return self._total_send_dropped
+
     def reset_statistics(self):
         self._total_up = 0
         self._total_down = 0
         self._total_send = 0
         self._cur_sendqueue = 0
+        self._total_recv = 0
+        self._recv_syscalls = 0
+        self._send_syscalls = 0
+        self._total_send_dropped = 0
 
     def get_address(self):
         raise NotImplementedError()
 
-    def send(self, candidates, packets):
+    def send(self, candidates, packets, priority=PRIORITY_NORMAL):
         raise NotImplementedError()
 
 class DummyEndpoint(Endpoint):
@@ -75,11 +363,11 @@ class DummyEndpoint(Endpoint):
     def get_address(self):
         return ("0.0.0.0", 0)
 
-    def send(self, candidates, packets):
+    def send(self, candidates, packets, priority=PRIORITY_NORMAL):
         if __debug__: dprint("Thrown away ", sum(len(data) for data in packets), " bytes worth of outgoing data to ", ",".join(str(candidate) for candidate in candidates), level="warning")
 
 class RawserverEndpoint(Endpoint):
-    def __init__(self, rawserver, dispersy, port, ip="0.0.0.0"):
+    def __init__(self, rawserver, dispersy, port, ip="0.0.0.0", send_rate=0):
         super(RawserverEndpoint, self).__init__()
 
         while True:
@@ -97,7 +385,7 @@ class RawserverEndpoint(Endpoint):
         self._dispersy = dispersy
         
         self._sendqueue_lock = threading.RLock()
-        self._sendqueue = []
+        self._sendqueue = SendQueue(send_rate)
 
     def get_address(self):
         return self._socket.getsockname()
@@ -109,6 +397,7 @@ class RawserverEndpoint(Endpoint):
         # sometimes called without any packets...
         if packets:
             self._total_down += sum(len(data) for _, data in packets)
+            self._total_recv += len(packets)
 
             if DEBUG:
                 for sock_addr, data in packets:
@@ -135,12 +424,13 @@ class RawserverEndpoint(Endpoint):
                                            True,
                                            timestamp)
 
-    def send(self, candidates, packets):
+    def send(self, candidates, packets, priority=PRIORITY_NORMAL):
         assert isinstance(candidates, (tuple, list, set)), type(candidates)
         assert all(isinstance(candidate, Candidate) for candidate in candidates)
         assert isinstance(packets, (tuple, list, set)), type(packets)
         assert all(isinstance(packet, str) for packet in packets)
         assert all(len(packet) > 0 for packet in packets)
+        assert PRIORITY_HIGH <= priority <= PRIORITY_LOW, priority
 
         self._total_up += sum(len(data) for data in packets) * len(candidates)
         self._total_send += (len(packets) * len(candidates))
@@ -148,17 +438,22 @@ class RawserverEndpoint(Endpoint):
         wan_address = self._dispersy.wan_address
 
         with self._sendqueue_lock:
-            batch = [(candidate.get_destination_address(wan_address), TUNNEL_PREFIX + data if candidate.tunnel else data)
-                     for candidate, data
-                     in product(candidates, packets)]
-
-            if len(batch) > 0:
-                did_have_senqueue = bool(self._sendqueue)
-                self._sendqueue.extend(batch)
-                
+            did_have_senqueue = bool(self._sendqueue)
+            put = self._sendqueue.put
+            queued = 0
+            for candidate, data in product(candidates, packets):
+                if put(candidate.get_destination_address(wan_address), TUNNEL_PREFIX + data if candidate.tunnel else data, priority):
+                    queued += 1
+                else:
+                    self._total_send_dropped += 1
+                    self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, u"sendqueue-full")
+
+            if queued:
                 # If we did not already a sendqueue, then we need to call process_sendqueue in order send these messages
                 if not did_have_senqueue:    
                     self._process_sendqueue()
+                else:
+                    self._cur_sendqueue = len(self._sendqueue)
             
                 # return True when something has been send
                 return True
@@ -168,45 +463,72 @@ class RawserverEndpoint(Endpoint):
     def _process_sendqueue(self):
         with self._sendqueue_lock:
             if self._sendqueue:
-                index = 0
                 NUM_PACKETS = min(max(50, len(self._sendqueue) / 10), len(self._sendqueue))
                 if DEBUG:
                     print >> sys.stderr, "endpoint:", len(self._sendqueue), "left in queue, trying to send", NUM_PACKETS
                 
-                for i in xrange(NUM_PACKETS):
-                    sock_addr, data = self._sendqueue[i]
-                    try:
-                        self._socket.sendto(data, sock_addr)
-                        if DEBUG:
-                            try:
-                                name = self._dispersy.convert_packet_to_meta_message(data, load=False, auto_load=False).name
-                            except:
-                                name = "???"
-                            print >> sys.stderr, "endpoint: %.1f %30s -> %15s:%-5d %4d bytes" % (time(), name, sock_addr[0], sock_addr[1], len(data))
-                            self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, name)
-                            
-                        index += 1
-    
-                    except socket.error, e:
-                        if e[0] != SOCKET_BLOCK_ERRORCODE:
-                            if DEBUG:
-                                print >> sys.stderr, long(time()), "endpoint: could not send", len(data), "to", sock_addr, len(self._sendqueue)
-                                print_exc()
-                                
-                        self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, u"socket-error")
-                        break
-    
-                self._sendqueue = self._sendqueue[index:]
+                batch = self._sendqueue.take(NUM_PACKETS)
+                index = self._send_batch(batch) if batch else 0
+                self._sendqueue.restore(index)
                 if self._sendqueue:
-                    # And schedule a new attempt
-                    self._add_task(self._process_sendqueue, 0.1, "process_sendqueue")
+                    # And schedule a new attempt, either when the socket is no longer blocking or
+                    # when the bandwidth limit allows more packets
+                    self._add_task(self._process_sendqueue, 0.1 if index < len(batch) else self._sendqueue.delay, "process_sendqueue")
                     if DEBUG:
                         print >> sys.stderr, "endpoint:", len(self._sendqueue), "left in queue"
                 
                 self._cur_sendqueue = len(self._sendqueue)
-                
+
+    def _send_batch(self, batch):
+        """
+        Sends the (sock_addr, data) tuples in BATCH, one sendto call each, and returns the number of
+        datagrams that were sent.
+        """
+        index = 0
+        for sock_addr, data in batch:
+            try:
+                self._send_syscalls += 1
+                self._socket.sendto(data, sock_addr)
+                if DEBUG:
+                    try:
+                        name = self._dispersy.convert_packet_to_meta_message(data, load=False, auto_load=False).name
+                    except:
+                        name = "???"
+                    print >> sys.stderr, "endpoint: %.1f %30s -> %15s:%-5d %4d bytes" % (time(), name, sock_addr[0], sock_addr[1], len(data))
+                    self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, name)
+
+                index += 1
+
+            except socket.error, e:
+                if e[0] != SOCKET_BLOCK_ERRORCODE:
+                    if DEBUG:
+                        print >> sys.stderr, long(time()), "endpoint: could not send", len(data), "to", sock_addr, len(self._sendqueue)
+                        print_exc()
+
+                self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, u"socket-error")
+                break
+
+        return index
+
 class StandaloneEndpoint(RawserverEndpoint):
-    def __init__(self, dispersy, port, ip="0.0.0.0"):
+    def __init__(self, dispersy, port, ip="0.0.0.0", bulk=False, batch_size=64, datagram_size=65535, rcvbuf=870400, send_rate=0):
+        """
+        Create a UDP endpoint that uses its own thread.
+
+        When BULK is True, and the platform supports recvmmsg and sendmmsg, up to BATCH_SIZE
+        datagrams are received or sent using a single system call.  DATAGRAM_SIZE bytes are
+        reserved to receive each datagram, larger datagrams are dropped.  Otherwise datagrams are
+        received and sent one system call each.
+
+        RCVBUF sets the size of the kernel receive buffer.  SEND_RATE limits the outgoing bandwidth,
+        in bytes per second, zero is unlimited.
+        """
+        assert isinstance(bulk, bool), type(bulk)
+        assert isinstance(batch_size, int), type(batch_size)
+        assert batch_size > 0, batch_size
+        assert isinstance(datagram_size, int), type(datagram_size)
+        assert 0 < datagram_size <= 65535, datagram_size
+        assert isinstance(rcvbuf, int), type(rcvbuf)
         Endpoint.__init__(self)
         
         self._running = True
@@ -217,7 +539,7 @@ class StandaloneEndpoint(RawserverEndpoint):
         while True:
             try:
                 self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 870400)
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
                 self._socket.bind((ip, port))
                 self._socket.setblocking(0)
                 if __debug__: dprint("Listening at ", port)
@@ -228,7 +550,17 @@ class StandaloneEndpoint(RawserverEndpoint):
         
         self._add_task = lambda task, delay = 0.0, id = "": None 
         self._sendqueue_lock = threading.RLock()
-        self._sendqueue = []
+        self._sendqueue = SendQueue(send_rate)
+
+        if bulk and MMsgSocket:
+            self._mmsg = MMsgSocket(self._socket, batch_size, datagram_size)
+            self._receive = self._receive_mmsg
+            self._send_batch = self._send_batch_mmsg
+            if __debug__: dprint("using recvmmsg and sendmmsg with ", batch_size, " datagrams per call")
+        else:
+            self._mmsg = None
+            if __debug__:
+                if bulk: dprint("recvmmsg and sendmmsg are not available, using recvfrom and sendto", level="warning")
 
     def start(self):
         self._thread.start()
@@ -238,7 +570,7 @@ class StandaloneEndpoint(RawserverEndpoint):
         self._thread.join(timeout)
 
     def _loop(self, port, ip):
-        recvfrom = self._socket.recvfrom
+        receive = self._receive
         socket_list = [self._socket.fileno()]
         
         prev_sendqueue = 0
@@ -256,21 +588,112 @@ class StandaloneEndpoint(RawserverEndpoint):
                 prev_sendqueue = time()
                 
             if read_list:
-                packets = []
-                try:
-                    while True:
-                        (data, sock_addr) = recvfrom(65535)
-                        if data:
-                            packets.append((sock_addr, data))
-                        else:
-                            break
-                        
-                except socket.error, e:
-                    self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, u"socket-error-'%s'"%str(e))
-                        
-                finally:
-                    if packets:
-                        self.data_came_in(packets)
+                receive()
+
+    def _receive(self):
+        """
+        Receives all available datagrams, one recvfrom call each.
+        """
+        recvfrom = self._socket.recvfrom
+        packets = []
+        try:
+            while True:
+                self._recv_syscalls += 1
+                (data, sock_addr) = recvfrom(65535)
+                if data:
+                    packets.append((sock_addr, data))
+                else:
+                    break
+
+        except socket.error, e:
+            self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, u"socket-error-'%s'"%str(e))
+
+        finally:
+            if packets:
+                self.data_came_in(packets)
+
+    def _receive_mmsg(self):
+        """
+        Receives all available datagrams, up to BATCH_SIZE per recvmmsg call.
+        """
+        recv = self._mmsg.recv
+        count = self._mmsg.count
+        packets = []
+        try:
+            while True:
+                self._recv_syscalls += 1
+                batch = recv()
+                for sock_addr, data in batch:
+                    if data:
+                        packets.append((sock_addr, data))
+                    else:
+                        self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, u"truncated")
+                # when fewer than COUNT datagrams were available the socket is drained
+                if len(batch) < count:
+                    break
+
+        except socket.error, e:
+            self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, u"socket-error-'%s'"%str(e))
+
+        finally:
+            if packets:
+                self.data_came_in(packets)
+
+    def _send_batch_mmsg(self, batch):
+        """
+        Sends the (sock_addr, data) tuples in BATCH, up to BATCH_SIZE per sendmmsg call, and
+        returns the number of datagrams that were sent.
+        """
+        index = 0
+        while index < len(batch):
+            chunk = batch[index:index + self._mmsg.count]
+            try:
+                self._send_syscalls += 1
+                sent = self._mmsg.send(chunk)
+
+            except socket.error, e:
+                if e[0] != SOCKET_BLOCK_ERRORCODE:
+                    if DEBUG:
+                        print >> sys.stderr, long(time()), "endpoint: could not send", len(batch) - index, "datagrams", len(self._sendqueue)
+                        print_exc()
+
+                self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_send, u"socket-error")
+                break
+
+            index += sent
+            # the kernel accepted only part of the batch, the send buffer is full
+            if sent < len(chunk):
+                break
+
+        return index
+
+class EpollEndpoint(StandaloneEndpoint):
+    """
+    A UDP endpoint that is handled on the Dispersy callback thread.
+
+    The socket is registered with the callback, which waits for it using epoll, hence incoming
+    packets are handled immediately, without a separate thread or polling timeout.  Available on
+    Linux only.
+    """
+    def __init__(self, dispersy, port, ip="0.0.0.0", **kargs):
+        super(EpollEndpoint, self).__init__(dispersy, port, ip, **kargs)
+        callback = dispersy.callback
+        # retry sending the remaining sendqueue later, persistent_register ensures that only one
+        # attempt is scheduled at any time
+        self._add_task = lambda task, delay = 0.0, id = "": callback.persistent_register(id, task, delay=delay)
+
+    def start(self):
+        self._dispersy.callback.register_reader(self._socket.fileno(), self._receive)
+
+    def stop(self, timeout=10.0):
+        self._dispersy.callback.unregister_reader(self._socket.fileno())
+
+    def data_came_in(self, packets):
+        # called on the callback thread, hence the packets are handled immediately instead of
+        # registering dispersythread_data_came_in
+        self._total_down += sum(len(data) for _, data in packets)
+        self._total_recv += len(packets)
+        self.dispersythread_data_came_in(packets, time())
 
 class TunnelEndpoint(Endpoint):
     def __init__(self, swift_process, dispersy):
@@ -290,7 +713,7 @@ class TunnelEndpoint(Endpoint):
     def get_address(self):
         return ("0.0.0.0", self._swift.listenport)
 
-    def send(self, candidates, packets):
+    def send(self, candidates, packets, priority=PRIORITY_NORMAL):
         assert isinstance(candidates, (tuple, list, set)), type(candidates)
         assert all(isinstance(candidate, Candidate) for candidate in candidates)
         assert isinstance(packets, (tuple, list, set)), type(packets)
@@ -337,6 +760,7 @@ class TunnelEndpoint(Endpoint):
             self._dispersy.statistics.dict_inc(self._dispersy.statistics.endpoint_recv, name)
             
         self._total_down += len(data)
+        self._total_recv += 1
         self._dispersy.callback.register(self.dispersythread_data_came_in, (sock_addr, data, time()))
 
     def dispersythread_data_came_in(self, sock_addr, data, timestamp):
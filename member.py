@@ -24,6 +24,7 @@ def cleanup():
     - Clears _cache from all DummyMember subclasses
     - Clears _mid_cache from all DummyMember subclasses
     - Clears _did_cache from all DummyMember subclasses
+    - Clears the public_keys and verified_signatures caches
     """
     def clear(cls):
         if hasattr(cls, "_cache"):
@@ -37,6 +38,118 @@ def cleanup():
             clear(subcls)
     
     clear(DummyMember)
+    public_keys.clear()
+    verified_signatures.clear()
+
+def set_cache_lengths(member_length=None, key_length=None):
+    """
+    Change the number of Member instances (hot) and parsed public keys (warm) that are cached.
+    """
+    assert member_length is None or (isinstance(member_length, int) and member_length > 0), member_length
+    assert key_length is None or (isinstance(key_length, int) and key_length > 0), key_length
+    if member_length:
+        Member._cache_length = member_length
+        Member._trim_cache()
+    if key_length:
+        public_keys.set_length(key_length)
+
+class PublicKeyCache(object):
+    """
+    A bounded LRU cache with parsed public keys, by their binary format.
+
+    Member instances are cached in Member._cache (hot), this cache (warm) holds the parsed keys of
+    many more members, allowing these members to be created again without parsing their key.
+    """
+    def __init__(self, length=16384):
+        assert isinstance(length, int)
+        assert length > 0
+        self._length = length
+        # _keys contains public_key:ec pairs, least recently used first
+        self._keys = OrderedDict()
+        # the number of lookups that were, or were not, found in the cache and the number of keys
+        # that were evicted
+        self.hit = 0
+        self.miss = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, public_key):
+        """
+        Returns the parsed PUBLIC_KEY, parsing it when it is not cached.
+        """
+        ec = self._keys.pop(public_key, None)
+        if ec is None:
+            self.miss += 1
+            ec = ec_from_public_bin(public_key)
+            self._keys[public_key] = ec
+            if len(self._keys) > self._length:
+                self._evict()
+
+        else:
+            self.hit += 1
+            # move PUBLIC_KEY to the most recently used position
+            self._keys[public_key] = ec
+
+        return ec
+
+    def set_length(self, length):
+        self._length = length
+        while len(self._keys) > self._length:
+            self._evict()
+
+    def clear(self):
+        self._keys.clear()
+
+    def _evict(self):
+        self._keys.popitem(False)
+        self.evictions += 1
+
+# parsed public keys, used by MemberBase
+public_keys = PublicKeyCache()
+
+class VerifiedSignatureCache(object):
+    """
+    A bounded LRU cache with the (mid, digest, signature) keys of recently verified signatures.
+
+    We often receive the exact same signed packet multiple times, i.e. because of bloom filter false
+    positives or forwarding.  Only valid signatures are cached, hence a hit can skip ECDSA
+    verification entirely.
+    """
+    def __init__(self, length=4096):
+        assert isinstance(length, int)
+        assert length > 0
+        self._length = length
+        self._keys = OrderedDict()
+        # the number of lookups that were, or were not, found in the cache
+        self.hit = 0
+        self.miss = 0
+
+    def __contains__(self, key):
+        if key in self._keys:
+            # move KEY to the most recently used position
+            del self._keys[key]
+            self._keys[key] = None
+            self.hit += 1
+            return True
+
+        self.miss += 1
+        return False
+
+    def add(self, key):
+        """
+        Add KEY, a (mid, digest, signature) tuple, after its signature was successfully verified.
+        """
+        self._keys[key] = None
+        if len(self._keys) > self._length:
+            self._keys.popitem(False)
+
+    def clear(self):
+        self._keys.clear()
+
+# verified signatures, used by Member.verify
+verified_signatures = VerifiedSignatureCache()
 
 class DummyMember(object):
     def __init__(self, mid):
@@ -186,7 +299,7 @@ class MemberBase(DummyMember):
             self._mid = mid
             self._public_key = public_key
             self._private_key = private_key
-            self._ec = ec_from_private_bin(private_key) if private_key else ec_from_public_bin(public_key)
+            self._ec = ec_from_private_bin(private_key) if private_key else public_keys.get(public_key)
             self._signature_length = ec_signature_length(self._ec)
             self._tags = [tag for tag in tags.split(",") if tag]
             self._has_identity = set()
@@ -309,9 +422,16 @@ class MemberBase(DummyMember):
         assert isinstance(signature, str)
         assert isinstance(offset, (int, long))
         assert isinstance(length, (int, long))
-        return self._public_key and \
-               self._signature_length == len(signature) \
-               and ec_verify(self._ec, sha1(data[offset:offset+(length or len(data))]).digest(), signature)
+        if self._public_key and self._signature_length == len(signature):
+            key = (self._mid, sha1(data[offset:offset+(length or len(data))]).digest(), signature)
+            if key in verified_signatures:
+                return True
+
+            if ec_verify(self._ec, key[1], signature):
+                verified_signatures.add(key)
+                return True
+
+        return False
 
     def sign(self, data, offset=0, length=0):
         """
@@ -352,11 +472,44 @@ class MemberBase(DummyMember):
         return "<%s %d %s>" % (self.__class__.__name__, self._database_id, self._mid.encode("HEX"))
 
 class Member(MemberBase):
+    # _cache contains public_key:Member pairs, least recently used first.  _mid_cache and
+    # _did_cache index the same Member instances by mid and by database id
     _cache_length = 1024
     _cache = OrderedDict()
     _mid_cache = {}
     _did_cache = {}
 
+    # the number of lookups that were, or were not, found in the cache and the number of Member
+    # instances that were evicted, for all Member subclasses together
+    cache_hit = 0
+    cache_miss = 0
+    cache_evictions = 0
+
+    @classmethod
+    def _cache_lookup(cls, cache, key):
+        member = cache.get(key)
+        if member is None:
+            Member.cache_miss += 1
+        else:
+            Member.cache_hit += 1
+            # move MEMBER to the most recently used position
+            public_key = member._public_key
+            del cls._cache[public_key]
+            cls._cache[public_key] = member
+        return member
+
+    @classmethod
+    def _trim_cache(cls):
+        while len(cls._cache) > cls._cache_length:
+            _, replaced_member = cls._cache.popitem(False)
+            del cls._mid_cache[replaced_member._mid]
+            del cls._did_cache[replaced_member._database_id]
+            Member.cache_evictions += 1
+
+        for subcls in cls.__subclasses__():
+            if not subcls._cache is cls._cache:
+                subcls._trim_cache()
+
     def __new__(cls, public_key, private_key=""):
         assert isinstance(public_key, str)
         assert isinstance(private_key, str)
@@ -364,7 +517,7 @@ class Member(MemberBase):
         assert private_key == "" or ec_check_private_bin(private_key), [len(private_key), private_key.encode("HEX")]
 
         # retrieve Member from cache (based on public_key)
-        return cls._cache.get(public_key) or object.__new__(cls)
+        return cls._cache_lookup(cls._cache, public_key) or object.__new__(cls)
 
     def __init__(self, public_key, private_key=""):
         super(Member, self).__init__(public_key, private_key)
@@ -382,11 +535,10 @@ class Member(MemberBase):
         self._did_cache[self._database_id] = self
         
         if len(self._cache) > self._cache_length:
-            replaced_member = self._cache.popitem(False)
-            if replaced_member:
-                replaced_member = replaced_member[1]
-                del self._mid_cache[replaced_member._mid]
-                del self._did_cache[replaced_member._database_id]
+            _, replaced_member = self._cache.popitem(False)
+            del self._mid_cache[replaced_member._mid]
+            del self._did_cache[replaced_member._database_id]
+            Member.cache_evictions += 1
                 
         assert len(self._cache) == len(self._mid_cache) and len(self._mid_cache) == len(self._did_cache), "Cache sizes are not synchronized after inserting (%s-%s) (%d,%d,%d)"%(type(self), str(self), len(self._cache), len(self._mid_cache), len(self._did_cache))
 
@@ -396,8 +548,9 @@ class MemberFromId(Member):
         assert len(mid) == 20
         
         # retrieve Member from cache (based on mid)
-        if mid in cls._mid_cache:
-            return cls._mid_cache[mid]
+        member = cls._cache_lookup(cls._mid_cache, mid)
+        if member:
+            return member
         
         # prevent __init__ and hence caching this instance
         raise LookupError(mid)
@@ -406,8 +559,9 @@ class MemberFromDatabaseId(Member):
     def __new__(cls, database_id):
         assert isinstance(database_id, (int, long)), type(database_id)
         
-        if database_id in cls._did_cache:
-            return cls._did_cache[database_id]
+        member = cls._cache_lookup(cls._did_cache, database_id)
+        if member:
+            return member
 
         # prevent __init__ and hence caching this instance
         raise LookupError(database_id)
@@ -1,3 +1,5 @@
+from hashlib import sha1
+
 from .member import DummyMember
 from .meta import MetaObject
 from .revision import update_revision_information
@@ -303,6 +305,13 @@ class Packet(MetaObject.Implementation):
     def packet(self):
         return self._packet
 
+    @property
+    def packet_digest(self):
+        """
+        The sha1 digest of the packet.  This is the key used in the sync bloom filters.
+        """
+        return sha1(self._packet).digest()
+
     # @property
     def __get_packet_id(self):
         return self._packet_id
@@ -35,7 +35,7 @@ class Payload(MetaObject):
 
 class IntroductionRequestPayload(Payload):
     class Implementation(Payload.Implementation):
-        def __init__(self, meta, destination_address, source_lan_address, source_wan_address, advice, connection_type, sync, identifier):
+        def __init__(self, meta, destination_address, source_lan_address, source_wan_address, advice, connection_type, sync, identifier, digest=False):
             """
             Create the payload for an introduction-request message.
 
@@ -72,6 +72,9 @@ class IntroductionRequestPayload(Payload):
 
             IDENTIFIER is a number that must be given in the associated introduction-response.  This
             number allows to distinguish between multiple introduction-response messages.
+
+            DIGEST is a boolean value.  When True the BLOOM_FILTER contains the sha1 digests of the
+            packets instead of the packets themselves.
             """
             assert is_address(destination_address), destination_address
             assert is_address(source_lan_address), source_lan_address
@@ -82,6 +85,7 @@ class IntroductionRequestPayload(Payload):
             assert sync is None or len(sync) == 5, sync
             assert isinstance(identifier, int), identifier
             assert 0 <= identifier < 2**16, identifier
+            assert isinstance(digest, bool), digest
             super(IntroductionRequestPayload.Implementation, self).__init__(meta)
             self._destination_address = destination_address
             self._source_lan_address = source_lan_address
@@ -89,6 +93,7 @@ class IntroductionRequestPayload(Payload):
             self._advice = advice
             self._connection_type = connection_type
             self._identifier = identifier
+            self._digest = digest
             if sync:
                 self._time_low, self._time_high, self._modulo, self._offset, self._bloom_filter = sync
                 assert isinstance(self._time_low, (int, long))
@@ -151,13 +156,17 @@ class IntroductionRequestPayload(Payload):
         def bloom_filter(self):
             return self._bloom_filter
 
+        @property
+        def digest(self):
+            return self._digest
+
         @property
         def identifier(self):
             return self._identifier
 
 class IntroductionResponsePayload(Payload):
     class Implementation(Payload.Implementation):
-        def __init__(self, meta, destination_address, source_lan_address, source_wan_address, lan_introduction_address, wan_introduction_address, connection_type, tunnel, identifier):
+        def __init__(self, meta, destination_address, source_lan_address, source_wan_address, lan_introduction_address, wan_introduction_address, connection_type, tunnel, identifier, digest=False):
             """
             Create the payload for an introduction-response message.
 
@@ -188,6 +197,9 @@ class IntroductionResponsePayload(Payload):
             IDENTIFIER is a number that was given in the associated introduction-request.  This
             number allows to distinguish between multiple introduction-response messages.
 
+            DIGEST is a boolean value.  When True the sender understands sync bloom filters that
+            contain the sha1 digests of the packets.
+
             When the associated request wanted advice the sender will also sent a puncture-request
             message to either the lan_introduction_address or the wan_introduction_address
             (depending on their positions).  The introduced node must sent a puncture message to the
@@ -202,6 +214,7 @@ class IntroductionResponsePayload(Payload):
             assert isinstance(tunnel, bool)
             assert isinstance(identifier, int)
             assert 0 <= identifier < 2**16
+            assert isinstance(digest, bool), digest
             super(IntroductionResponsePayload.Implementation, self).__init__(meta)
             self._destination_address = destination_address
             self._source_lan_address = source_lan_address
@@ -211,6 +224,7 @@ class IntroductionResponsePayload(Payload):
             self._connection_type = connection_type
             self._tunnel = tunnel
             self._identifier = identifier
+            self._digest = digest
 
         @property
         def destination_address(self):
@@ -244,6 +258,10 @@ class IntroductionResponsePayload(Payload):
         def identifier(self):
             return self._identifier
 
+        @property
+        def digest(self):
+            return self._digest
+
 class PunctureRequestPayload(Payload):
     class Implementation(Payload.Implementation):
         def __init__(self, meta, lan_walker_address, wan_walker_address, identifier):
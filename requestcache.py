@@ -1,10 +1,12 @@
 from random import random
+from time import time
+
+from .dprint import dprint
 from .revision import update_revision_information
 
 if __debug__:
     def identifier_to_string(identifier):
         return identifier.encode("HEX") if isinstance(identifier, str) else identifier
-    from .dprint import dprint
 
 # update version information directly from SVN
 update_revision_information("$HeadURL$", "$Revision$")
@@ -22,10 +24,151 @@ class Cache(object):
     def __str__(self):
         return "<%s>" % self.__class__.__name__
 
+class TimingWheel(object):
+    """
+    A hierarchical timing wheel.
+
+    Keys are scheduled with a deadline and are returned by expire(...) once that deadline has
+    passed.  Deadlines are rounded up to RESOLUTION seconds, hence keys expire at most RESOLUTION
+    seconds late and never early.
+
+    Level 0 contains SLOTS buckets of one tick each, every next level contains SLOTS buckets that
+    are SLOTS times wider.  Whenever the wheel passes a bucket boundary on a higher level, the keys
+    in that bucket are moved down to a lower level.  Keys that are further away than the highest
+    level can hold are placed in its last bucket and moved down again until they expire.
+    Scheduling and canceling a key takes constant time.
+    """
+    def __init__(self, resolution=0.5, slots=64, levels=3):
+        assert isinstance(resolution, float), type(resolution)
+        assert resolution > 0.0, resolution
+        assert isinstance(slots, int), type(slots)
+        assert slots > 1, slots
+        assert isinstance(levels, int), type(levels)
+        assert levels > 0, levels
+        self._resolution = resolution
+        self._slots = slots
+        # _widths[level] contains the number of ticks covered by each bucket on LEVEL
+        self._widths = [slots ** level for level in xrange(levels)]
+        self._buckets = [[dict() for _ in xrange(slots)] for _ in xrange(levels)]
+        # _entries contains key:[tick, value, bucket] for every scheduled key
+        self._entries = dict()
+        # _tick is the last tick that has been handled
+        self._tick = 0
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def schedule(self, key, deadline, value, now):
+        """
+        Schedule KEY to expire at DEADLINE, replacing the existing deadline of KEY if any.
+
+        VALUE is returned together with KEY once it expires.  NOW must be the current time.
+        """
+        assert isinstance(deadline, float), type(deadline)
+        assert isinstance(now, float), type(now)
+        if key in self._entries:
+            self.cancel(key)
+        elif not self._entries:
+            # nothing is scheduled, skip all ticks that have passed
+            self._tick = max(self._tick, int(now / self._resolution))
+
+        entry = [int(-(-deadline // self._resolution)), value, None]
+        self._entries[key] = entry
+        # keys whose deadline has already passed expire on the next tick
+        self._insert(key, entry, self._tick + 1)
+
+    def cancel(self, key):
+        """
+        Cancel KEY.  Returns True when KEY was scheduled.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        del entry[2][key]
+        return True
+
+    def expire(self, now):
+        """
+        Advance the wheel to NOW and return a list with (key, value) tuples for all keys whose
+        deadline has passed.
+        """
+        assert isinstance(now, float), type(now)
+        buckets = self._buckets
+        widths = self._widths
+        slots = self._slots
+        target = int(now / self._resolution)
+        expired = []
+
+        while self._tick < target and self._entries:
+            self._tick += 1
+            tick = self._tick
+
+            # move keys down from the higher levels, starting at the highest
+            for level in xrange(len(widths) - 1, 0, -1):
+                width = widths[level]
+                if tick % width == 0:
+                    bucket = buckets[level][(tick // width) % slots]
+                    if bucket:
+                        keys = bucket.keys()
+                        bucket.clear()
+                        for key in keys:
+                            self._insert(key, self._entries[key], tick)
+
+            bucket = buckets[0][tick % slots]
+            if bucket:
+                keys = bucket.keys()
+                bucket.clear()
+                for key in keys:
+                    entry = self._entries[key]
+                    if entry[0] <= tick:
+                        del self._entries[key]
+                        expired.append((key, entry[1]))
+                    else:
+                        # only happens to keys that were placed in the last bucket of the highest
+                        # level
+                        self._insert(key, entry, tick + 1)
+
+        if not self._entries:
+            self._tick = max(self._tick, target)
+
+        return expired
+
+    def _insert(self, key, entry, earliest):
+        # the key is placed in a bucket that expires on or after the EARLIEST tick
+        tick = self._tick
+        slots = self._slots
+        entry_tick = max(entry[0], earliest)
+
+        for level, width in enumerate(self._widths):
+            # the key must be placed in a bucket that the wheel has not yet passed
+            distance = entry_tick // width - tick // width
+            if distance < slots:
+                break
+        else:
+            distance = slots - 1
+
+        bucket = self._buckets[level][(tick // width + distance) % slots]
+        bucket[key] = None
+        entry[2] = bucket
+
 class RequestCache(object):
+    # the callback identifier for the task that drives the timing wheel
+    TIMING_WHEEL_CALLBACK_ID = "requestcache-timing-wheel"
+
     def __init__(self, callback):
         self._callback = callback
         self._identifiers = dict()
+        # the timeout and cleanup of all caches are scheduled on a single timing wheel instead of
+        # using a callback task for each cache
+        self._wheel = TimingWheel()
+        self._wheel_running = False
 
     def generate_identifier(self):
         while True:
@@ -48,7 +191,7 @@ class RequestCache(object):
         assert cache.timeout_delay > 0.0
 
         if __debug__: dprint("set ", identifier_to_string(identifier), " for ", cache, " (", cache.timeout_delay, "s timeout)")
-        self._callback.register(self._on_timeout, (identifier,), id_="requestcache-%s" % identifier, delay=cache.timeout_delay)
+        self._schedule(identifier, self._on_timeout, cache.timeout_delay)
         self._identifiers[identifier] = cache
         cache.identifier = identifier
         
@@ -60,7 +203,7 @@ class RequestCache(object):
         assert cache.timeout_delay > 0.0
 
         if __debug__: dprint("replace ", identifier_to_string(identifier), " for ", cache, " (", cache.timeout_delay, "s timeout)")
-        self._callback.replace_register("requestcache-%s" % identifier, self._on_timeout, (identifier,), delay=cache.cleanup_delay)
+        self._schedule(identifier, self._on_timeout, cache.cleanup_delay)
         self._identifiers[identifier] = cache
         cache.identifier = identifier
 
@@ -90,14 +233,47 @@ class RequestCache(object):
             if __debug__: dprint("canceling timeout on ", identifier_to_string(identifier), " for ", cache)
 
             if cache.cleanup_delay:
-                self._callback.replace_register("requestcache-%s" % identifier, self._on_cleanup, (identifier,), delay=cache.cleanup_delay)
+                self._schedule(identifier, self._on_cleanup, cache.cleanup_delay)
             
             elif identifier in self._identifiers:
-                self._callback.unregister("requestcache-%s" % identifier)
+                self._wheel.cancel(identifier)
                 del self._identifiers[identifier]
 
             return cache
 
+    def _schedule(self, identifier, func, delay):
+        now = time()
+        self._wheel.schedule(identifier, now + delay, func, now)
+        if not self._wheel_running:
+            self._wheel_running = True
+            self._callback.register(self._drive_wheel, id_=self.TIMING_WHEEL_CALLBACK_ID)
+
+    def _drive_wheel(self):
+        """
+        Fire the timeouts and cleanups of all caches whose delay has passed, every RESOLUTION
+        seconds, until the wheel is empty.
+        """
+        wheel = self._wheel
+        try:
+            while wheel:
+                yield wheel.resolution
+                expired = wheel.expire(time())
+                if __debug__ and expired: dprint(len(expired), " caches expired")
+                for identifier, func in expired:
+                    try:
+                        func(identifier)
+                    except AssertionError:
+                        # the Callback shuts down, just as it would for an assertion in any other call
+                        raise
+                    except Exception, exception:
+                        # other caches must still expire, hence the exception handlers are called
+                        # instead of stopping the wheel
+                        dprint(exception=True, level="error")
+                        self._callback._call_exception_handlers(exception, False)
+
+        finally:
+            self._wheel_running = False
+
     def _on_timeout(self, identifier):
         assert identifier in self._identifiers, identifier
         cache = self._identifiers[identifier]
@@ -105,7 +281,7 @@ class RequestCache(object):
         cache.on_timeout()
         
         if cache.cleanup_delay:
-            self._callback.replace_register("requestcache-%s" % identifier, self._on_cleanup, (identifier,), delay=cache.cleanup_delay)
+            self._schedule(identifier, self._on_cleanup, cache.cleanup_delay)
         
         elif identifier in self._identifiers:
             del self._identifiers[identifier]
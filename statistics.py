@@ -1,5 +1,6 @@
 from time import time
 
+from .member import Member, public_keys, verified_signatures
 from .revision import update_revision_information, get_revision_information
 
 # update version information directly from SVN
@@ -52,6 +53,10 @@ class DispersyStatistics(Statistics):
         self.total_down = 0
         self.total_up = 0
         self.total_send = 0
+        self.total_recv = 0
+        self.recv_syscalls = 0
+        self.send_syscalls = 0
+        self.total_send_dropped = 0
         
         # size of the sendqueue
         self.cur_sendqueue = 0
@@ -66,6 +71,20 @@ class DispersyStatistics(Statistics):
         self.walk_bootstrap_attempt = 0
         self.walk_bootstrap_success = 0
         self.walk_reset = 0
+
+        # nr of introduction requests whose sync response candidates were (not) cached
+        self.sync_response_cache_hit = 0
+        self.sync_response_cache_miss = 0
+
+        # nr of signatures that were (not) found in the verified signature cache
+        self.verify_cache_hit = 0
+        self.verify_cache_miss = 0
+        self.member_cache_hit = 0
+        self.member_cache_miss = 0
+        self.member_cache_evictions = 0
+        self.public_key_cache_hit = 0
+        self.public_key_cache_miss = 0
+        self.public_key_cache_evictions = 0
         
         self.wan_address = None
         self.update()
@@ -115,7 +134,20 @@ class DispersyStatistics(Statistics):
         self.total_down = self._dispersy.endpoint.total_down
         self.total_up = self._dispersy.endpoint.total_up
         self.total_send = self._dispersy.endpoint.total_send
+        self.total_recv = self._dispersy.endpoint.total_recv
+        self.recv_syscalls = self._dispersy.endpoint.recv_syscalls
+        self.send_syscalls = self._dispersy.endpoint.send_syscalls
+        self.total_send_dropped = self._dispersy.endpoint.total_send_dropped
         self.cur_sendqueue = self._dispersy.endpoint.cur_sendqueue
+
+        self.verify_cache_hit = verified_signatures.hit
+        self.verify_cache_miss = verified_signatures.miss
+        self.member_cache_hit = Member.cache_hit
+        self.member_cache_miss = Member.cache_miss
+        self.member_cache_evictions = Member.cache_evictions
+        self.public_key_cache_hit = public_keys.hit
+        self.public_key_cache_miss = public_keys.miss
+        self.public_key_cache_evictions = public_keys.evictions
         
         self.communities = [community.statistics for community in self._dispersy.get_communities()]
         for community in self.communities:
@@ -130,11 +162,23 @@ class DispersyStatistics(Statistics):
         self.delay_timeout = 0
         self.received_count = 0
         self.created_count = 0
+        self.verify_cache_hit = verified_signatures.hit = 0
+        self.verify_cache_miss = verified_signatures.miss = 0
+        self.member_cache_hit = Member.cache_hit = 0
+        self.member_cache_miss = Member.cache_miss = 0
+        self.member_cache_evictions = Member.cache_evictions = 0
+        self.public_key_cache_hit = public_keys.hit = 0
+        self.public_key_cache_miss = public_keys.miss = 0
+        self.public_key_cache_evictions = public_keys.evictions = 0
 
         self._dispersy.endpoint.reset_statistics()
         self.total_down = self._dispersy.endpoint.total_down
         self.total_up = self._dispersy.endpoint.total_up
         self.total_send = self._dispersy.endpoint.total_send
+        self.total_recv = self._dispersy.endpoint.total_recv
+        self.recv_syscalls = self._dispersy.endpoint.recv_syscalls
+        self.send_syscalls = self._dispersy.endpoint.send_syscalls
+        self.total_send_dropped = self._dispersy.endpoint.total_send_dropped
         self.cur_sendqueue = self._dispersy.endpoint.cur_sendqueue
         self.start = self.timestamp = time()
 
@@ -144,6 +188,9 @@ class DispersyStatistics(Statistics):
         self.walk_bootstrap_attempt = 0
         self.walk_bootstrap_success = 0
 
+        self.sync_response_cache_hit = 0
+        self.sync_response_cache_miss = 0
+
         if self.are_debug_statistics_enabled():
             self.drop = {}
             self.delay = {}
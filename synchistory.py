@@ -0,0 +1,115 @@
+"""
+The LastSyncHistory keeps the history of LastSyncDistribution messages in memory.
+
+A LastSyncDistribution message may only be stored history_size times for each member, or for each
+pair of members when the DoubleMemberAuthentication policy is used.  Previously the entire history
+was selected from the database for every stored batch, only to find the messages that had to be
+pruned.  The LastSyncHistory loads the history of a member (or pair of members) once and is kept up
+to date by Dispersy when packets are stored and pruned, allowing the obsolete packets to be deleted
+by their id.
+"""
+
+try:
+    # python 2.7 only...
+    from collections import OrderedDict
+except ImportError:
+    from .python27_ordereddict import OrderedDict
+
+from bisect import insort
+
+from .authentication import DoubleMemberAuthentication
+from .distribution import LastSyncDistribution
+from .revision import update_revision_information
+
+if __debug__:
+    from .dprint import dprint
+
+# update version information directly from SVN
+update_revision_information("$HeadURL$", "$Revision$")
+
+class LastSyncHistory(object):
+    # the maximum number of histories that are kept in memory
+    _cache_length = 4096
+
+    def __init__(self, community):
+        if __debug__:
+            from .community import Community
+            assert isinstance(community, Community)
+
+        # the community that this history is keeping track off
+        self._community = community
+
+        # _histories contains the most recently used histories, each history is an ascending list
+        # with (global_time, packet_id, member_database_id) tuples.  KEY is either a member
+        # database id or a (member1_database_id, member2_database_id) tuple where member1 < member2
+        # (meta_message_database_id, key) / [(global_time, packet_id, member_database_id)]
+        self._histories = OrderedDict()
+
+    def invalidate(self):
+        """
+        Discard all histories.  They will be loaded from the database again when they are needed.
+        """
+        if __debug__: dprint(self._community.cid.encode("HEX"), " invalidate last sync history")
+        self._histories.clear()
+
+    def _load(self, meta, key):
+        execute = self._community.dispersy.database.execute
+        if isinstance(meta.authentication, DoubleMemberAuthentication):
+            return sorted((global_time, packet_id, member_database_id)
+                          for packet_id, global_time, member_database_id
+                          in execute(u"""
+SELECT sync.id, sync.global_time, sync.member
+FROM sync
+JOIN double_signed_sync ON double_signed_sync.sync = sync.id
+WHERE sync.meta_message = ? AND double_signed_sync.member1 = ? AND double_signed_sync.member2 = ?""",
+                                     (meta.database_id,) + key))
+        else:
+            return sorted((global_time, packet_id, key)
+                          for packet_id, global_time
+                          in execute(u"SELECT id, global_time FROM sync WHERE meta_message = ? AND member = ?",
+                                     (meta.database_id, key)))
+
+    def get(self, meta, key):
+        """
+        Returns the history of KEY for META as an ascending list with (global_time, packet_id,
+        member_database_id) tuples.
+
+        The returned list must not be modified.
+
+        @param meta: The meta message with the LastSyncDistribution policy.
+        @type meta: Message
+
+        @param key: The member database id or, for the DoubleMemberAuthentication policy, the
+         ordered (member1_database_id, member2_database_id) tuple.
+        @type key: int or (int, int)
+        """
+        assert isinstance(meta.distribution, LastSyncDistribution)
+        assert isinstance(key, tuple) == isinstance(meta.authentication, DoubleMemberAuthentication)
+        cache_key = (meta.database_id, key)
+        history = self._histories.pop(cache_key, None)
+        if history is None:
+            history = self._load(meta, key)
+        # move to the most recently used position
+        self._histories[cache_key] = history
+        if len(self._histories) > self._cache_length:
+            self._histories.popitem(False)
+        return history
+
+    def add(self, meta, key, global_time, packet_id, member_database_id):
+        """
+        Add the stored packet PACKET_ID, created by MEMBER_DATABASE_ID, to the history of KEY for
+        META.
+
+        Returns a list with the (global_time, packet_id, member_database_id) tuples that no longer
+        fit in the history, i.e. the packets that must be removed from the database.
+        """
+        history = self.get(meta, key)
+        item = (global_time, packet_id, member_database_id)
+        # the history may have been loaded after the packet was stored
+        if not item in history:
+            insort(history, item)
+        if len(history) > meta.distribution.history_size:
+            obsolete = history[:len(history) - meta.distribution.history_size]
+            del history[:len(history) - meta.distribution.history_size]
+            return obsolete
+        return []
@@ -0,0 +1,292 @@
+"""
+The SyncIndex keeps the packet digests of the syncable packets of a community in memory, ordered by
+global time.
+
+Building a sync bloom filter requires the digests of all packets within a global time range (or a
+modulo/offset selection), with priority > 32, that are not undone.  Previously the packets were
+selected from the database for every walker step.  The SyncIndex is loaded from the database once
+and is kept up to date by Dispersy whenever packets are stored, undone, redone, or pruned.
+
+The SyncIndex also caches the sync response candidates, i.e. (digest, id) pairs, that Dispersy
+selects from the database when answering introduction requests that contain digest keyed bloom
+filters.  Many peers request the same range, hence these candidates only need to be selected once,
+until the sync table changes.
+
+The SyncKeyFilter is a bloom filter containing the (member, global_time) keys of all packets that a
+community has stored.  Most incoming packets are new, the SyncKeyFilter allows Dispersy to detect
+this without querying the database.
+"""
+
+try:
+    # python 2.7 only...
+    from collections import OrderedDict
+except ImportError:
+    from .python27_ordereddict import OrderedDict
+
+from bisect import bisect_left, bisect_right, insort
+from struct import Struct
+
+from .bloomfilter import ByteArrayBloomFilter
+from .distribution import SyncDistribution
+from .revision import update_revision_information
+
+if __debug__:
+    from .dprint import dprint
+
+# update version information directly from SVN
+update_revision_information("$HeadURL$", "$Revision$")
+
+class SyncIndex(object):
+    # the maximum number of cached sync response candidate lists
+    _response_cache_length = 32
+
+    def __init__(self, community):
+        if __debug__:
+            from .community import Community
+            assert isinstance(community, Community)
+
+        # the community that this index is keeping track off
+        self._community = community
+
+        # the meta message database ids that are part of the sync bloom filters
+        self._meta_message_ids = frozenset(meta.database_id
+                                           for meta
+                                           in community.get_meta_messages()
+                                           if isinstance(meta.distribution, SyncDistribution) and meta.distribution.priority > 32)
+
+        # the index is loaded from the database the first time it is queried
+        self._loaded = False
+
+        # _keys contains (global_time, member_database_id) tuples in ascending order
+        self._keys = []
+
+        # _digests contains the packet digest for every key in _keys
+        # (global_time, member_database_id) / digest
+        self._digests = {}
+
+        # _responses contains the most recently used sync response candidates
+        # (time_low, time_high, modulo, offset) / [(digest, id)]
+        self._responses = OrderedDict()
+
+    @property
+    def is_loaded(self):
+        """
+        Returns True when the index has been loaded from the database.
+        """
+        return self._loaded
+
+    @property
+    def has_syncable_messages(self):
+        """
+        Returns True when the community has one or more meta messages that are synced using the
+        bloom filters.
+        """
+        return bool(self._meta_message_ids)
+
+    def _load(self):
+        assert not self._loaded
+        if __debug__: dprint(self._community.cid.encode("HEX"), " loading sync index")
+        if self._meta_message_ids:
+            self._digests = dict(((global_time, member), str(digest))
+                                 for member, global_time, digest
+                                 in self._community.dispersy.database.execute(u"SELECT member, global_time, digest FROM sync WHERE meta_message IN (%s) AND undone = 0" % u", ".join(u"?" for _ in self._meta_message_ids),
+                                                                              tuple(self._meta_message_ids)))
+            self._keys = sorted(self._digests.iterkeys())
+        self._loaded = True
+
+    def invalidate(self):
+        """
+        Discard the index.  It will be loaded from the database again when it is queried.
+
+        This is used when the sync table is changed in ways that are not worth tracking, i.e. when
+        malicious behavior is detected or when a community is destroyed.
+        """
+        if __debug__: dprint(self._community.cid.encode("HEX"), " invalidate sync index")
+        self._loaded = False
+        self._keys = []
+        self._digests = {}
+        self._responses.clear()
+
+    def add(self, messages):
+        """
+        Add MESSAGES, that have been stored in the database and are not undone, to the index.
+
+        Messages that are not part of the sync bloom filters are ignored.
+        """
+        messages = [message for message in messages if message.database_id in self._meta_message_ids]
+        if messages:
+            self._responses.clear()
+
+            if self._loaded:
+                keys = self._keys
+                digests = self._digests
+                for message in messages:
+                    key = (message.distribution.global_time, message.authentication.member.database_id)
+                    if not key in digests:
+                        insort(keys, key)
+                    digests[key] = message.packet_digest
+
+    def remove(self, keys):
+        """
+        Remove KEYS, an iterator of (global_time, member_database_id) tuples, from the index.
+
+        Unknown keys are ignored.
+        """
+        self._responses.clear()
+        if self._loaded:
+            digests = self._digests
+            for key in keys:
+                if key in digests:
+                    del digests[key]
+                    del self._keys[bisect_left(self._keys, key)]
+
+    def replace(self, global_time, member_database_id, digest):
+        """
+        Replace the digest associated to (GLOBAL_TIME, MEMBER_DATABASE_ID), if it is in the index.
+        """
+        assert isinstance(digest, str)
+        self._responses.clear()
+        key = (global_time, member_database_id)
+        if self._loaded and key in self._digests:
+            self._digests[key] = digest
+
+    def __len__(self):
+        if not self._loaded:
+            self._load()
+        return len(self._keys)
+
+    def select(self, global_time, limit, higher=True):
+        """
+        Returns a list with at most LIMIT (global_time, digest) tuples.
+
+        When HIGHER is True the digests with a global time above GLOBAL_TIME are returned in
+        ascending order.  Otherwise the digests with a global time below GLOBAL_TIME are returned in
+        descending order.
+        """
+        if not self._loaded:
+            self._load()
+        keys = self._keys
+        digests = self._digests
+        if higher:
+            index = bisect_right(keys, (global_time, 0x7fffffffffffffff))
+            return [(key[0], digests[key]) for key in keys[index:index + limit]]
+        else:
+            index = bisect_left(keys, (global_time, -1))
+            return [(key[0], digests[key]) for key in reversed(keys[max(0, index - limit):index])]
+
+    def iter_range(self, time_low, time_high):
+        """
+        Yields all digests with a global time between TIME_LOW and TIME_HIGH (inclusive).
+        """
+        if not self._loaded:
+            self._load()
+        keys = self._keys
+        digests = self._digests
+        for index in xrange(bisect_left(keys, (time_low, -1)), bisect_right(keys, (time_high, 0x7fffffffffffffff))):
+            yield digests[keys[index]]
+
+    def iter_modulo(self, modulo, offset):
+        """
+        Yields all digests where (global_time + OFFSET) % MODULO is zero.
+        """
+        if not self._loaded:
+            self._load()
+        digests = self._digests
+        for key in self._keys:
+            if (key[0] + offset) % modulo == 0:
+                yield digests[key]
+
+    def get_response_candidates(self, time_low, time_high, modulo, offset):
+        """
+        Returns the cached sync response candidates for this selection or None when they are not
+        cached.
+
+        The candidates remain cached until a packet is added to, removed from, or replaced in the
+        index.
+        """
+        key = (time_low, time_high, modulo, offset)
+        candidates = self._responses.pop(key, None)
+        if candidates is not None:
+            # move to the most recently used position
+            self._responses[key] = candidates
+        return candidates
+
+    def set_response_candidates(self, time_low, time_high, modulo, offset, candidates):
+        """
+        Cache CANDIDATES, a list with (digest, id) pairs, as the sync response candidates for this
+        selection.
+        """
+        assert isinstance(candidates, list)
+        self._responses[(time_low, time_high, modulo, offset)] = candidates
+        if len(self._responses) > self._response_cache_length:
+            self._responses.popitem(False)
+
+class SyncKeyFilter(object):
+    # the error rate of the bloom filter, i.e. the fraction of new packets that still require a
+    # database query
+    _error_rate = 0.01
+
+    # the minimal number of keys that the bloom filter can hold
+    _minimal_capacity = 1024
+
+    _key_struct = Struct("!QQ")
+
+    def __init__(self, community):
+        if __debug__:
+            from .community import Community
+            assert isinstance(community, Community)
+
+        # the community that this filter is keeping track off
+        self._community = community
+
+        # the bloom filter is created from the database the first time it is queried
+        self._bloom_filter = None
+
+        # the number of keys that were added to the bloom filter
+        self._count = 0
+
+        # the number of keys that the bloom filter can hold before it must be recreated
+        self._capacity = 0
+
+    def _load(self):
+        assert self._bloom_filter is None
+        execute = self._community.dispersy.database.execute
+        count, = execute(u"SELECT COUNT(*) FROM sync WHERE community = ?", (self._community.database_id,)).next()
+        # reserve room for twice the current number of keys to avoid recreating the filter often
+        self._capacity = max(self._minimal_capacity, 2 * count)
+        if __debug__: dprint(self._community.cid.encode("HEX"), " loading sync key filter with ", count, " keys (capacity ", self._capacity, ")")
+        self._bloom_filter = ByteArrayBloomFilter(self._error_rate, self._capacity)
+        pack = self._key_struct.pack
+        self._bloom_filter.add_keys(pack(member, global_time)
+                                    for member, global_time
+                                    in execute(u"SELECT member, global_time FROM sync WHERE community = ?", (self._community.database_id,)))
+        self._count = count
+
+    def invalidate(self):
+        """
+        Discard the bloom filter.  It will be created from the database again when it is queried.
+        """
+        self._bloom_filter = None
+
+    def add(self, messages):
+        """
+        Add the keys of MESSAGES, that have been stored in the database, to the filter.
+        """
+        if self._bloom_filter:
+            pack = self._key_struct.pack
+            self._bloom_filter.add_keys(pack(message.authentication.member.database_id, message.distribution.global_time) for message in messages)
+            self._count += len(messages)
+            if self._count > self._capacity:
+                # the error rate becomes too high, recreate a larger filter when it is queried
+                self.invalidate()
+
+    def may_contain(self, member_database_id, global_time):
+        """
+        Returns False when the community has certainly not stored a packet with this
+        (MEMBER_DATABASE_ID, GLOBAL_TIME) key.  Returns True when it may have.
+
+        Keys of removed packets remain in the filter, this only results in an unnecessary query.
+        """
+        if self._bloom_filter is None:
+            self._load()
+        return self._key_struct.pack(member_database_id, global_time) in self._bloom_filter
@@ -3,6 +3,7 @@ from time import time
 
 from ..dispersy import Dispersy
 from ..callback import Callback
+from ..candidate import CandidateTable, WalkCandidate
 from ..member import Member
 from ..debugcommunity import DebugCommunity
 from ..crypto import ec_generate_key, ec_to_public_bin, ec_to_private_bin
@@ -96,3 +97,143 @@ class TestCandidates(unittest.TestCase):
             got.append(candidate.wan_address)
         
         self.assertEquals(expected, got)
+
+    def test_yield_walk_candidates(self):
+        c = DebugCommunity.create_community(self.mm)
+        candidates = []
+        for i in range(5):
+            address = ("127.0.0.1", i+1)
+            candidates.append(c.create_candidate(address, False, address, address, u"unknown"))
+
+        #stumble candidates must be yielded least recent first
+        now = time()
+        for i, candidate in enumerate(candidates):
+            candidate.stumble(c, now - 10.0 * (i + 1))
+
+        expected = [candidate.lan_address for candidate in reversed(candidates)]
+        got = [candidate.lan_address for candidate in c.dispersy_yield_walk_candidates() if candidate in candidates]
+
+        self.assertEquals(expected, got)
+
+        #an inactive candidate is no longer yielded
+        candidates[4].inactive(c, now)
+        got = [candidate.lan_address for candidate in c.dispersy_yield_walk_candidates() if candidate in candidates]
+
+        self.assertEquals(expected[1:], got)
+
+    def __create_member(self):
+        ec = ec_generate_key(u"low")
+        return Member(ec_to_public_bin(ec), ec_to_private_bin(ec))
+
+    def test_member_candidates(self):
+        c = DebugCommunity.create_community(self.mm)
+        m1 = self.__create_member()
+        m2 = self.__create_member()
+        a = c.create_candidate(("127.0.0.1", 1), False, ("127.0.0.1", 1), ("127.0.0.1", 1), u"unknown")
+        b = c.create_candidate(("127.0.0.1", 2), False, ("127.0.0.1", 2), ("127.0.0.1", 2), u"unknown")
+
+        a.associate(c, m1)
+        b.associate(c, m1)
+        b.associate(c, m2)
+        self.assertEquals(set([a, b]), set(c.get_member_candidates(m1)))
+        self.assertEquals(set([b]), set(c.get_member_candidates(m2)))
+        self.assertEquals(a, c.get_candidate_mid(m1.mid))
+
+        #disassociate removes the member once no candidates remain
+        b.disassociate(c, m2)
+        self.assertEquals((), c.get_member_candidates(m2))
+        self.assertEquals(None, c.get_candidate_mid(m2.mid))
+
+        #remove_candidate removes all associations of the candidate
+        c.remove_candidate(a.sock_addr)
+        self.assertEquals(set([b]), set(c.get_member_candidates(m1)))
+        self.assertEquals(b, c.get_candidate_mid(m1.mid))
+
+        c.remove_candidate(b.sock_addr)
+        self.assertEquals((), c.get_member_candidates(m1))
+        self.assertTrue(b.is_associated(c, m1))
+
+    def test_member_candidates_not_in_table(self):
+        c = DebugCommunity.create_community(self.mm)
+        m1 = self.__create_member()
+        candidate = WalkCandidate(("127.0.0.1", 1), False, ("127.0.0.1", 1), ("127.0.0.1", 1), u"unknown")
+
+        #candidates are only indexed once they are in the community
+        candidate.associate(c, m1)
+        self.assertEquals((), c.get_member_candidates(m1))
+
+        candidate.stumble(c, time())
+        self.assertEquals(set([candidate]), set(c.get_member_candidates(m1)))
+
+    def test_member_candidates_merge(self):
+        c = DebugCommunity.create_community(self.mm)
+        m1 = self.__create_member()
+        m2 = self.__create_member()
+
+        a = c.create_candidate(("1.1.1.1", 1), False, ("192.168.0.1", 1), ("1.1.1.1", 1), u"unknown")
+        a.associate(c, m1)
+        other = WalkCandidate(("1.1.1.1", 2), False, ("192.168.0.1", 1), ("1.1.1.1", 2), u"unknown")
+        other.associate(c, m2)
+
+        #the associations of the merged candidate are indexed for the candidate that remains
+        a.merge(other)
+        self.assertEquals(set([a]), set(c.get_member_candidates(m1)))
+        self.assertEquals(set([a]), set(c.get_member_candidates(m2)))
+
+        #and stay consistent once that candidate is removed
+        c.remove_candidate(a.sock_addr)
+        self.assertEquals((), c.get_member_candidates(m1))
+        self.assertEquals((), c.get_member_candidates(m2))
+
+class TestCandidateTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = CandidateTable()
+        for i in range(5):
+            self.table[("127.0.0.1", i+1)] = i+1
+
+    def test_order(self):
+        #keys are iterated in the order in which they were added, replacing a value keeps its position
+        self.table[("127.0.0.1", 1)] = 10
+        self.assertEquals([10, 2, 3, 4, 5], self.table.values())
+
+        del self.table[("127.0.0.1", 3)]
+        self.table[("127.0.0.1", 3)] = 3
+        self.assertEquals([10, 2, 4, 5, 3], self.table.values())
+
+    def test_cursor(self):
+        cursor = self.table.cursor()
+        got = [self.table.next(cursor) for _ in range(6)]
+        self.assertEquals([1, 2, 3, 4, 5, None], got)
+
+        #after returning None the cursor starts again at the first candidate
+        self.assertEquals(1, self.table.next(cursor))
+
+    def test_cursor_remove_current(self):
+        cursor = self.table.cursor()
+        self.assertEquals(1, self.table.next(cursor))
+        self.assertEquals(2, self.table.next(cursor))
+
+        #the cursor continues with the candidate that followed the removed one
+        del self.table[("127.0.0.1", 2)]
+        self.assertEquals(3, self.table.next(cursor))
+
+    def test_cursor_remove_current_and_previous(self):
+        cursor = self.table.cursor()
+        self.assertEquals(1, self.table.next(cursor))
+        self.assertEquals(2, self.table.next(cursor))
+
+        del self.table[("127.0.0.1", 2)]
+        del self.table[("127.0.0.1", 1)]
+        self.assertEquals([3, 4, 5, None], [self.table.next(cursor) for _ in range(4)])
+
+    def test_cursor_remove_last(self):
+        cursor = self.table.cursor()
+        for _ in range(5):
+            self.table.next(cursor)
+
+        #new candidates are yielded, even when the candidate before them was removed
+        self.table.pop(("127.0.0.1", 5))
+        self.table[("127.0.0.1", 6)] = 6
+        self.assertEquals(6, self.table.next(cursor))
+        self.assertEquals(None, self.table.next(cursor))
@@ -0,0 +1,108 @@
+import unittest
+
+from ..endpoint import SendQueue, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+
+class TestSendQueue(unittest.TestCase):
+
+    def test_priority(self):
+        queue = SendQueue()
+        address = ("127.0.0.1", 1)
+        queue.put(address, "low", PRIORITY_LOW)
+        queue.put(address, "normal", PRIORITY_NORMAL)
+        queue.put(address, "high", PRIORITY_HIGH)
+        self.assertEquals(3, len(queue))
+
+        #packets are taken by priority, regardless of the order in which they were queued
+        expected = [(address, "high"), (address, "normal"), (address, "low")]
+        self.assertEquals(expected, queue.take(10))
+        self.assertEquals(0, len(queue))
+
+    def test_round_robin(self):
+        queue = SendQueue()
+        a, b, c = ("127.0.0.1", 1), ("127.0.0.1", 2), ("127.0.0.1", 3)
+        for data in ("a1", "a2", "a3"):
+            queue.put(a, data)
+        queue.put(b, "b1")
+        queue.put(c, "c1")
+
+        #destinations take turns, one packet each
+        expected = [(a, "a1"), (b, "b1"), (c, "c1"), (a, "a2"), (a, "a3")]
+        self.assertEquals(expected, queue.take(10))
+
+    def test_take_count(self):
+        queue = SendQueue()
+        a, b = ("127.0.0.1", 1), ("127.0.0.1", 2)
+        queue.put(a, "a1")
+        queue.put(a, "a2")
+        queue.put(b, "b1")
+
+        self.assertEquals([(a, "a1"), (b, "b1")], queue.take(2))
+        self.assertEquals(1, len(queue))
+        self.assertEquals([(a, "a2")], queue.take(2))
+        self.assertEquals([], queue.take(2))
+
+    def test_restore(self):
+        queue = SendQueue()
+        a, b = ("127.0.0.1", 1), ("127.0.0.1", 2)
+        queue.put(a, "a1")
+        queue.put(a, "a2")
+        queue.put(b, "b1")
+        self.assertEquals([(a, "a1"), (b, "b1"), (a, "a2")], queue.take(10))
+
+        #only the first packet was sent, the others return to the front of the queue in order
+        queue.restore(1)
+        self.assertEquals(2, len(queue))
+
+        queue.put(a, "a3")
+        expected = [(b, "b1"), (a, "a2"), (a, "a3")]
+        self.assertEquals(expected, queue.take(10))
+
+    def test_restore_priority(self):
+        queue = SendQueue()
+        address = ("127.0.0.1", 1)
+        queue.put(address, "high", PRIORITY_HIGH)
+        queue.put(address, "low", PRIORITY_LOW)
+        queue.take(10)
+
+        #nothing was sent, both packets return to their own priority
+        queue.restore(0)
+        queue.put(address, "normal", PRIORITY_NORMAL)
+        expected = [(address, "high"), (address, "normal"), (address, "low")]
+        self.assertEquals(expected, queue.take(10))
+
+    def test_max_length(self):
+        queue = SendQueue(max_length=2)
+        address = ("127.0.0.1", 1)
+        self.assertTrue(queue.put(address, "1"))
+        self.assertTrue(queue.put(address, "2"))
+        self.assertFalse(queue.put(address, "3"))
+        self.assertEquals(2, len(queue))
+
+    def test_token_bucket(self):
+        #100 bytes per second with a burst of 100 bytes
+        queue = SendQueue(rate=100, burst=100)
+        address = ("127.0.0.1", 1)
+        for _ in xrange(3):
+            queue.put(address, "x" * 60)
+        self.assertEquals(0.0, queue.delay)
+
+        #the second packet is taken while tokens remain, leaving the bucket 20 bytes short
+        self.assertEquals(2, len(queue.take(10)))
+        self.assertTrue(0.0 < queue.delay <= 0.21, queue.delay)
+
+        #no packets are taken until the bucket refills
+        self.assertEquals([], queue.take(10))
+        self.assertEquals(1, len(queue))
+
+    def test_restore_tokens(self):
+        queue = SendQueue(rate=100, burst=100)
+        address = ("127.0.0.1", 1)
+        queue.put(address, "x" * 60)
+        queue.put(address, "x" * 60)
+        self.assertEquals(2, len(queue.take(10)))
+        self.assertTrue(queue.delay > 0.0)
+
+        #the second packet was not sent, its 60 bytes are returned to the bucket
+        queue.restore(1)
+        self.assertEquals(0.0, queue.delay)
+        self.assertEquals([(address, "x" * 60)], queue.take(10))
@@ -0,0 +1,127 @@
+"""
+Measure the memory used by WalkCandidate instances.
+
+Creates COUNT synthetic candidates, each known in COMMUNITIES communities, and outputs:
+- OWNED BYTES-PER-CANDIDATE, the size of the objects that are owned by a single candidate
+- RSS BYTES-PER-CANDIDATE, the growth of the resident set size divided by COUNT
+"""
+
+if __name__ == "__main__":
+    # Concerning the relative imports, from PEP 328:
+    # http://www.python.org/dev/peps/pep-0328/
+    #
+    #    Relative imports use a module's __name__ attribute to determine that module's position in
+    #    the package hierarchy. If the module's name does not contain any package information
+    #    (e.g. it is set to '__main__') then relative imports are resolved as if the module were a
+    #    top level module, regardless of where the module is actually located on the file system.
+    print "Usage: python -c \"from dispersy.tool.candidatememory import main; main()\" [--count COUNT] [--communities COMMUNITIES]"
+    exit(1)
+
+from hashlib import sha1
+from time import time
+import gc
+import optparse
+import resource
+import sys
+
+from ..candidate import WalkCandidate, CandidateIndex, CandidateTable
+from ..community import Community
+from ..member import Member
+
+class SyntheticCommunity(Community):
+    """
+    A Community that only provides what WalkCandidate requires, i.e. it has no database, no
+    Dispersy instance, and no messages.
+    """
+    def __init__(self, cid):
+        self._cid = cid
+        self._candidates = CandidateTable()
+        self._candidate_index = CandidateIndex(cid)
+        self._member_candidates = {}
+
+    def add_candidate(self, candidate):
+        self._candidate_index.update(candidate)
+
+class SyntheticMember(Member):
+    """
+    A Member that does not require a key or a database.
+    """
+    def __new__(cls, database_id):
+        # bypass the Member cache
+        return object.__new__(cls)
+
+    def __init__(self, database_id):
+        self._database_id = database_id
+        self._mid = sha1(str(database_id)).digest()
+        self._public_key = self._mid
+
+def owned_size(candidate):
+    """
+    Returns the number of bytes used by CANDIDATE and the containers that only CANDIDATE refers to.
+
+    Addresses, community identifiers, and members are shared with the rest of Dispersy and are not
+    included.
+    """
+    size = sys.getsizeof(candidate)
+    if hasattr(candidate, "__dict__"):
+        size += sys.getsizeof(candidate.__dict__)
+    if candidate._associations:
+        size += sys.getsizeof(candidate._associations)
+        size += sum(sys.getsizeof(association) for association in candidate._associations)
+    if candidate._global_times:
+        size += sys.getsizeof(candidate._global_times)
+    size += sys.getsizeof(candidate._timestamps)
+    for timestamps in candidate._timestamps.itervalues():
+        size += sys.getsizeof(timestamps)
+        size += sum(sys.getsizeof(getattr(timestamps, name)) for name in timestamps.__slots__)
+    return size
+
+def rss():
+    """
+    Returns the maximum resident set size in bytes.
+    """
+    # ru_maxrss is given in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def main():
+    command_line_parser = optparse.OptionParser()
+    command_line_parser.add_option("--count", action="store", type="int", help="The number of candidates to create", default=100000)
+    command_line_parser.add_option("--communities", action="store", type="int", help="The number of communities that each candidate is in", default=1)
+
+    # parse command-line arguments
+    opt, _ = command_line_parser.parse_args()
+    assert opt.count > 0
+    assert opt.communities > 0
+
+    communities = [SyntheticCommunity(sha1(str(index)).digest()) for index in xrange(opt.communities)]
+    members = [SyntheticMember(index) for index in xrange(1, 1001)]
+
+    gc.collect()
+    before = rss()
+
+    now = time()
+    candidates = []
+    for index in xrange(opt.count):
+        # all sock_addr tuples are unique, just like the candidates that Dispersy receives
+        sock_addr = ("10.%d.%d.%d" % (index >> 16 & 255, index >> 8 & 255, index & 255), 1024 + index % 50000)
+        candidate = WalkCandidate(sock_addr, False, sock_addr, sock_addr, u"unknown")
+        for community in communities:
+            # one in four candidates is walked or stumbled upon, the others are only introduced
+            if index % 4 == 0:
+                candidate.walk(community, now + index, 0.0)
+                candidate.associate(community, members[index % len(members)])
+                candidate.set_global_time(community, index)
+            elif index % 4 == 1:
+                candidate.stumble(community, now + index)
+                candidate.associate(community, members[index % len(members)])
+                candidate.set_global_time(community, index)
+            else:
+                candidate.intro(community, now + index)
+        candidates.append(candidate)
+
+    gc.collect()
+    after = rss()
+
+    print "CANDIDATES", len(candidates), "COMMUNITIES", len(communities)
+    print "OWNED", sum(owned_size(candidate) for candidate in candidates) / len(candidates)
+    print "RSS", (after - before) / len(candidates)
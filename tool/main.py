@@ -8,7 +8,7 @@ import signal
 from ..callback import Callback
 from ..dispersy import Dispersy
 from ..dprint import dprint
-from ..endpoint import StandaloneEndpoint
+from ..endpoint import StandaloneEndpoint, EpollEndpoint
 from threading import currentThread
 
 def watchdog(dispersy):
@@ -53,6 +53,8 @@ def main_real(setup=None):
     command_line_parser.add_option("--script", action="store", type="string", help="Script to execute, i.e. module.module.class", default="")
     command_line_parser.add_option("--kargs", action="store", type="string", help="Executes --script with these arguments.  Example 'startingtimestamp=1292333014,endingtimestamp=12923340000'")
     command_line_parser.add_option("--debugstatistics", action="store_true", help="turn on debug statistics", default=False)
+    command_line_parser.add_option("--bulk", action="store_true", help="receive and send datagrams in batches (recvmmsg/sendmmsg)", default=False)
+    command_line_parser.add_option("--epoll", action="store_true", help="handle the socket on the Dispersy thread using epoll", default=False)
     # # swift
     # command_line_parser.add_option("--swiftproc", action="store_true", help="Use swift to tunnel all traffic", default=False)
     # command_line_parser.add_option("--swiftpath", action="store", type="string", default="./swift")
@@ -81,7 +83,10 @@ def main_real(setup=None):
     #     dispersy.endpoint = TunnelEndpoint(swift_process, dispersy)
     #     swift_process.add_download(dispersy.endpoint)
     # else:
-    dispersy.endpoint = StandaloneEndpoint(dispersy, opt.port, opt.ip)
+    if opt.epoll:
+        dispersy.endpoint = EpollEndpoint(dispersy, opt.port, opt.ip, bulk=opt.bulk)
+    else:
+        dispersy.endpoint = StandaloneEndpoint(dispersy, opt.port, opt.ip, bulk=opt.bulk)
     dispersy.endpoint.start()
 
     # register tasks